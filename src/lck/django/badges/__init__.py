@@ -33,3 +33,11 @@ from lck.django.badges.models import update_type, update_group
 def do_nothing(**kwargs):
     """A dummy callback for badges."""
     pass
+
+
+def batch_callback(func):
+    """Marks a badge callback which supports batch evaluation by the
+    ``recompute_badges`` command. Called with a list of owners as the
+    `owners` keyword argument, it returns the owners which qualify."""
+    func.batch = True
+    return func
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""lck.django.badges.executors
+   ---------------------------
+
+   Runs badge callbacks. Callbacks are resolved from their dotted paths once
+   per process and run by an executor chosen in ``settings.py``:
+
+   * ``BADGES_EXECUTOR`` - ``"inline"`` runs callbacks right away,
+     ``"thread"`` runs them in a pool of in-process threads, ``"process"``
+     runs them in a pool of forked processes (use it for CPU-heavy rules),
+     ``"rq"`` and ``"celery"`` run them in a task queue worker. Callbacks
+     which are Celery tasks themselves are run within the worker's task, so
+     that their pending update is only forgotten when it starts.
+     **Default**: ``"celery"``.
+
+   * ``BADGES_EXECUTOR_WORKERS`` - size of the thread or process pool.
+     **Default**: 2.
+
+   * ``BADGES_DEDUP_WINDOW`` - an update requested with the same arguments
+     as one that's still waiting to run is dropped. This is how long such
+     a pending update is remembered, in seconds. 0 disables deduplication.
+     **Default**: 5 seconds.
+
+   * ``BADGES_TASK_EXPIRATION`` - expiration of queued tasks in seconds.
+     **Default**: 300 seconds.
+
+   Each process collects call counts, errors and timings per callback,
+   available through ``get_metrics()``. Runs in a thread or process pool are
+   recorded in the process that dispatched them."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from hashlib import md5
+import importlib
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db import models as db
+try:
+    import celery
+except ImportError:
+    celery = None
+
+
+LOG = logging.getLogger(__name__)
+BADGES_EXECUTOR = getattr(settings, 'BADGES_EXECUTOR', 'celery')
+BADGES_EXECUTOR_WORKERS = getattr(settings, 'BADGES_EXECUTOR_WORKERS', 2)
+BADGES_DEDUP_WINDOW = getattr(settings, 'BADGES_DEDUP_WINDOW', 5)
+BADGES_TASK_EXPIRATION = getattr(settings, 'BADGES_TASK_EXPIRATION', 300)
+
+_CALLBACKS = {}
+_METRICS = {}
+_metrics_lock = threading.Lock()
+
+
+def resolve_callback(path):
+    """Returns the callable at the dotted `path`, imported only once per
+    process."""
+    try:
+        return _CALLBACKS[path]
+    except KeyError:
+        pass
+    module, _, name = path.rpartition('.')
+    try:
+        callback = getattr(importlib.import_module(module), name)
+    except (ImportError, ValueError, AttributeError):
+        raise ValueError("Cannot find badge callback `{}`".format(path))
+    _CALLBACKS[path] = callback
+    return callback
+
+
+def record(path, duration, failed=False):
+    with _metrics_lock:
+        metrics = _METRICS.setdefault(path, {'calls': 0, 'errors': 0,
+            'total_time': 0.0, 'max_time': 0.0})
+        metrics['calls'] += 1
+        metrics['errors'] += int(failed)
+        metrics['total_time'] += duration
+        metrics['max_time'] = max(metrics['max_time'], duration)
+
+
+def get_metrics():
+    """Returns ``{path: {'calls', 'errors', 'total_time', 'max_time',
+    'avg_time'}}`` for callbacks run in this process."""
+    with _metrics_lock:
+        result = {}
+        for path, metrics in _METRICS.iteritems():
+            result[path] = dict(metrics,
+                avg_time=metrics['total_time'] / metrics['calls'])
+        return result
+
+
+def run(path, args, kwargs, dedup_key=None):
+    """Runs the callback at `path`. Returns ``(path, duration, failed)``."""
+    if dedup_key:
+        # updates requested from now on aren't covered by this run
+        cache.delete(dedup_key)
+    start = time.time()
+    failed = False
+    try:
+        resolve_callback(path)(*args, **kwargs)
+    except Exception:
+        failed = True
+        LOG.exception("Badge callback `%s` failed.", path)
+    return path, time.time() - start, failed
+
+
+def _record_result(result):
+    record(*result)
+
+
+def _run_and_record(path, args, kwargs, dedup_key=None):
+    _record_result(run(path, args, kwargs, dedup_key))
+
+
+def _run_in_thread(path, args, kwargs, dedup_key=None):
+    try:
+        return run(path, args, kwargs, dedup_key)
+    finally:
+        # pool threads open their own connections, don't leak them
+        for connection in connections.all():
+            connection.close()
+
+
+def _init_process():
+    # the forked connections belong to the parent, don't close them
+    for connection in connections.all():
+        connection.connection = None
+
+
+class InlineExecutor(object):
+    def submit(self, path, args, kwargs, dedup_key=None):
+        _run_and_record(path, args, kwargs, dedup_key)
+
+
+class PoolExecutor(object):
+    def __init__(self, workers=BADGES_EXECUTOR_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def make_pool(self):
+        return ThreadPool(self.workers)
+
+    def submit(self, path, args, kwargs, dedup_key=None):
+        with self._lock:
+            if self._pool is None:
+                self._pool = self.make_pool()
+        self._pool.apply_async(_run_in_thread, (path, args, kwargs,
+            dedup_key), callback=_record_result)
+
+
+class ProcessExecutor(PoolExecutor):
+    def make_pool(self):
+        return multiprocessing.Pool(self.workers, initializer=_init_process)
+
+
+class RQExecutor(object):
+    def __init__(self):
+        import django_rq
+        self.queue = django_rq.get_queue('badges')
+
+    def submit(self, path, args, kwargs, dedup_key=None):
+        self.queue.enqueue_call(_run_and_record, (path, args, kwargs,
+            dedup_key), timeout=BADGES_TASK_EXPIRATION,
+            result_ttl=BADGES_TASK_EXPIRATION)
+
+
+if celery is not None:
+    # registered on import so that workers know it
+    run_task = celery.task(expires=BADGES_TASK_EXPIRATION,
+        name='lck.django.badges.run')(_run_and_record)
+
+
+class CeleryExecutor(object):
+    def submit(self, path, args, kwargs, dedup_key=None):
+        if celery is None:
+            raise ImproperlyConfigured("BADGES_EXECUTOR is 'celery' but "
+                "Celery is not installed.")
+        run_task.delay(path, args, kwargs, dedup_key)
+
+
+EXECUTORS = {
+    'inline': InlineExecutor,
+    'thread': PoolExecutor,
+    'process': ProcessExecutor,
+    'rq': RQExecutor,
+    'celery': CeleryExecutor,
+}
+if BADGES_EXECUTOR not in EXECUTORS:
+    raise ImproperlyConfigured("Unknown BADGES_EXECUTOR: {!r}. Use {}.".format(
+        BADGES_EXECUTOR, ", ".join(repr(e) for e in sorted(EXECUTORS))))
+executor = EXECUTORS[BADGES_EXECUTOR]()
+
+
+def _token(value):
+    if isinstance(value, db.Model):
+        return "{}.{}:{}".format(value._meta.app_label,
+            value._meta.object_name, value.pk)
+    return repr(value)
+
+
+def _dedup_key(path, args, kwargs):
+    tokens = [path]
+    tokens.extend(_token(arg) for arg in args)
+    tokens.extend("{}={}".format(key, _token(kwargs[key]))
+        for key in sorted(kwargs))
+    return "badges::pending::{}".format(md5("\n".join(tokens).encode('utf8')
+        ).hexdigest())
+
+
+def dispatch(path, *args, **kwargs):
+    """Runs the badge callback at `path` with the given arguments on the
+    configured executor. Returns False if an identical update is already
+    pending."""
+    resolve_callback(path) # fail early on invalid paths
+    dedup_key = None
+    if BADGES_DEDUP_WINDOW > 0 and BADGES_EXECUTOR != 'inline':
+        dedup_key = _dedup_key(path, args, kwargs)
+        if not cache.add(dedup_key, True, BADGES_DEDUP_WINDOW):
+            return False
+    executor.submit(path, args, kwargs, dedup_key)
+    return True
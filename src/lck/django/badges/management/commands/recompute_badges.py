@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import json
+import multiprocessing
+from optparse import make_option
+import os
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connections, transaction
+from django.db.models import get_model
+
+from lck.django.badges.executors import resolve_callback
+from lck.django.badges.models import Badge, BadgeType, get_badge_type
+
+
+def get_owner_model(label):
+    try:
+        app_label, model_name = label.split('.')
+    except ValueError:
+        model = None
+    else:
+        model = get_model(app_label, model_name)
+    if model is None:
+        raise CommandError("Unknown model: {!r}. Use the `app.Model` "
+            "format.".format(label))
+    return model
+
+
+def get_batch_callback(badge_type):
+    """Returns the callback of `badge_type` if it's marked with
+    `lck.django.badges.batch_callback`, otherwise None."""
+    callback = resolve_callback(badge_type.callback or
+        badge_type.group.callback)
+    return callback if getattr(callback, 'batch', False) else None
+
+
+def init_process():
+    # the forked connections belong to the parent, don't close them
+    for connection in connections.all():
+        connection.connection = None
+
+
+@transaction.commit_on_success
+def evaluate_chunk(chunk):
+    """Evaluates badge types on owners with primary keys between `first` and
+    `last`. Only batch callbacks are evaluated, see
+    `lck.django.badges.batch_callback`.
+
+    Types are evaluated together with the other evaluated types of their
+    group. In groups which allow a single badge, owners keep a badge of
+    a type they still qualify for. Otherwise they're awarded the type given
+    last among the ones they qualify for.
+
+    Returns ``(last, owner count, awarded count, revoked count)``."""
+    label, type_keys, first, last = chunk
+    model = get_owner_model(label)
+    owners = list(model._default_manager.filter(pk__gte=first,
+        pk__lte=last).order_by('pk'))
+    owner_ct = ContentType.objects.get_for_model(model)
+    groups = defaultdict(list)
+    for key in type_keys:
+        badge_type = get_badge_type(key)
+        callback = get_batch_callback(badge_type)
+        if callback:
+            groups[badge_type.group_id].append((badge_type,
+                set(callback(owners=owners))))
+    awarded = revoked = 0
+    for group_types in groups.itervalues():
+        holding = defaultdict(set)
+        for owner_oid, type_key in Badge.objects.filter(type__in=[
+            badge_type.pk for badge_type, _ in group_types],
+            owner_ct=owner_ct, owner_oid__in=[owner.pk for owner in owners]
+            ).values_list('owner_oid', 'type'):
+            holding[owner_oid].add(type_key)
+        for badge_type, qualifying in group_types:
+            revoked += Badge.revoke_many(badge_type, [owner for owner in owners
+                if owner not in qualifying and
+                badge_type.pk in holding[owner.pk]])
+        missing = defaultdict(list)
+        if group_types[0][0].group.multiple_allowed:
+            # owners keep the badges they already have
+            for badge_type, qualifying in group_types:
+                missing[badge_type].extend(owner for owner in qualifying
+                    if badge_type.pk not in holding[owner.pk])
+        else:
+            # a single badge per owner, otherwise awarding one type would
+            # replace the other on every run
+            for owner in owners:
+                types = [badge_type for badge_type, qualifying in group_types
+                    if owner in qualifying]
+                if types and not holding[owner.pk] & {badge_type.pk
+                    for badge_type in types}:
+                    missing[types[-1]].append(owner)
+        for badge_type, type_owners in missing.iteritems():
+            if type_owners:
+                Badge.award_many(badge_type, type_owners)
+                awarded += len(type_owners)
+    return last, len(owners), awarded, revoked
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--model', dest='model', default='auth.User',
+            help='The `app.Model` of badge owners. Default: auth.User.'),
+        make_option('--type', dest='types', action='append', default=[],
+            help='Only evaluate the badge type with the given key. Can be '
+            'given multiple times, later types win when an owner qualifies '
+            'for several of a single-badge group. Default: all types with '
+            'a callback, by key.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=500, help='How many owners to evaluate in a single '
+            'transaction. Default: 500.'),
+        make_option('--processes', dest='processes', type='int', default=1,
+            help='How many worker processes evaluate chunks. Default: 1.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='Path to a file storing the last evaluated owner. If it '
+            'exists, evaluation resumes after that owner.'),
+    )
+    help = ("Re-evaluates badge rules for all owners in chunks, awarding and "
+            "revoking badges in bulk.")
+
+    def handle_noargs(self, **options):
+        label = options['model']
+        model = get_owner_model(label)
+        type_keys = options['types']
+        if not type_keys:
+            type_keys = [badge_type.key for badge_type in
+                BadgeType.objects.select_related('group').order_by('key')
+                if badge_type.callback or badge_type.group.callback]
+        for key in type_keys:
+            try:
+                badge_type = get_badge_type(key)
+            except BadgeType.DoesNotExist:
+                raise CommandError("Unknown badge type: {!r}.".format(key))
+            if options['types'] and not get_batch_callback(badge_type):
+                raise CommandError("The callback of {!r} doesn't support "
+                    "batch evaluation.".format(key))
+        checkpoint = options['checkpoint']
+        last_pk = self.load_checkpoint(checkpoint, label)
+        chunks = self.iter_chunks(model, label, type_keys, last_pk,
+            options['chunk_size'])
+        if options['processes'] > 1:
+            pool = multiprocessing.Pool(options['processes'],
+                initializer=init_process)
+            # ordered, so that the checkpoint never skips a chunk
+            results = pool.imap(evaluate_chunk, chunks)
+        else:
+            pool = None
+            results = (evaluate_chunk(chunk) for chunk in chunks)
+        started = time.time()
+        owners = awarded = revoked = 0
+        try:
+            for last_pk, count, chunk_awarded, chunk_revoked in results:
+                owners += count
+                awarded += chunk_awarded
+                revoked += chunk_revoked
+                self.save_checkpoint(checkpoint, label, last_pk)
+                if int(options['verbosity']) > 1:
+                    print("{} owners evaluated ({:.1f} owners/s).".format(
+                        owners, owners / (time.time() - started)))
+        finally:
+            if pool:
+                pool.terminate()
+        elapsed = time.time() - started
+        print("{} owners evaluated in {:.1f} s ({:.1f} owners/s), {} badges "
+            "awarded, {} revoked.".format(owners, elapsed,
+            owners / elapsed if elapsed else 0, awarded, revoked))
+
+    def iter_chunks(self, model, label, type_keys, last_pk, chunk_size):
+        pks = model._default_manager.order_by('pk').values_list('pk',
+            flat=True)
+        while True:
+            chunk = list(pks.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                return
+            last_pk = chunk[-1]
+            yield label, type_keys, chunk[0], last_pk
+
+    def load_checkpoint(self, path, label):
+        if not path or not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['model'] != label:
+            raise CommandError("Checkpoint {!r} was saved for {!r}.".format(
+                path, checkpoint['model']))
+        return checkpoint['last_pk']
+
+    def save_checkpoint(self, path, label, last_pk):
+        if not path:
+            return
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'model': label, 'last_pk': last_pk}, f)
+        os.rename(path + '.tmp', path)
@@ -31,17 +31,34 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import importlib
-from os.path import splitext
+from collections import defaultdict
+from datetime import datetime
+import time
 
-from django.db import models as db
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import models as db
+from django.db.models import Count
+from django.db import router
+from django.db.models.signals import post_delete, post_save
+from django.db.models.sql import DeleteQuery
 from django.contrib.contenttypes.generic import GenericForeignKey
 from django.utils.translation import ugettext_lazy as _
+try:
+    from django.utils.timezone import now
+except ImportError:
+    now = datetime.now
+
+from lck.django.badges import executors
 from lck.django.common.models import Named, TimeTrackable, EditorTrackable,\
     ImageModel
 
 
+BADGES_SUMMARY_TIMEOUT = getattr(settings, 'BADGES_SUMMARY_TIMEOUT',
+    60 * 60 * 24)
+
+
 class BadgeMetadata(Named.NonUnique, TimeTrackable):
     key = db.CharField(verbose_name=_("key"), max_length=75, primary_key=True)
     description = db.TextField(verbose_name=_("description"),
@@ -167,45 +184,267 @@ class Badge(TimeTrackable, EditorTrackable):
         type, it is "upgraded" to the current type unless `multiple_allowed`
         is set on the badge group. In the latter case a duplicate badge is
         awarded.
+
+        Like a regular save and delete, this sends ``post_save`` and
+        ``post_delete`` for the badges created and removed.
         """
-        badge_type = BadgeType.objects.get(pk=type)
-        old_badges = Badge.find_by_group(badge_type.group.key, owner=owner,
-            subject=subject)
-        create_badge = False
-        if badge_type.group.multiple_allowed or not old_badges:
-            create_badge = True
+        return cls._award(type, [owner], subject, send_signals=True)[owner]
+
+    @classmethod
+    def award_many(cls, type, owners, subject=None):
+        """Like `award()` but for many `owners` at once. Existing badges
+        for all owners are looked up in a single query, outdated ones are
+        removed with a single bulk delete and new ones are inserted with
+        a single `bulk_create`.
+
+        No ``post_save`` or ``post_delete`` signals are sent, whatever the
+        number of owners. Cached badge summaries are invalidated directly.
+
+        Returns a dictionary mapping each owner to its badge. Badges created
+        in bulk don't have their primary keys set."""
+        return cls._award(type, owners, subject, send_signals=False)
+
+    @classmethod
+    def _award(cls, type, owners, subject, send_signals):
+        badge_type = get_badge_type(type)
+        group = badge_type.group
+        owners = list(owners)
+        subject_filter = _subject_filter(subject)
+        result = {}
+        outdated = []
+        if not group.multiple_allowed:
+            group_types = _get_registry()['group_types'][group.pk]
+            for owner_ct_id, ct_owners in _owners_by_ct(owners).iteritems():
+                by_pk = {owner.pk: owner for owner in ct_owners}
+                existing = Badge.objects.filter(type__in=group_types,
+                    owner_ct=owner_ct_id, owner_oid__in=by_pk.keys(),
+                    **subject_filter).order_by('id')
+                for badge in existing:
+                    owner = by_pk[badge.owner_oid]
+                    if badge.type_id != badge_type.pk or owner in result:
+                        # upgraded or duplicate
+                        outdated.append(badge)
+                    else:
+                        badge.type = badge_type
+                        badge.owner = owner
+                        result[owner] = badge
+        _delete_badges([badge.id for badge in outdated])
+        if send_signals:
+            using = router.db_for_write(Badge)
+            for badge in outdated:
+                post_delete.send(sender=Badge, instance=badge, using=using)
+        new_badges = []
+        for owner in owners:
+            if owner not in result:
+                result[owner] = Badge._create(type=badge_type, owner=owner,
+                    subject=subject)
+                new_badges.append(result[owner])
+        if send_signals:
+            for badge in new_badges:
+                badge.save()
+            # the signal handlers have invalidated the summaries
+            return result
+        if new_badges:
+            # bulk_create() doesn't call save(), set what it would
+            timestamp = now()
+            for badge in new_badges:
+                badge.created = badge.modified = timestamp
+                badge.cache_version += 1
+            Badge.objects.bulk_create(new_badges)
+            for badge in new_badges:
+                badge._update_field_state()
+        if outdated or new_badges:
+            invalidate_badge_summaries(owners)
+        return result
+
+    @classmethod
+    def revoke_many(cls, type, owners, subject=None):
+        """Removes badges of a specified `type` from all `owners` with
+        a single bulk delete. Like `award_many()`, it sends no signals.
+        Returns the number of badges removed."""
+        badge_type = get_badge_type(type)
+        subject_filter = _subject_filter(subject)
+        revoked = []
+        for owner_ct_id, ct_owners in _owners_by_ct(owners).iteritems():
+            revoked.extend(Badge.objects.filter(type=badge_type.pk,
+                owner_ct=owner_ct_id, owner_oid__in=[owner.pk
+                for owner in ct_owners], **subject_filter).values_list('id',
+                flat=True))
+        _delete_badges(revoked)
+        if revoked:
+            invalidate_badge_summaries(owners)
+        return len(revoked)
+
+
+def _owners_by_ct(owners):
+    result = defaultdict(list)
+    for owner in owners:
+        owner_ct = ContentType.objects.get_for_model(owner.__class__)
+        result[owner_ct.id].append(owner)
+    return result
+
+
+def _subject_filter(subject):
+    if not subject:
+        return {}
+    return {
+        'subject_ct': ContentType.objects.get_for_model(subject.__class__),
+        'subject_oid': subject.pk,
+    }
+
+
+def _delete_badges(ids):
+    if ids:
+        # nothing refers to badges so there's nothing to collect
+        DeleteQuery(Badge).delete_batch(ids, router.db_for_write(Badge))
+
+
+_REGISTRY = {'version': None}
+_REGISTRY_VERSION_KEY = 'badges::registry::version'
+
+
+def _get_registry():
+    """Returns badge types and groups keyed by their primary keys. The
+    registry is kept in process memory and reloaded after any badge type or
+    group is saved or deleted in a process sharing the same cache."""
+    global _REGISTRY
+    version = cache.get(_REGISTRY_VERSION_KEY)
+    if version is None:
+        # never start from a value that might have been used before
+        cache.add(_REGISTRY_VERSION_KEY, int(time.time() * 1000),
+            60 * 60 * 24 * 30)
+        version = cache.get(_REGISTRY_VERSION_KEY)
+    registry = _REGISTRY
+    if version is None or registry['version'] != version:
+        groups = {group.pk: group for group in BadgeGroup.objects.all()}
+        types = {}
+        group_types = defaultdict(list)
+        for badge_type in BadgeType.objects.select_related('icon'):
+            badge_type.group = groups[badge_type.group_id]
+            types[badge_type.pk] = badge_type
+            group_types[badge_type.group_id].append(badge_type.pk)
+        # replaced as a whole, other threads might be reading it
+        registry = _REGISTRY = {'version': version, 'types': types,
+            'groups': groups, 'group_types': group_types}
+    return registry
+
+
+def _summary_key(ct_id, owner_pk, version):
+    return "badges::summary::{}::{}::{}".format(version, ct_id, owner_pk)
+
+
+def _type_summary(badge_type, count):
+    icon = badge_type.icon
+    return {
+        'key': badge_type.key,
+        'name': badge_type.name,
+        'icon': icon.image.url if icon and icon.image else None,
+        'count': count,
+    }
+
+
+def get_badge_summaries(owners):
+    """Returns a dictionary mapping each of `owners` to a summary of its
+    badges: a list of ``{'key', 'name', 'icon', 'count'}`` dictionaries
+    sorted by badge type key, where `icon` is an URL or None.
+
+    Summaries are read from the cache with a single multi-get. Missing ones
+    are computed with a single query per owner content type."""
+    registry = _get_registry()
+    keys = {}
+    for ct_id, ct_owners in _owners_by_ct(owners).iteritems():
+        for owner in ct_owners:
+            keys[_summary_key(ct_id, owner.pk, registry['version'])] = (ct_id,
+                owner)
+    cached = cache.get_many(keys.keys())
+    result = {}
+    missing = defaultdict(dict)
+    for key, (ct_id, owner) in keys.iteritems():
+        if key in cached:
+            result[owner] = cached[key]
         else:
-            # delete badge versions which are to be upgraded
-            old_badges.exclude(type=badge_type).delete()
-            if old_badges.exists():
-                # leave a single badge
-                for outdated in old_badges[1:]:
-                    outdated.delete()
-                return old_badges[0]
-            else:
-                create_badge = True
-        if create_badge:
-            badge = Badge._create(type=badge_type, owner=owner, subject=subject)
-            badge.save()
-            return badge
-        return None
+            missing[ct_id][owner.pk] = owner
+    computed = {}
+    for ct_id, by_pk in missing.iteritems():
+        counts = defaultdict(dict)
+        for owner_pk, type_key, count in Badge.objects.filter(owner_ct=ct_id,
+            owner_oid__in=by_pk.keys()).values_list('owner_oid', 'type'
+            ).annotate(Count('id')).order_by():
+            counts[owner_pk][type_key] = count
+        for owner_pk, owner in by_pk.iteritems():
+            result[owner] = [_type_summary(registry['types'][key], count)
+                for key, count in sorted(counts[owner_pk].iteritems())]
+            computed[_summary_key(ct_id, owner_pk, registry['version'])] = \
+                result[owner]
+    if computed:
+        cache.set_many(computed, BADGES_SUMMARY_TIMEOUT)
+    return result
+
+
+def invalidate_badge_summaries(owners):
+    version = _get_registry()['version']
+    cache.delete_many([_summary_key(ct_id, owner.pk, version)
+        for ct_id, ct_owners in _owners_by_ct(owners).iteritems()
+        for owner in ct_owners])
+
+
+def get_badge_type(type):
+    """Returns a `BadgeType` with its `group` loaded from the registry.
+    `type` can be a key or a `BadgeType` instance."""
+    if isinstance(type, BadgeType):
+        type = type.pk
+    try:
+        return _get_registry()['types'][type]
+    except KeyError:
+        raise BadgeType.DoesNotExist("No badge type `{}`".format(type))
+
+
+def get_badge_group(group):
+    """Returns a `BadgeGroup` from the registry. `group` can be a key or
+    a `BadgeGroup` instance."""
+    if isinstance(group, BadgeGroup):
+        group = group.pk
+    try:
+        return _get_registry()['groups'][group]
+    except KeyError:
+        raise BadgeGroup.DoesNotExist("No badge group `{}`".format(group))
 
 
 def update_type(type, *args, **kwargs):
-    """Send a badge type callback task through Celery."""
-    badge_type = BadgeType.objects.get(pk=type)
-    _do_update(badge_type.callback or badge_type.group.callback, *args, **kwargs)
+    """Run a badge type callback on the configured executor. See
+    `lck.django.badges.executors`."""
+    badge_type = get_badge_type(type)
+    return _do_update(badge_type.callback or badge_type.group.callback, *args,
+        **kwargs)
 
 
 def update_group(group, *args, **kwargs):
-    """Send a badge group callback task through Celery."""
-    _do_update(BadgeGroup.objects.get(pk=group).callback, *args, **kwargs)
+    """Run a badge group callback on the configured executor. See
+    `lck.django.badges.executors`."""
+    return _do_update(get_badge_group(group).callback, *args, **kwargs)
 
 
 def _do_update(callback, *args, **kwargs):
-    module, function = splitext(callback)
-    mod = importlib.import_module(module)
+    return executors.dispatch(callback, *args, **kwargs)
+
+
+def invalidate_registry(sender, instance, **kwargs):
+    global _REGISTRY
+    _REGISTRY = {'version': None}
     try:
-        eval('mod{}.delay(*args, **kwargs)'.format(function))
-    except (NameError, AttributeError):
-        raise ValueError("Cannot find badge callback `{}`".format(callback))
+        cache.incr(_REGISTRY_VERSION_KEY)
+    except ValueError:
+        pass # no registry loaded yet
+post_save.connect(invalidate_registry, sender=BadgeGroup)
+post_delete.connect(invalidate_registry, sender=BadgeGroup)
+post_save.connect(invalidate_registry, sender=BadgeType)
+post_delete.connect(invalidate_registry, sender=BadgeType)
+post_save.connect(invalidate_registry, sender=BadgeIcon)
+post_delete.connect(invalidate_registry, sender=BadgeIcon)
+
+
+def invalidate_badge_summary(sender, instance, **kwargs):
+    cache.delete(_summary_key(instance.owner_ct_id, instance.owner_oid,
+        _get_registry()['version']))
+post_save.connect(invalidate_badge_summary, sender=Badge)
+post_delete.connect(invalidate_badge_summary, sender=Badge)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Badge summaries."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django import template
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
+
+from lck.django.badges.models import get_badge_summaries
+
+register = template.Library()
+
+PREFETCHED_BADGES = '_lckd_prefetched_badges'
+
+
+def _summary_key(owner):
+    return (ContentType.objects.get_for_model(owner).id,
+        smart_unicode(owner.pk))
+
+
+class PrefetchBadgesNode(template.Node):
+    """Loads badge summaries for a list of owners into the context."""
+
+    def __init__(self, objects_expr, owner_attr=None):
+        self.objects_expr = objects_expr
+        self.owner_attr = template.Variable(owner_attr) if owner_attr else None
+
+    @classmethod
+    def handle_token(cls, parser, token):
+        """Class method to parse prefetch_badges and return a Node."""
+        tokens = token.contents.split()
+        if len(tokens) == 3 and tokens[1] == 'for':
+            return cls(parser.compile_filter(tokens[2]))
+        if len(tokens) == 5 and tokens[1] == 'for' and tokens[3] == 'by':
+            return cls(parser.compile_filter(tokens[2]), tokens[4])
+        raise template.TemplateSyntaxError("%r tag must be used as "
+            "{%% %s for [object_list] [by attribute] %%}" % (tokens[0],
+            tokens[0]))
+
+    def render(self, context):
+        try:
+            objects = self.objects_expr.resolve(context)
+        except template.VariableDoesNotExist:
+            return ''
+        if not objects:
+            return ''
+        owners = objects
+        if self.owner_attr:
+            owners = []
+            for obj in objects:
+                try:
+                    owners.append(self.owner_attr.resolve(obj))
+                except template.VariableDoesNotExist:
+                    pass
+        prefetched = dict(context.get(PREFETCHED_BADGES) or {})
+        for owner, summary in get_badge_summaries(
+            owner for owner in owners if owner is not None).iteritems():
+            prefetched[_summary_key(owner)] = summary
+        context[PREFETCHED_BADGES] = prefetched
+        return ''
+
+
+class GetBadgesNode(template.Node):
+    """Injects the badge summary of an owner into the context."""
+
+    def __init__(self, owner_expr, as_varname):
+        self.owner_expr = owner_expr
+        self.as_varname = as_varname
+
+    @classmethod
+    def handle_token(cls, parser, token):
+        """Class method to parse get_badges and return a Node."""
+        tokens = token.contents.split()
+        if len(tokens) != 5 or tokens[1] != 'for' or tokens[3] != 'as':
+            raise template.TemplateSyntaxError("%r tag must be used as "
+                "{%% %s for [owner] as [varname] %%}" % (tokens[0],
+                tokens[0]))
+        return cls(parser.compile_filter(tokens[2]), tokens[4])
+
+    def render(self, context):
+        try:
+            owner = self.owner_expr.resolve(context)
+        except template.VariableDoesNotExist:
+            owner = None
+        summary = []
+        if owner is not None:
+            prefetched = context.get(PREFETCHED_BADGES) or {}
+            key = _summary_key(owner)
+            if key in prefetched:
+                summary = prefetched[key]
+            else:
+                summary = get_badge_summaries([owner])[owner]
+        context[self.as_varname] = summary
+        return ''
+
+
+@register.tag
+def prefetch_badges(parser, token):
+    """
+    Loads badge summaries for all owners in the given list with a single
+    cache multi-get. ``get_badges`` tags used later at the same or a nested
+    template level read them from memory. With ``by``, owners are taken from
+    the given attribute of each object.
+
+    Syntax::
+
+        {% prefetch_badges for [owner_list] %}
+        {% prefetch_badges for [object_list] by [attribute] %}
+
+    Example usage::
+
+        {% prefetch_badges for comment_list by user %}
+        {% for comment in comment_list %}
+            {% get_badges for comment.user as badges %}
+            {% for badge in badges %}
+                <img src="{{ badge.icon }}" alt="{{ badge.name }}"/>
+            {% endfor %}
+        {% endfor %}
+
+    """
+    return PrefetchBadgesNode.handle_token(parser, token)
+
+@register.tag
+def get_badges(parser, token):
+    """
+    Gets the badge summary of an owner and populates the template context
+    with a variable containing it, whose name is defined by the 'as' clause.
+    The summary is a list of dictionaries with ``key``, ``name``, ``icon``
+    (an URL or None) and ``count`` keys.
+
+    Syntax::
+
+        {% get_badges for [owner] as [varname] %}
+
+    """
+    return GetBadgesNode.handle_token(parser, token)
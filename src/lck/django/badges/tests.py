@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Tests for badges."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models.signals import post_delete, post_save
+from django.test import TestCase
+
+from lck.django.badges import batch_callback, executors
+from lck.django.badges.models import Badge, BadgeGroup, BadgeType,\
+    get_badge_summaries
+
+
+@batch_callback
+def even_owners(owners):
+    return [owner for owner in owners if owner.pk % 2 == 0]
+
+
+@batch_callback
+def all_owners(owners):
+    return owners
+
+
+class TestAwarding(TestCase):
+    def setUp(self):
+        group = BadgeGroup.objects.create(key='activity', name="Activity")
+        for key in ('bronze', 'silver'):
+            BadgeType.objects.create(key=key, name=key.title(), group=group)
+        User.objects.bulk_create([User(username='owner{}'.format(i))
+            for i in xrange(5)])
+        self.owners = list(User.objects.filter(username__startswith='owner'))
+
+    def test_award_many(self):
+        first = self.owners[0]
+        Badge.award('bronze', first)
+        Badge.award('silver', self.owners[1])
+        with self.assertNumQueries(3):
+            # lookup, upgrade and insert
+            badges = Badge.award_many('silver', self.owners)
+        self.assertEqual(set(badges), set(self.owners))
+        self.assertEqual(Badge.objects.count(), 5)
+        self.assertEqual(set(Badge.objects.values_list('type', flat=True)),
+            {'silver'})
+        with self.assertNumQueries(1):
+            Badge.award_many('silver', self.owners)
+        self.assertEqual(Badge.award('silver', first).owner_oid, first.pk)
+        self.assertEqual(Badge.objects.count(), 5)
+        # the same as after save()
+        self.assertEqual(set(Badge.objects.values_list('cache_version',
+            flat=True)), {1})
+
+    def test_signals(self):
+        sent = []
+
+        def receiver(sender, instance, **kwargs):
+            sent.append(instance.type_id)
+        post_save.connect(receiver, sender=Badge)
+        post_delete.connect(receiver, sender=Badge)
+        try:
+            first, second = self.owners[:2]
+            # batches never send signals, whatever their size
+            Badge.award_many('bronze', [first])
+            Badge.award_many('silver', [first, second])
+            Badge.revoke_many('silver', [second])
+            self.assertEqual(sent, [])
+            # a single award does, like a regular delete and save
+            Badge.award('bronze', first)
+            self.assertEqual(sent, ['silver', 'bronze'])
+        finally:
+            post_save.disconnect(receiver, sender=Badge)
+            post_delete.disconnect(receiver, sender=Badge)
+
+    def test_recompute(self):
+        bronze = BadgeType.objects.get(key='bronze')
+        bronze.callback = 'lck.django.badges.tests.even_owners'
+        bronze.save()
+        odd = [owner for owner in self.owners if owner.pk % 2]
+        Badge.award_many('bronze', odd)
+        call_command('recompute_badges', types=['bronze'], chunk_size=2,
+            verbosity=0)
+        self.assertEqual(set(Badge.objects.values_list('owner_oid',
+            flat=True)), {owner.pk for owner in even_owners(self.owners)})
+        # repeated runs don't award again, even in groups allowing multiple
+        # badges
+        group = BadgeGroup.objects.get(key='activity')
+        group.multiple_allowed = True
+        group.save()
+        count = Badge.objects.count()
+        call_command('recompute_badges', types=['bronze'], verbosity=0)
+        self.assertEqual(Badge.objects.count(), count)
+
+    def test_recompute_group(self):
+        for key, callback in (('bronze', 'all_owners'),
+            ('silver', 'even_owners')):
+            badge_type = BadgeType.objects.get(key=key)
+            badge_type.callback = 'lck.django.badges.tests.' + callback
+            badge_type.save()
+        even = even_owners(self.owners)
+        Badge.award('bronze', even[0])
+        call_command('recompute_badges', verbosity=0)
+        # a single badge per owner, the one held is kept while it qualifies
+        expected = {owner.pk: 'silver' if owner in even else 'bronze'
+            for owner in self.owners}
+        expected[even[0].pk] = 'bronze'
+        self.assertEqual(Badge.objects.count(), len(self.owners))
+        self.assertEqual(dict(Badge.objects.values_list('owner_oid', 'type')),
+            expected)
+        ids = set(Badge.objects.values_list('id', flat=True))
+        call_command('recompute_badges', verbosity=0)
+        self.assertEqual(set(Badge.objects.values_list('id', flat=True)), ids)
+
+    def test_summaries(self):
+        first, second = self.owners[:2]
+        Badge.award('bronze', first)
+        summaries = get_badge_summaries([first, second])
+        self.assertEqual(summaries[first], [{'key': 'bronze', 'name':
+            "Bronze", 'icon': None, 'count': 1}])
+        self.assertEqual(summaries[second], [])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_badge_summaries([first, second]), summaries)
+        Badge.award_many('silver', [first, second])
+        summaries = get_badge_summaries([first, second])
+        self.assertEqual([badge['key'] for badge in summaries[first]],
+            ['silver'])
+        Badge.revoke_many('silver', [second])
+        self.assertEqual(get_badge_summaries([second])[second], [])
+
+
+class TestExecutors(TestCase):
+    def test_inline(self):
+        path = 'lck.django.badges.do_nothing'
+        calls = executors.get_metrics().get(path, {}).get('calls', 0)
+        executors.InlineExecutor().submit(path, (), {'owner': 1})
+        self.assertEqual(executors.get_metrics()[path]['calls'], calls + 1)
+        self.assertIs(executors.resolve_callback(path),
+            executors.resolve_callback(path))
+        with self.assertRaises(ValueError):
+            executors.resolve_callback('lck.django.badges.no_such_callback')
+
+    def test_dedup_key(self):
+        owner = User(pk=1, username='owner')
+        self.assertEqual(executors._dedup_key('a.b', (owner,), {'x': 1}),
+            executors._dedup_key('a.b', (User(pk=1),), {'x': 1}))
+        self.assertNotEqual(executors._dedup_key('a.b', (owner,), {}),
+            executors._dedup_key('a.b', (User(pk=2),), {}))
+
+    def test_dedup(self):
+        path = 'lck.django.badges.do_nothing'
+        submitted = []
+
+        class Recorder(object):
+            def submit(self, path, args, kwargs, dedup_key=None):
+                submitted.append(dedup_key)
+
+        executor, mode = executors.executor, executors.BADGES_EXECUTOR
+        executors.executor, executors.BADGES_EXECUTOR = Recorder(), 'thread'
+        try:
+            self.assertTrue(executors.dispatch(path, owner=1))
+            self.assertFalse(executors.dispatch(path, owner=1))
+            # the key is released when the callback runs
+            executors.run(path, (), {'owner': 1}, submitted[0])
+            self.assertTrue(executors.dispatch(path, owner=1))
+        finally:
+            executors.executor, executors.BADGES_EXECUTOR = executor, mode
+            cache.delete(submitted[0])
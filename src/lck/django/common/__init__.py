@@ -28,17 +28,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from datetime import date
 from functools import wraps
+from hashlib import md5
 import re
-from zlib import adler32, crc32
 
 from django.conf import settings
 from django.db import transaction
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
 from django.template import loader, RequestContext
 from django.utils import simplejson
+from django.utils.http import parse_etags, quote_etag
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
+from django.views.decorators.http import condition
 from dj.chain import chain as lazy_chain # compatibility with lck.django < 0.8
 from dj.choices import Language
 from lck.cache import memoize
@@ -47,14 +50,111 @@ from lck.cache import memoize
 DOTS_REGEX = re.compile(r'\.\s+')
 INTERNAL_IPS = getattr(settings, 'INTERNAL_IPS', set(('127.0.0.1', '::1',
     'localhost')))
+RENDER_ETAG_SALT = getattr(settings, 'RENDER_ETAG_SALT', '')
+_VERSION_KEY_TYPES = (basestring, int, long, float, date)
+
+
+def version_etag(request, *keys):
+    """version_etag(request, *keys) -> unicode
+
+    Returns an ETag which changes only when one of `keys` does, so it can be
+    computed without rendering anything. Keys are strings, numbers, dates or
+    ``TimeTrackable`` objects, for which the model, primary key,
+    ``cache_version`` and ``modified`` are used. Other values (e.g. lists or
+    QuerySets) raise TypeError, pass a version number of their contents
+    instead. The ETag also varies with the user and language of the
+    `request` and with ``RENDER_ETAG_SALT`` (e.g. a release number, so that
+    template changes don't leave clients with stale pages)."""
+
+    user = getattr(request, 'user', None)
+    parts = [RENDER_ETAG_SALT, getattr(user, 'pk', None),
+        getattr(request, 'LANGUAGE_CODE', '')]
+    for key in keys:
+        if hasattr(key, 'cache_version'):
+            key = "{}.{}:{}:{}:{}".format(key._meta.app_label,
+                key._meta.object_name, key.pk, key.cache_version,
+                key.modified.isoformat() if key.modified else '')
+        elif key is not None and not isinstance(key, _VERSION_KEY_TYPES):
+            raise TypeError("Unsupported version key: {!r}".format(key))
+        parts.append(key)
+    return md5("\n".join(unicode(part) for part in parts).encode('utf8')
+        ).hexdigest()
+
+
+def _context_version(context):
+    """Returns `version_etag()` keys for all values in `context` or None if
+    some of them can't be used as keys. The request is skipped, the ETag
+    varies with its user and language anyway."""
+
+    version = []
+    for name in sorted(context):
+        value = context[name]
+        if isinstance(value, HttpRequest):
+            continue
+        if not (value is None or hasattr(value, 'cache_version') or
+            isinstance(value, _VERSION_KEY_TYPES)):
+            return None
+        version.extend((name, value))
+    return version
+
+
+def _etag_matches(request, etag):
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return etag in etags or '*' in etags
+
+
+def conditional_render(etag_func=None, last_modified_func=None):
+    """conditional_render([etag_func, last_modified_func]) -> decorator
+
+    Like Django's ``condition`` decorator, the view is not called at all if
+    the client's copy is up to date according to `etag_func` or
+    `last_modified_func`. Both are called with the arguments of the view,
+    e.g. ``lambda request, pk: version_etag(request, Item.objects.get(pk=pk))``.
+    `render()` calls within the view don't compute their own ETags."""
+
+    def decorator(func):
+        @wraps(func)
+        def inner(request, *args, **kwargs):
+            request.lck_conditional = True
+            return func(request, *args, **kwargs)
+        return condition(etag_func, last_modified_func)(inner)
+    return decorator
 
 
 def render(request, template_name, context, debug=False, mimetype=None,
-    compute_etag=True):
-    """render(request, template_name, context, [debug, mimetype]) -> HttpResponse
+    compute_etag=True, version=None):
+    """render(request, template_name, context, [debug, mimetype, compute_etag,
+    version]) -> HttpResponse
 
     Renders the `context` within for a `request` using a template named
-    `template_name` returning the required `mimetype`."""
+    `template_name` returning the required `mimetype`.
+
+    If `version` is given, the ETag is computed before rendering by
+    `version_etag()` from the template name and `version`, a sequence of
+    keys. If `version` is True, all values in the `context` are used with
+    their names. If some of them can't be versioned (e.g. QuerySets or lists
+    of objects), the body ETag is used instead. Otherwise if `compute_etag`
+    is True, the ETag is a digest of the rendered body.
+
+    For GET and HEAD requests a matching ``If-None-Match`` header results in
+    a 304 response, for a version ETag without touching the template
+    engine."""
+
+    http_response_kwargs = {'mimetype': mimetype}
+    if getattr(request, 'lck_conditional', False):
+        # handled by `conditional_render()`
+        compute_etag = False
+        version = None
+    conditional = request.method in ('GET', 'HEAD')
+    etag = None
+    if version is True:
+        version = _context_version(context)
+    if version is not None:
+        etag = version_etag(request, template_name, *version)
+        if conditional and _etag_matches(request, etag):
+            http_response = HttpResponse(status=304, **http_response_kwargs)
+            http_response['ETag'] = quote_etag(etag)
+            return http_response
 
     if hasattr(settings, 'AUTH_PROFILE_MODULE'):
         if 'user_profile' in context:
@@ -69,17 +169,16 @@ def render(request, template_name, context, debug=False, mimetype=None,
         context['other_user_profile'] = context['other_user'].get_profile() \
                                         if 'other_user' in context else None
 
-    http_response_kwargs = {'mimetype': mimetype}
     response = loader.render_to_string(template_name, RequestContext(request,
         context)).encode('utf8')
-    if compute_etag:
-        etag = b"-".join((hex(crc32(response)), hex(adler32(response))))
-        if etag == request.environ.get('HTTP_IF_NONE_MATCH', 'X'):
+    if etag is None and compute_etag:
+        etag = md5(response).hexdigest()
+        if conditional and _etag_matches(request, etag):
             response = ""
             http_response_kwargs['status'] = 304
     http_response = HttpResponse(response, **http_response_kwargs)
-    if compute_etag:
-        http_response['ETag'] = etag
+    if etag is not None:
+        http_response['ETag'] = quote_etag(etag)
     return http_response
 
 
@@ -5,15 +5,26 @@ Albeit useful, this module is still somewhat a mess in a really early state of d
 import datetime
 import os
 import re
-from subprocess import check_call, CalledProcessError
+from subprocess import PIPE, Popen
 from tempfile import NamedTemporaryFile
+import threading
+import time
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+try:
+    from PIL import WebPImagePlugin
+except ImportError:
+    PIL_WEBP = False
+else:
+    # newer Pillow always ships the plugin but might lack the decoder
+    PIL_WEBP = getattr(WebPImagePlugin, 'SUPPORTED', True)
+
 from django import forms
+from django.conf import settings
 from django.forms.extras.widgets import RE_DATE, SelectDateWidget
 from django.forms.widgets import Select, RadioFieldRenderer, HiddenInput
 from django.forms.util import flatatt
@@ -24,6 +35,16 @@ from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 
+WEBP_MAX_SIZE = getattr(settings, 'WEBP_MAX_SIZE', 10 * 1024 * 1024)
+WEBP_DECODE_TIMEOUT = getattr(settings, 'WEBP_DECODE_TIMEOUT', 10)
+WEBP_DECODE_PROCESSES = getattr(settings, 'WEBP_DECODE_PROCESSES', 2)
+
+_dwebp_slots = threading.Condition()
+_dwebp_running = [0]
+_dwebp_version = []
+_devnull = []
+
+
 class JQueryUIRadioInput(StrAndUnicode):
     """
     An object used by RadioFieldRenderer that represents a single
@@ -167,72 +188,187 @@ class PolishSelectDateWidget(SelectDateWidget):
         return mark_safe(u'\n'.join(output))
 
 
+def _kill(process):
+    try:
+        process.kill()
+    except OSError: # already finished
+        pass
+
+
+def _get_devnull():
+    if not _devnull:
+        _devnull.append(open(os.devnull, 'wb'))
+    return _devnull[0]
+
+
+def _run_dwebp(args, deadline, input=None):
+    """Runs dwebp with `args` once one of ``WEBP_DECODE_PROCESSES`` slots is
+    free and kills it at `deadline`. If `input` is given, it's written to the
+    standard input and the standard output is returned. Returns
+    ``(return code, output)`` or None if no slot was free in time or dwebp is
+    not installed."""
+    # Python 2 semaphores can't time out, waiting on a condition can
+    with _dwebp_slots:
+        while _dwebp_running[0] >= WEBP_DECODE_PROCESSES:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            _dwebp_slots.wait(remaining)
+        _dwebp_running[0] += 1
+    try:
+        piped = input is not None
+        try:
+            process = Popen(['dwebp'] + args, stdin=PIPE if piped else None,
+                stdout=PIPE if piped else _get_devnull(),
+                stderr=_get_devnull())
+        except OSError: # dwebp not installed
+            return None
+        timer = threading.Timer(max(deadline - time.time(), 0),
+            _kill, [process])
+        timer.start()
+        try:
+            output = process.communicate(input)[0]
+        finally:
+            timer.cancel()
+    finally:
+        with _dwebp_slots:
+            _dwebp_running[0] -= 1
+            _dwebp_slots.notify_all()
+    return process.returncode, output
+
+
+def _dwebp_pipes():
+    """Returns True if the installed dwebp can read from the standard input
+    and write to the standard output, which libwebp supports since 0.6."""
+    if not _dwebp_version:
+        try:
+            output = Popen(['dwebp', '-version'], stdout=PIPE,
+                stderr=_get_devnull()).communicate()[0]
+        except OSError: # dwebp not installed
+            output = b''
+        m = re.match(br'(\d+)\.(\d+)', output.strip())
+        _dwebp_version.append(tuple(int(part) for part in m.groups())
+            if m else (0, 0))
+    return _dwebp_version[0] >= (0, 6)
+
+
+def dwebp(source, target, timeout=None):
+    """Converts a WebP `source` file to a PNG `target` file with
+    `dwebp <http://code.google.com/intl/pl/speed/webp/docs/dwebp.html>`_.
+    At most ``WEBP_DECODE_PROCESSES`` conversions run at the same time.
+    Returns False if the conversion failed or didn't finish within `timeout`
+    seconds (by default ``WEBP_DECODE_TIMEOUT``), including waiting for
+    a free slot."""
+    if timeout is None:
+        timeout = WEBP_DECODE_TIMEOUT
+    result = _run_dwebp([source, '-o', target], time.time() + timeout)
+    if result and result[0] == 0:
+        return True
+    if os.path.exists(target):
+        os.unlink(target)
+    return False
+
+
+def dwebp_content(content, timeout=None):
+    """Like `dwebp()` but converts WebP `content` to PNG data in memory.
+    The data is piped through dwebp, older versions which can't do that use
+    temporary files instead. Returns None if the conversion failed."""
+    if timeout is None:
+        timeout = WEBP_DECODE_TIMEOUT
+    if _dwebp_pipes():
+        result = _run_dwebp(['-o', '-', '--', '-'], time.time() + timeout,
+            input=content)
+        if result and result[0] == 0 and result[1]:
+            return result[1]
+        return None
+    with NamedTemporaryFile(suffix='.webp') as file:
+        abs_path = os.path.splitext(file.name)[0] + '.png'
+        file.write(content)
+        file.flush()
+        if not dwebp(file.name, abs_path, timeout):
+            return None
+    try:
+        with open(abs_path, 'rb') as image:
+            return image.read()
+    finally:
+        os.unlink(abs_path)
+
+
+def _upload_header(data, length=12):
+    if hasattr(data, 'temporary_file_path'):
+        with open(data.temporary_file_path(), 'rb') as f:
+            return f.read(length)
+    if hasattr(data, 'read'):
+        data.seek(0)
+        try:
+            return data.read(length)
+        finally:
+            data.seek(0)
+    return data['content'][:length]
+
+
+def _is_webp(data):
+    header = _upload_header(data)
+    return header[:4] == b'RIFF' and header[8:12] == b'WEBP'
+
+
+def _upload_size(data):
+    if hasattr(data, 'size'):
+        return data.size
+    return len(data['content'])
+
+
 class WebpImageField(forms.ImageField):
-    """Extends the default django ImageField with WEBP support through
-       `dwebp <http://code.google.com/intl/pl/speed/webp/docs/dwebp.html>`_.
+    """Extends the default django ImageField with WEBP support.
 
-       Converts image data to PNG on the fly so that PIL (as of 1.1.7) is able
-       to use it.
+       If Pillow was built with WebP support, WebP images are validated
+       in-process like any other image. Otherwise image data is converted to
+       PNG on the fly with ``dwebp()`` so that PIL is able to use it.
+
+       WebP uploads larger than ``WEBP_MAX_SIZE`` bytes are rejected before
+       decoding. Other formats are not limited.
     """
-    def __init__(self, *args, **kwargs):
-        print args
-        print kwargs
-        super(WebpImageField, self).__init__(*args, **kwargs)
+    default_error_messages = {
+        'too_large': _("The image is too large. Upload an image smaller "
+            "than %(max_size)s bytes."),
+    }
 
     def to_python(self, data):
+        if data and WEBP_MAX_SIZE and _is_webp(data) and \
+            _upload_size(data) > WEBP_MAX_SIZE:
+            raise forms.ValidationError(self.error_messages['too_large'] % {
+                'max_size': WEBP_MAX_SIZE})
         try:
-            # try PIL-supported images first 
+            # try PIL-supported images first
             return super(WebpImageField, self).to_python(data)
-        except forms.ValidationError, e:
-            pass
+        except forms.ValidationError:
+            if PIL_WEBP:
+                raise
         if hasattr(data, 'temporary_file_path'):
             # file already on disk
             file = data.temporary_file_path()
             abs_path = os.path.splitext(file)[0] + '.png'
-            devnull = os.open(os.devnull, os.O_RDWR)
-            try:
-                check_call(['dwebp', file, '-o', abs_path],
-                    stdout=devnull, stderr=devnull)
-                data.temporary_file_path = abs_path
-                data.name = os.path.basename(abs_path)
-                data.size = getsize(abs_path)
-                os.unlink(file)
-            except CalledProcessError:
-                raise ValidationError(self.error_messages['invalid_image'])
-            finally:
-                os.close(devnull)
+            if not dwebp(file, abs_path):
+                raise forms.ValidationError(
+                    self.error_messages['invalid_image'])
+            data.temporary_file_path = lambda: abs_path
+            data.name = os.path.basename(abs_path)
+            data.size = os.path.getsize(abs_path)
+            os.unlink(file)
+            return data
+        if hasattr(data, 'read'):
+            # InMemoryUploadFile
+            data.seek(0)
+            content = dwebp_content(data.read())
+        else:
+            content = dwebp_content(data['content'])
+        if content is None:
+            raise forms.ValidationError(self.error_messages['invalid_image'])
+        # Monkey-patch the UploadFile object.
+        if hasattr(data, 'read'):
+            data.name = os.path.splitext(data.name)[0] + '.png'
+            data.size = len(content)
+            data.file = StringIO(content)
         else:
-            with NamedTemporaryFile() as file:
-                abs_path = os.path.splitext(file.name)[0] + '.png'
-
-                if hasattr(data, 'read'):
-                    # InMemoryUploadFile
-                    data.seek(0)
-                    file.write(data.read())
-                    output = data.file
-                else:
-                    file.write(data['content'])
-                    output = data['content']
-
-                file.flush()
-
-                devnull = os.open(os.devnull, os.O_RDWR)
-                try:
-                    check_call(['dwebp', file.name, '-o', abs_path],
-                        stdout=devnull, stderr=devnull)
-                    # Monkey-patch the UploadFile object.
-                    data.name = os.path.basename(abs_path)
-                    data.size = os.path.getsize(abs_path)
-                    with open(abs_path, 'rb') as image:
-                        # InMemoryUploadFile
-                        if hasattr(data, 'read'):
-                            data.file = StringIO(image.read())
-                        else:
-                            data['content'] = StringIO(image.read())
-                except CalledProcessError:
-                    raise ValidationError(self.error_messages['invalid_image'])
-                finally:
-                    os.close(devnull)
-
-        # Return the monkey-patched UploadFile object.
+            data['content'] = content
         return data
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import multiprocessing
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models as db
+from django.db.models import get_model
+
+from lck.django.common.thumbnails import get_thumbnail_storage, \
+    prepare_thumbnails, Original
+
+
+def get_image_field(label, field_name):
+    return get_model(*label.split('.'))._meta.get_field(field_name)
+
+
+def pregenerate(task):
+    """Generates thumbnails of a single image. Returns the task and an error
+    message or None."""
+    label, field_name, name, sizes = task
+    original = Original(get_image_field(label, field_name).storage, name,
+        get_thumbnail_storage())
+    try:
+        # all sizes of an image are generated in a single pass
+        prepare_thumbnails(original, sizes)
+    except (IOError, OSError) as e:
+        return task, unicode(e)
+    return task, None
+
+
+class Command(BaseCommand):
+    args = "app.Model [app.Model ...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='',
+            help='Comma-separated thumbnail sizes, e.g. "s48,m300".'),
+        make_option('--field', dest='field', default=None,
+            help='Name of the image field. Default: all image fields of the '
+            'model.'),
+        make_option('--processes', dest='processes', type='int',
+            default=multiprocessing.cpu_count(), help='How many processes '
+            'generate thumbnails. Default: the number of CPUs.'),
+    )
+    help = ("Generates missing thumbnails of images stored in the given "
+            "models.")
+
+    def handle(self, *labels, **options):
+        sizes = [size.strip() for size in options['sizes'].split(',')
+            if size.strip()]
+        if not labels or not sizes:
+            raise CommandError("Give at least one model and --sizes.")
+        tasks = []
+        for label in labels:
+            for field, name in self.iter_images(label, options['field']):
+                tasks.append((label, field.name, name, sizes))
+        started = time.time()
+        pool = multiprocessing.Pool(options['processes'])
+        errors = 0
+        try:
+            for task, error in pool.imap_unordered(pregenerate, tasks, 16):
+                if error:
+                    errors += 1
+                    print("{}: {}".format(task[2], error))
+        finally:
+            pool.terminate()
+        elapsed = time.time() - started
+        print("{} images checked in {:.1f} s ({:.1f}/s), {} failed.".format(
+            len(tasks), elapsed, len(tasks) / elapsed if elapsed else 0,
+            errors))
+
+    def iter_images(self, label, field_name=None):
+        try:
+            app_label, model_name = label.split('.')
+        except ValueError:
+            model = None
+        else:
+            model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError("Unknown model: {!r}. Use the `app.Model` "
+                "format.".format(label))
+        fields = [f for f in model._meta.fields
+            if isinstance(f, db.ImageField) and (field_name is None or
+            f.name == field_name)]
+        if not fields:
+            raise CommandError("{} has no image field {!r}.".format(label,
+                field_name))
+        for field in fields:
+            names = model._default_manager.exclude(**{field.name: ''}
+                ).values_list(field.name, flat=True)
+            for name in names.iterator():
+                if name:
+                    yield field, name
@@ -58,6 +58,7 @@ except ImportError:
     now = datetime.now
 
 from lck.django.common import model_is_user, monkeys, nested_commit_on_success
+from lck.django.common.thumbnails import warm_thumbnails
 
 
 EDITOR_TRACKABLE_MODEL = getattr(settings, 'EDITOR_TRACKABLE_MODEL', User)
@@ -376,7 +377,15 @@ class ImageModel(Titled, Slugged, TimeTrackable):
 
         class Icon(ImageModel):
             image = ImageModel.image_field(upload_to='icons', etc.)
+            thumbnail_sizes = ('s48', 'm300')
+
+    Thumbnails in ``thumbnail_sizes`` are generated in a single pass in
+    a background thread when an object is created or its image changes. When
+    replacing the file under the same name, call `warm_thumbnails()`
+    yourself. See the ``thumbnail`` filter for possible sizes.
     """
+    thumbnail_sizes = ()
+
     height = db.PositiveIntegerField(verbose_name=_("height"), default=0,
             editable=False)
     width = db.PositiveIntegerField(verbose_name=_("width"), default=0,
@@ -390,6 +399,21 @@ class ImageModel(Titled, Slugged, TimeTrackable):
         format = self.title, self.width, self.height, self.image.size/1024
         return "%s (%dx%d, %d kB)" % format
 
+    def __init__(self, *args, **kwargs):
+        super(ImageModel, self).__init__(*args, **kwargs)
+        # `dirty_fields` keeps the field file which `FieldFile.save()`
+        # renames in place, so the name is remembered separately. Deferred
+        # images aren't loaded for that.
+        image = self.__dict__.get('image')
+        self._saved_image_name = getattr(image, 'name', image)
+
+    def save(self, *args, **kwargs):
+        changed = self.pk is None or self.image.name != self._saved_image_name
+        super(ImageModel, self).save(*args, **kwargs)
+        self._saved_image_name = self.image.name
+        if changed and self.thumbnail_sizes and self.image:
+            warm_thumbnails(self.image, self.thumbnail_sizes)
+
     class Meta:
         abstract = True
 
@@ -28,22 +28,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import os
-
 from django import template
-from PIL import Image
-
 
-register = template.Library()
+from lck.django.common.thumbnails import get_thumbnail_url
 
 
-def _is_proper_image(image):
-    if image is not None:
-        for attr in 'width', 'height', 'file', 'url':
-            if not hasattr(image, attr):
-                return False
-        return True
-    return False
+register = template.Library()
 
 
 @register.filter
@@ -81,75 +71,7 @@ def thumbnail(image, size):
 
     The thumbnails are kept next to the original images with a `_{size}` suffix
     added to the name. If a thumbnail exists and is newer than the original
-    image, it is reused on subsequent calls."""
-
-    if not _is_proper_image(image):
-        if hasattr(image, 'image') and _is_proper_image(image.image):
-            image = image.image
-        else:
-            return None
-
-    shift = None
-    if size.startswith("h"):
-        height = int(size[1:])
-        width = height * image.width / image.height
-    elif size.startswith("w"):
-        width = int(size[1:])
-        height = width * image.height / image.width
-    elif size.startswith("m"):
-        max = int(size[1:])
-        if image.width > image.height:
-            width = max
-            height = width * image.height / image.width
-        else:
-            height = max
-            width = height * image.width / image.height
-    elif size.startswith("s"):
-        width = height = int(size[1:])
-        if image.width > image.height:
-            shift = int((image.width - image.height) / 2)
-        else:
-            shift = 0
-    else:
-        width, height = size.split("x")
-    width = int(round(width))
-    height = int(round(height))
-
-    file = image.file.name
-    try:
-        basename, format = file.rsplit('.', 1)
-    except ValueError: # if there is no extension
-        basename = file
-        format = 'jpg'
-    thumb_filename = basename + '_' + size + '.' + format
-
-    try:
-        baseurl, format = image.url.rsplit('.', 1)
-    except ValueError: # if there is no extension
-        baseurl = image.url
-        format = 'jpg'
-    thumb_url = baseurl + '_' + size + '.' + format
-
-    if os.path.exists(thumb_filename):
-        if os.path.getmtime(thumb_filename) < os.path.getmtime(file):
-            create_new = True
-            os.unlink(thumb_filename)
-        else:
-            create_new = False
-    else:
-        create_new = True
-
-    if create_new:
-        pil_image = Image.open(file)
-        pil_format = pil_image.format or 'JPEG'
-        if pil_format not in Image.SAVE:
-            pil_format = 'JPEG'
-        if shift is not None:
-            shorter = min(image.width, image.height)
-            pil_image = pil_image.crop((shift, 0, shorter+shift, shorter))
-        pil_image.thumbnail((width, height), Image.ANTIALIAS)
-        if pil_format == 'JPEG' and pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
-        pil_image.save(thumb_filename, pil_format)
-
-    return thumb_url
+    image, it is reused on subsequent calls. Known thumbnails are indexed in
+    the cache, see `lck.django.common.thumbnails` for details."""
+
+    return get_thumbnail_url(image, size)
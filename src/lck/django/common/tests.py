@@ -28,9 +28,43 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from datetime import datetime, timedelta
+from distutils.spawn import find_executable
+from hashlib import md5
+from io import BytesIO
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import models as db
+from django.db.models.fields.files import ImageFieldFile
+from django.forms import ValidationError
+from django.template import TemplateDoesNotExist
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils.http import quote_etag
 from django.utils.unittest import skipUnless
+from PIL import Image
+
+from lck.django import common
+from lck.django.common import conditional_render, render, version_etag
+from lck.django.common import forms as common_forms
+from lck.django.common import thumbnails as thumbnails_module
+from lck.django.common.forms import dwebp, dwebp_content, PIL_WEBP, \
+    WebpImageField
+from lck.django.common.templatetags.thumbnail import thumbnail
+from lck.django.common.thumbnails import ensure_thumbnail, \
+    forget_thumbnails, generate_thumbnail, Original, prepare_thumbnails, \
+    remove_stale_thumbnails, thumbnails, warm_thumbnails
 
 
 class TestHelpers(TestCase):
@@ -46,6 +80,94 @@ class TestHelpers(TestCase):
         self.assertEqual(cut("123456789", length=-1), "12345678 (...)")
 
 
+def make_request(method='get', **headers):
+    request = getattr(RequestFactory(), method)('/', **headers)
+    request.user = AnonymousUser()
+    return request
+
+
+class TestRender(TestCase):
+    def test_version_etag(self):
+        request = make_request()
+        etag = version_etag(request, 'item', 1)
+        self.assertEqual(etag, version_etag(request, 'item', 1))
+        self.assertNotEqual(etag, version_etag(request, 'item', 2))
+        with self.assertRaises(TypeError):
+            version_etag(request, 'items', [1, 2])
+        request.META['HTTP_IF_NONE_MATCH'] = quote_etag(version_etag(request,
+            'missing.html', 1))
+        # the template is never loaded
+        response = render(request, 'missing.html', {}, version=[1])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], request.META['HTTP_IF_NONE_MATCH'])
+        # only safe methods are answered with 304
+        request.method = 'POST'
+        with self.assertRaises(TemplateDoesNotExist):
+            render(request, 'missing.html', {}, version=[1])
+
+    @skipUnless("lck.dummy.defaults" in settings.INSTALLED_APPS,
+                "Requires lck.dummy.defaults to be installed.")
+    def test_version_from_context(self):
+        from lck.dummy.defaults.models import TimeConscious
+        first = TimeConscious.objects.create(name='first')
+        second = TimeConscious.objects.create(name='second')
+        request = make_request()
+        response = render(request, 'defaults/render.html', {'b': second,
+            'a': first, 'title': 'Hello', 'request': request}, version=True)
+        self.assertEqual(response['ETag'], quote_etag(version_etag(request,
+            'defaults/render.html', 'a', first, 'b', second, 'title',
+            'Hello')))
+        # values which can't be versioned fall back to the body ETag
+        response = render(request, 'defaults/render.html', {'a': first,
+            'title': 'Hello', 'items': [first, second]}, version=True)
+        self.assertEqual(response['ETag'],
+            quote_etag(md5(response.content).hexdigest()))
+
+    def test_etag_salt(self):
+        request = make_request()
+        etag = version_etag(request, 'item', 1)
+        salt = common.RENDER_ETAG_SALT
+        common.RENDER_ETAG_SALT = 'next-release'
+        try:
+            self.assertNotEqual(version_etag(request, 'item', 1), etag)
+        finally:
+            common.RENDER_ETAG_SALT = salt
+
+    def test_body_etag(self):
+        response = render(make_request(), 'defaults/render.html',
+            {'title': 'Hello'})
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(etag, quote_etag(md5(response.content).hexdigest()))
+        for header in ('"other", ' + etag, etag + ',"other"', '*'):
+            response = render(make_request(HTTP_IF_NONE_MATCH=header),
+                'defaults/render.html', {'title': 'Hello'})
+            self.assertEqual(response.status_code, 304, header)
+            self.assertEqual(response.content, b'')
+        response = render(make_request(HTTP_IF_NONE_MATCH='"other"'),
+            'defaults/render.html', {'title': 'Hello'})
+        self.assertEqual(response.status_code, 200)
+        response = render(make_request('post', HTTP_IF_NONE_MATCH=etag),
+            'defaults/render.html', {'title': 'Hello'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_render(self):
+        calls = []
+
+        @conditional_render(etag_func=lambda request: 'fixed')
+        def view(request):
+            calls.append(request)
+            return render(request, 'defaults/render.html', {'title': 'Hello'})
+
+        response = view(make_request())
+        self.assertEqual(response.status_code, 200)
+        # the ETag of `conditional_render()` is used, not one of the body
+        self.assertEqual(response['ETag'], quote_etag('fixed'))
+        response = view(make_request(HTTP_IF_NONE_MATCH=quote_etag('fixed')))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(calls), 1)
+
+
 @skipUnless("lck.dummy.defaults" in settings.INSTALLED_APPS,
             "Requires lck.dummy.defaults to be installed.")
 class TestModels(TestCase):
@@ -140,3 +262,358 @@ class TestModels(TestCase):
                 field1=0,
                 field4=0,
             )
+
+
+class ImageFile(object):
+    """The minimal image interface supported by the thumbnail filter."""
+
+    def __init__(self, path, url):
+        self.file = open(path, 'rb')
+        self.url = url
+        self.width, self.height = Image.open(path).size
+
+
+class FakeRemoteStorage(Storage):
+    """Keeps files in memory and counts calls, each of which would be
+    a round trip to a remote storage."""
+
+    def __init__(self):
+        self.files = {}
+        self.modified = {}
+        self.calls = 0
+
+    def _open(self, name, mode='rb'):
+        self.calls += 1
+        return ContentFile(self.files[name])
+
+    def _save(self, name, content):
+        self.calls += 1
+        self.files[name] = content.read()
+        self.modified[name] = datetime.now()
+        return name
+
+    def delete(self, name):
+        self.calls += 1
+        self.files.pop(name, None)
+
+    def exists(self, name):
+        self.calls += 1
+        return name in self.files
+
+    def modified_time(self, name):
+        self.calls += 1
+        return self.modified[name]
+
+    def size(self, name):
+        self.calls += 1
+        return len(self.files[name])
+
+    def listdir(self, path):
+        self.calls += 1
+        prefix = path + '/' if path else ''
+        names = [name[len(prefix):] for name in self.files
+            if name.startswith(prefix)]
+        return [], [name for name in names if '/' not in name]
+
+    def url(self, name):
+        return 'http://remote.example.com/' + name
+
+
+def make_remote_image(storage, name, size=(400, 300)):
+    content = BytesIO()
+    Image.new('RGB', size, 'red').save(content, 'JPEG')
+    storage.save(name, ContentFile(content.getvalue()))
+    return ImageFieldFile(None, db.ImageField(storage=storage), name)
+
+
+class TestThumbnails(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'image.jpg')
+        Image.new('RGB', (400, 300), 'red').save(path)
+        self.image = ImageFile(path, '/media/image.jpg')
+
+    def tearDown(self):
+        self.image.file.close()
+        shutil.rmtree(self.dir)
+
+    def test_thumbnail(self):
+        url = thumbnail(self.image, 's48')
+        self.assertEqual(url, '/media/image_s48.jpg')
+        path = os.path.join(self.dir, 'image_s48.jpg')
+        self.assertEqual(Image.open(path).size, (48, 48))
+        self.assertEqual(thumbnail(self.image, 'w100'), '/media/image_w100.jpg')
+        self.assertEqual(Image.open(os.path.join(self.dir, 'image_w100.jpg')
+            ).size, (100, 75))
+        os.unlink(path)
+        # known thumbnails don't touch the filesystem
+        self.assertEqual(thumbnail(self.image, 's48'), url)
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(thumbnail(None, 's48'))
+
+    def test_thumbnails(self):
+        urls = thumbnails(self.image, ['s48', 'm300', 'h30'])
+        self.assertEqual(urls, {'s48': '/media/image_s48.jpg',
+            'm300': '/media/image_m300.jpg', 'h30': '/media/image_h30.jpg'})
+        for size, expected in ('s48', (48, 48)), ('m300', (300, 225)), \
+            ('h30', (40, 30)):
+            self.assertEqual(Image.open(os.path.join(self.dir,
+                'image_{}.jpg'.format(size))).size, expected)
+
+    def test_remote_storage(self):
+        storage = FakeRemoteStorage()
+        image = make_remote_image(storage, 'images/{}.jpg'.format(
+            os.path.basename(self.dir)))
+        storage.calls = 0
+        url = thumbnail(image, 's48')
+        self.assertTrue(url.startswith('http://remote.example.com/images/'))
+        self.assertTrue(url.endswith('_s48.jpg'))
+        self.assertEqual(Image.open(BytesIO(storage.files[url[26:]])).size,
+            (48, 48))
+        self.assertTrue(storage.calls)
+        storage.calls = 0
+        for i in xrange(10):
+            self.assertEqual(thumbnail(image, 's48'), url)
+        self.assertEqual(storage.calls, 0)
+
+    def test_background_index_miss(self):
+        storage = FakeRemoteStorage()
+        image = make_remote_image(storage, 'images/{}.jpg'.format(
+            os.path.basename(self.dir)))
+        url = thumbnail(image, 's48')
+        original = Original.from_image(image)
+        cache.delete(original.index_key(original.thumbnail_name('s48')))
+        # an existing thumbnail isn't replaced by the placeholder
+        self.assertEqual(thumbnails(image, ['s48'], background=True),
+            {'s48': url})
+        storage.calls = 0
+        self.assertEqual(thumbnails(image, ['s48'], background=True),
+            {'s48': url})
+        self.assertEqual(storage.calls, 0)
+
+    def test_wait_timeout(self):
+        storage = FakeRemoteStorage()
+        image = make_remote_image(storage, 'images/{}.jpg'.format(
+            os.path.basename(self.dir)))
+        original = Original.from_image(image)
+        thumb_name = original.thumbnail_name('s48')
+        lock_timeout = thumbnails_module.THUMBNAIL_LOCK_TIMEOUT
+        # a lock which is never released, e.g. by a dead process
+        cache.set(original.lock_key(thumb_name), True)
+        thumbnails_module.THUMBNAIL_LOCK_TIMEOUT = 0.2
+        try:
+            ensure_thumbnail(original, thumb_name, 's48')
+        finally:
+            thumbnails_module.THUMBNAIL_LOCK_TIMEOUT = lock_timeout
+            cache.delete(original.lock_key(thumb_name))
+        self.assertIn(thumb_name, storage.files)
+
+    def test_warm_thumbnails(self):
+        storage = FakeRemoteStorage()
+        name = 'images/{}.jpg'.format(os.path.basename(self.dir))
+        image = make_remote_image(storage, name)
+        url = thumbnail(image, 's48')
+        thumb_name = url[26:]
+        # the original is replaced under the same name
+        content = BytesIO()
+        Image.new('RGB', (400, 300), 'blue').save(content, 'JPEG')
+        storage.files[name] = content.getvalue()
+        storage.modified[name] = storage.modified[thumb_name] + \
+            timedelta(seconds=1)
+        jobs = []
+        submit = thumbnails_module._submit
+        thumbnails_module._submit = lambda function, args: jobs.append(
+            (function, args))
+        try:
+            storage.calls = 0
+            warm_thumbnails(image, ['s48', 'w100'])
+            self.assertEqual(storage.calls, 0)
+            self.assertEqual(len(jobs), 1)
+        finally:
+            thumbnails_module._submit = submit
+        for function, args in jobs:
+            function(*args)
+        self.assertEqual(thumbnail(image, 's48'), url)
+        red, green, blue = Image.open(BytesIO(storage.files[thumb_name])
+            ).convert('RGB').getpixel((24, 24))
+        self.assertTrue(blue > 200 and red < 50)
+        self.assertIn(thumb_name.replace('_s48', '_w100'), storage.files)
+
+    def test_background_failure(self):
+        storage = FakeRemoteStorage()
+        image = make_remote_image(storage, 'images/{}.jpg'.format(
+            os.path.basename(self.dir)))
+        original = Original.from_image(image)
+        cache.set(original.pending_key('s48'), True)
+        del storage.files[image.name]
+        # logged instead of lost in the pool, the size can be retried
+        thumbnails_module._prepare_pending(original, ['s48'])
+        self.assertIsNone(cache.get(original.pending_key('s48')))
+
+    def test_content_addressed(self):
+        storage = FakeRemoteStorage()
+        name = 'images/{}.jpg'.format(os.path.basename(self.dir))
+        image = make_remote_image(storage, name)
+        thumbnails_module.THUMBNAIL_CONTENT_ADDRESSED = True
+        try:
+            url = thumbnail(image, 's48')
+            self.assertRegexpMatches(url, r'_s48_[0-9a-f]{12}\.jpg$')
+            storage.calls = 0
+            self.assertEqual(thumbnail(image, 's48'), url)
+            self.assertEqual(storage.calls, 0)
+            # a changed original gets a new name once it's forgotten
+            content = BytesIO()
+            Image.new('RGB', (400, 300), 'blue').save(content, 'JPEG')
+            storage.files[name] = content.getvalue()
+            self.assertEqual(thumbnail(image, 's48'), url)
+            forget_thumbnails(image, ['s48'])
+            new_url = thumbnail(image, 's48')
+            self.assertNotEqual(new_url, url)
+            original = Original(storage, name)
+            thumb_name = prepare_thumbnails(original, ['s48'])['s48']
+            self.assertEqual(storage.url(thumb_name), new_url)
+            # normally done in the background
+            remove_stale_thumbnails(original, [(thumb_name, 's48')])
+            self.assertEqual([n for n in storage.files if '_s48_' in n],
+                [thumb_name])
+        finally:
+            thumbnails_module.THUMBNAIL_CONTENT_ADDRESSED = False
+
+
+def make_webp(size=(400, 300)):
+    content = BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(content, 'WEBP')
+    return content.getvalue()
+
+
+class TestWebpImageField(TestCase):
+    @skipUnless(PIL_WEBP, "Requires Pillow with WebP support.")
+    def test_in_process(self):
+        upload = SimpleUploadedFile('image.webp', make_webp())
+        self.assertIs(WebpImageField().clean(upload), upload)
+        self.assertEqual(upload.name, 'image.webp')
+
+    @skipUnless(PIL_WEBP and find_executable('dwebp'),
+                "Requires Pillow with WebP support and dwebp.")
+    def test_dwebp_content(self):
+        png = dwebp_content(make_webp((40, 30)))
+        self.assertEqual(Image.open(BytesIO(png)).size, (40, 30))
+        self.assertIsNone(dwebp_content(b'RIFF not really'))
+
+    def test_invalid(self):
+        upload = SimpleUploadedFile('image.webp', b'RIFF not really')
+        with self.assertRaises(ValidationError):
+            WebpImageField().clean(upload)
+
+    def test_size_limit(self):
+        upload = SimpleUploadedFile('image.webp',
+            b'RIFF\x00\x00\x00\x00WEBP' + b'\x00' * 1024)
+        content = BytesIO()
+        Image.new('RGB', (40, 30), 'red').save(content, 'PNG')
+        png = SimpleUploadedFile('image.png', content.getvalue())
+        max_size = common_forms.WEBP_MAX_SIZE
+        common_forms.WEBP_MAX_SIZE = 16
+        try:
+            with self.assertRaises(ValidationError) as context:
+                WebpImageField().clean(upload)
+            self.assertIn('too large', context.exception.messages[0])
+            # only WebP images are limited
+            self.assertIs(WebpImageField().clean(png), png)
+        finally:
+            common_forms.WEBP_MAX_SIZE = max_size
+
+
+def reference_generate_thumbnail(source_filename, thumb_filename, size):
+    """The square thumbnail pipeline before draft mode and multi-step
+    resizing. Cropping decodes the full image."""
+    pil_image = Image.open(source_filename)
+    width, height = pil_image.size
+    shorter = min(width, height)
+    shift = int((width - height) / 2) if width > height else 0
+    pil_image = pil_image.crop((shift, 0, shorter + shift, shorter))
+    max_size = int(size[1:])
+    pil_image.thumbnail((max_size, max_size), Image.ANTIALIAS)
+    pil_image.save(thumb_filename, 'JPEG')
+
+
+def measure(args):
+    """Returns time and peak RSS growth in kB of running `function` in
+    a fresh process."""
+    function, args = args
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    function(*args)
+    return (time.time() - start,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+
+
+@skipUnless(os.environ.get('LCK_BENCHMARK'),
+            "Set LCK_BENCHMARK=1 to run benchmarks.")
+class BenchmarkThumbnails(TestCase):
+    def test_generate_thumbnail(self):
+        dir = tempfile.mkdtemp()
+        storage = FileSystemStorage(location=dir)
+        try:
+            for width, height in (1024, 768), (3264, 2448), (6000, 4000):
+                name = '{}x{}.jpg'.format(width, height)
+                source = os.path.join(dir, name)
+                Image.effect_noise((width, height), 64).convert('RGB').save(
+                    source, 'JPEG', quality=90)
+                cases = (
+                    (reference_generate_thumbnail, (source,
+                        source + '.thumb', 's300')),
+                    (generate_thumbnail, (Original(storage, name),
+                        name + '.thumb', 's300')),
+                )
+                for function, args in cases:
+                    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+                    try:
+                        elapsed, rss = pool.apply(measure, ((function,
+                            args),))
+                    finally:
+                        pool.terminate()
+                    print("\n{}x{} {}: {:.1f} ms, peak RSS +{} kB".format(
+                        width, height, function.__name__, elapsed * 1000,
+                        rss))
+        finally:
+            shutil.rmtree(dir)
+
+    def test_storage_calls(self):
+        storage = FakeRemoteStorage()
+        images = [make_remote_image(storage, 'image{}.jpg'.format(i))
+            for i in xrange(20)]
+        for label in 'first', 'repeated':
+            storage.calls = 0
+            for image in images:
+                thumbnails(image, ['s48', 's100', 'm300'])
+            print("\n{} renders: {:.1f} storage calls per image".format(
+                label, storage.calls / len(images)))
+
+
+@skipUnless(os.environ.get('LCK_BENCHMARK'),
+            "Set LCK_BENCHMARK=1 to run benchmarks.")
+class BenchmarkWebpImageField(TestCase):
+    def test_uploads_per_second(self):
+        content = make_webp((1024, 768))
+        field = WebpImageField()
+        if PIL_WEBP:
+            start = time.time()
+            for i in xrange(50):
+                field.clean(SimpleUploadedFile('image.webp', content))
+            print("\nin-process: {:.1f} uploads/s".format(
+                50 / (time.time() - start)))
+        dir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(dir, 'image.webp')
+            with open(source, 'wb') as f:
+                f.write(content)
+            start = time.time()
+            for i in xrange(20):
+                if not dwebp(source, os.path.join(dir, 'image.png')):
+                    print("\ndwebp: unavailable")
+                    break
+            else:
+                print("\ndwebp: {:.1f} uploads/s".format(
+                    20 / (time.time() - start)))
+        finally:
+            shutil.rmtree(dir)
@@ -0,0 +1,642 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""lck.django.common.thumbnails
+   ----------------------------
+
+   Thumbnail generation used by the ``thumbnail`` filter. Originals are read
+   and thumbnails are written through Django's storage API. Known thumbnails
+   are kept in an index in the cache so rendering a thumbnail which already
+   exists doesn't touch the storage. Generation of a single thumbnail is
+   guarded by a lock in the cache so concurrent renders don't do the same
+   work twice.
+
+   Configured by these values in ``settings.py``:
+
+   * ``THUMBNAIL_STORAGE`` - dotted path to the storage class thumbnails are
+     kept in. **Default**: None, meaning the storage of the original image.
+
+   * ``THUMBNAIL_INDEX_TIMEOUT`` - how long a thumbnail is known to be up to
+     date with its original, in seconds. **Default**: 1 hour.
+
+   * ``THUMBNAIL_BACKGROUND`` - if True, missing thumbnails are generated
+     by a pool of ``THUMBNAIL_WORKERS`` background threads and the
+     placeholder URL is returned in the meantime. **Default**: False.
+
+   * ``THUMBNAIL_PLACEHOLDER_URL`` - URL returned while a thumbnail is being
+     generated. **Default**: None, meaning the URL of the original image.
+
+   * ``THUMBNAIL_LOCK_TIMEOUT`` - maximum time in seconds a single
+     thumbnail generation can hold its lock. **Default**: 30 seconds.
+
+   * ``THUMBNAIL_QUALITY`` - JPEG and WebP quality. **Default**: 85.
+
+   * ``THUMBNAIL_PROGRESSIVE`` - if True, JPEG thumbnails are saved as
+     progressive. **Default**: True.
+
+   * ``THUMBNAIL_WEBP`` - if True and Pillow supports it, thumbnails are
+     saved as WebP with a ``.webp`` extension. **Default**: False.
+
+   * ``THUMBNAIL_CONTENT_ADDRESSED`` - if True, thumbnail names include
+     a hash of the original's content and of the thumbnail settings, so
+     a thumbnail URL never changes its content and can be served with
+     far-future caching headers. A lookup table in the cache maps originals
+     and sizes to current names. Renditions made stale by a changed original
+     are removed in the background. **Default**: False.
+
+   Large JPEG originals are decoded at a reduced scale, reduced with a fast
+   filter close to the target size and then resized with a high-quality
+   filter. Metadata is not copied to thumbnails."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from contextlib import closing
+from hashlib import md5, sha1
+from io import BytesIO
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import posixpath
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, get_storage_class
+from django.db.models.fields.files import FieldFile
+from PIL import Image
+
+
+THUMBNAIL_STORAGE = getattr(settings, 'THUMBNAIL_STORAGE', None)
+THUMBNAIL_INDEX_TIMEOUT = getattr(settings, 'THUMBNAIL_INDEX_TIMEOUT', 60 * 60)
+THUMBNAIL_BACKGROUND = getattr(settings, 'THUMBNAIL_BACKGROUND', False)
+THUMBNAIL_PLACEHOLDER_URL = getattr(settings, 'THUMBNAIL_PLACEHOLDER_URL',
+    None)
+THUMBNAIL_WORKERS = getattr(settings, 'THUMBNAIL_WORKERS', 2)
+THUMBNAIL_LOCK_TIMEOUT = getattr(settings, 'THUMBNAIL_LOCK_TIMEOUT', 30)
+THUMBNAIL_QUALITY = getattr(settings, 'THUMBNAIL_QUALITY', 85)
+THUMBNAIL_PROGRESSIVE = getattr(settings, 'THUMBNAIL_PROGRESSIVE', True)
+THUMBNAIL_WEBP = getattr(settings, 'THUMBNAIL_WEBP', False)
+THUMBNAIL_CONTENT_ADDRESSED = getattr(settings, 'THUMBNAIL_CONTENT_ADDRESSED',
+    False)
+
+# ANTIALIAS is gone from newer versions of Pillow
+HIGH_QUALITY_FILTER = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+
+LOG = logging.getLogger(__name__)
+
+_pool = []
+_pool_lock = threading.Lock()
+_storage = []
+
+
+def _is_proper_image(image):
+    if isinstance(image, FieldFile):
+        # checking attributes of field files would open them
+        return bool(image)
+    if image is not None:
+        for attr in 'width', 'height', 'file', 'url':
+            if not hasattr(image, attr):
+                return False
+        return True
+    return False
+
+
+def get_image(image):
+    """Returns `image` or its `image` attribute, whichever is an image.
+    Returns None if neither is."""
+    if _is_proper_image(image):
+        return image
+    if hasattr(image, 'image') and _is_proper_image(image.image):
+        return image.image
+    return None
+
+
+def webp_enabled():
+    """Returns True if thumbnails should be saved as WebP."""
+    if not THUMBNAIL_WEBP:
+        return False
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def get_thumbnail_name(name, size):
+    """Returns the name of the `size` thumbnail for a file or URL `name`."""
+    try:
+        basename, format = name.rsplit('.', 1)
+    except ValueError: # if there is no extension
+        basename = name
+        format = 'jpg'
+    if webp_enabled():
+        format = 'webp'
+    return basename + '_' + size + '.' + format
+
+
+def get_dimensions(size, image_width, image_height):
+    """Returns ``(width, height, shift)`` of a `size` thumbnail of an image.
+    `shift` is the offset of the square cut for square thumbnails, None
+    otherwise. See the ``thumbnail`` filter for possible sizes."""
+    shift = None
+    if size.startswith("h"):
+        height = int(size[1:])
+        width = height * image_width / image_height
+    elif size.startswith("w"):
+        width = int(size[1:])
+        height = width * image_height / image_width
+    elif size.startswith("m"):
+        max = int(size[1:])
+        if image_width > image_height:
+            width = max
+            height = width * image_height / image_width
+        else:
+            height = max
+            width = height * image_width / image_height
+    elif size.startswith("s"):
+        width = height = int(size[1:])
+        if image_width > image_height:
+            shift = int((image_width - image_height) / 2)
+        else:
+            shift = 0
+    else:
+        width, height = size.split("x")
+    return int(round(float(width))), int(round(float(height))), shift
+
+
+def get_thumbnail_storage():
+    """Returns the storage configured in ``THUMBNAIL_STORAGE`` or None."""
+    if THUMBNAIL_STORAGE and not _storage:
+        _storage.append(get_storage_class(THUMBNAIL_STORAGE)())
+    return _storage[0] if _storage else None
+
+
+class Original(object):
+    """An original image `name` in `storage`. Its thumbnails are kept in
+    `thumbnail_storage`, by default the same storage."""
+
+    def __init__(self, storage, name, thumbnail_storage=None):
+        self.storage = storage
+        self.name = name
+        self.thumbnail_storage = thumbnail_storage or storage
+        self._content_digest = None
+
+    @classmethod
+    def from_image(cls, image):
+        """Returns the original of an image returned by `get_image()`."""
+        if isinstance(image, FieldFile):
+            storage, name = image.storage, image.name
+        else:
+            location, name = os.path.split(image.file.name)
+            base_url = image.url[:image.url.rfind('/') + 1]
+            storage = FileSystemStorage(location=location, base_url=base_url)
+        return cls(storage, name, get_thumbnail_storage())
+
+    def open(self):
+        return self.storage.open(self.name, 'rb')
+
+    def thumbnail_name(self, size):
+        """Returns the name of the current `size` thumbnail. With
+        ``THUMBNAIL_CONTENT_ADDRESSED`` this reads the original once, in
+        chunks."""
+        if not THUMBNAIL_CONTENT_ADDRESSED:
+            return get_thumbnail_name(self.name, size)
+        if self._content_digest is None:
+            digest = sha1()
+            with closing(self.open()) as f:
+                for chunk in f.chunks():
+                    digest.update(chunk)
+            self._content_digest = digest.hexdigest()
+        signature = "{}:{}:{}:{}:{}".format(self._content_digest, size,
+            THUMBNAIL_QUALITY, THUMBNAIL_PROGRESSIVE, webp_enabled())
+        before, after = self._content_addressed_parts(size)
+        return before + md5(signature.encode('utf8')).hexdigest()[:12] + after
+
+    def _content_addressed_parts(self, size):
+        """Returns the parts of a content-addressed thumbnail name before
+        and after the hash."""
+        return get_thumbnail_name(self.name, size + '_|').rsplit('|', 1)
+
+    def stale_thumbnail_names(self, thumb_name, size):
+        """Returns names of other content-addressed `size` thumbnails of this
+        original. Returns an empty list if the storage can't list them."""
+        before, after = self._content_addressed_parts(size)
+        directory = posixpath.dirname(before)
+        pattern = re.compile(re.escape(posixpath.basename(before)) +
+            '[0-9a-f]{12}' + re.escape(after) + '$')
+        try:
+            _, files = self.thumbnail_storage.listdir(directory)
+        except (NotImplementedError, OSError):
+            return []
+        return [posixpath.join(directory, name) for name in files
+            if pattern.match(name)
+            and posixpath.join(directory, name) != thumb_name]
+
+    def index_key(self, thumb_name):
+        return "thumbnail::index::{}".format(self._digest(thumb_name))
+
+    def lock_key(self, thumb_name):
+        return "thumbnail::lock::{}".format(self._digest(thumb_name))
+
+    def lookup_key(self, size):
+        return "thumbnail::lookup::{}".format(self._digest("{}\n{}".format(
+            self.name, size)))
+
+    def pending_key(self, size):
+        return "thumbnail::pending::{}".format(self._digest("{}\n{}".format(
+            self.name, size)))
+
+    def known_thumbnail_names(self, sizes):
+        """Returns a dictionary mapping those of `sizes` which are known to
+        have up to date thumbnails to their names. Doesn't touch the
+        storage."""
+        if THUMBNAIL_CONTENT_ADDRESSED:
+            keys = dict((self.lookup_key(size), size) for size in sizes)
+            return dict((keys[key], name) for key, name
+                in cache.get_many(keys.keys()).iteritems())
+        names = dict((self.index_key(self.thumbnail_name(size)), size)
+            for size in sizes)
+        return dict((names[key], self.thumbnail_name(names[key]))
+            for key in cache.get_many(names.keys()))
+
+    def existing_thumbnail_names(self, sizes):
+        """Returns a dictionary mapping those of `sizes` which have up to date
+        thumbnails in the storage to their names and adds them to the index.
+        With ``THUMBNAIL_CONTENT_ADDRESSED`` names are only known after
+        reading the original, so nothing is checked."""
+        if THUMBNAIL_CONTENT_ADDRESSED:
+            return {}
+        names = dict((size, self.thumbnail_name(size)) for size in sizes)
+        names = dict((size, thumb_name) for size, thumb_name
+            in names.iteritems() if self.is_up_to_date(thumb_name))
+        cache.set_many(dict((self.index_key(thumb_name), True)
+            for thumb_name in names.itervalues()), THUMBNAIL_INDEX_TIMEOUT)
+        return names
+
+    def _digest(self, thumb_name):
+        storage = self.thumbnail_storage
+        return md5("{}.{}\n{}\n{}".format(storage.__class__.__module__,
+            storage.__class__.__name__, getattr(storage, 'location', ''),
+            thumb_name).encode('utf8')).hexdigest()
+
+    def is_up_to_date(self, thumb_name):
+        """Returns True if the thumbnail exists and is not older than the
+        original. Stale thumbnails are removed."""
+        storage = self.thumbnail_storage
+        if not storage.exists(thumb_name):
+            return False
+        if THUMBNAIL_CONTENT_ADDRESSED:
+            # the name changes with the content
+            return True
+        try:
+            stale = (storage.modified_time(thumb_name) <
+                self.storage.modified_time(self.name))
+        except NotImplementedError:
+            return True
+        if stale:
+            storage.delete(thumb_name)
+        return not stale
+
+    def write(self, thumb_name, content):
+        """Stores a thumbnail. Local files are replaced atomically so readers
+        never see partial thumbnails."""
+        storage = self.thumbnail_storage
+        try:
+            path = storage.path(thumb_name)
+        except NotImplementedError:
+            path = None
+        if path is None:
+            if storage.exists(thumb_name):
+                storage.delete(thumb_name)
+            saved_name = storage.save(thumb_name, ContentFile(content))
+            if saved_name != thumb_name:
+                storage.delete(saved_name)
+                raise IOError("Thumbnail {!r} was written concurrently."
+                    "".format(thumb_name))
+            return
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.rename(temp_path, path)
+
+
+def fit(width, height, image_width, image_height):
+    """Returns the size of an image scaled down to fit in `width` x `height`
+    with its aspect ratio preserved. Images are never scaled up."""
+    if image_width > width:
+        image_height = max(int(round(image_height * width / image_width)), 1)
+        image_width = width
+    if image_height > height:
+        image_width = max(int(round(image_width * height / image_height)), 1)
+        image_height = height
+    return image_width, image_height
+
+
+def _plan(size, image_width, image_height):
+    """Returns the box of an `image_width` x `image_height` image shown on
+    a `size` thumbnail and the size of the thumbnail."""
+    width, height, shift = get_dimensions(size, image_width, image_height)
+    box = (0, 0, image_width, image_height)
+    if shift is not None:
+        shorter = min(image_width, image_height)
+        box = (shift, 0, shorter + shift, shorter)
+    return box, fit(width, height, box[2] - box[0], box[3] - box[1])
+
+
+def _scaled(box, source_size, pil_image):
+    """Returns `box` in coordinates of `pil_image`, a scaled down version
+    of an image of `source_size`."""
+    if pil_image.size == source_size:
+        return box
+    scale_x = pil_image.size[0] / source_size[0]
+    scale_y = pil_image.size[1] / source_size[1]
+    return (int(round(box[0] * scale_x)), int(round(box[1] * scale_y)),
+        int(round(box[2] * scale_x)), int(round(box[3] * scale_y)))
+
+
+def _covers(pil_image, source_size, box, target):
+    box = _scaled(box, source_size, pil_image)
+    return box[2] - box[0] >= target[0] and box[3] - box[1] >= target[1]
+
+
+def _render(pil_image, source_size, box, target):
+    box = _scaled(box, source_size, pil_image)
+    if box != (0, 0) + pil_image.size:
+        pil_image = pil_image.crop(box)
+    if pil_image.mode not in ('1', 'L', 'LA', 'RGB', 'RGBA'):
+        pil_image = pil_image.convert('RGBA' if 'transparency' in
+            pil_image.info else 'RGB')
+    # a fast reduce to twice the target size, then a high-quality filter
+    factor = min(pil_image.size[0] // target[0], pil_image.size[1] // target[1])
+    if factor >= 4:
+        if hasattr(pil_image, 'reduce') and pil_image.mode != '1':
+            pil_image = pil_image.reduce(factor // 2)
+        else:
+            pil_image = pil_image.resize((pil_image.size[0] // (factor // 2),
+                pil_image.size[1] // (factor // 2)), Image.NEAREST)
+    if pil_image.size != target:
+        pil_image = pil_image.resize(target, HIGH_QUALITY_FILTER)
+    return pil_image
+
+
+def _encode(pil_image, pil_format, transparency=None):
+    options = {}
+    if pil_format == 'JPEG':
+        if pil_image.mode not in ('L', 'RGB'):
+            pil_image = pil_image.convert('RGB')
+        options.update(quality=THUMBNAIL_QUALITY, optimize=True,
+            progressive=THUMBNAIL_PROGRESSIVE)
+    elif pil_format == 'WEBP':
+        options.update(quality=THUMBNAIL_QUALITY)
+    elif transparency is not None and pil_image.mode in ('L', 'P'):
+        options['transparency'] = transparency
+    # don't copy metadata of the original
+    pil_image.info = {}
+    output = BytesIO()
+    pil_image.save(output, pil_format, **options)
+    return output.getvalue()
+
+
+def generate_thumbnails(original, thumbs):
+    """Writes thumbnails of an `Original` decoding it only once. `thumbs`
+    is a list of ``(thumb_name, size)`` pairs.
+
+    JPEG images are decoded at the smallest scale not smaller than the
+    largest thumbnail. Thumbnails are rendered from the largest to the
+    smallest, each from the smallest rendition so far which is big enough."""
+    with closing(original.open()) as f:
+        _generate_thumbnails(original, Image.open(f), thumbs)
+
+
+def _generate_thumbnails(original, pil_image, thumbs):
+    pil_format = pil_image.format or 'JPEG'
+    if webp_enabled():
+        pil_format = 'WEBP'
+    elif pil_format not in Image.SAVE:
+        pil_format = 'JPEG'
+    transparency = pil_image.info.get('transparency')
+    source_size = pil_image.size
+    plans = []
+    for thumb_name, size in thumbs:
+        box, target = _plan(size, *source_size)
+        plans.append((target[0] * target[1], thumb_name, box, target))
+    plans.sort(reverse=True)
+    # the whole image is decoded, ask for enough pixels in every box
+    pil_image.draft(pil_image.mode, (
+        max(int(target[0] * source_size[0] / (box[2] - box[0]))
+            for _, _, box, target in plans),
+        max(int(target[1] * source_size[1] / (box[3] - box[1]))
+            for _, _, box, target in plans)))
+    renditions = [pil_image]
+    for _, thumb_name, box, target in plans:
+        source = pil_image
+        for rendition in renditions[1:]:
+            if _covers(rendition, source_size, box, target):
+                source = rendition
+        thumbnail = _render(source, source_size, box, target)
+        original.write(thumb_name, _encode(thumbnail, pil_format,
+            transparency))
+        if box == (0, 0) + source_size and thumbnail is not source:
+            renditions.append(thumbnail)
+
+
+def generate_thumbnail(original, thumb_name, size):
+    """Writes a `size` thumbnail of an `Original` as `thumb_name`."""
+    generate_thumbnails(original, [(thumb_name, size)])
+
+
+def _acquire(original, thumbs):
+    return [(thumb_name, size) for thumb_name, size in thumbs
+        if cache.add(original.lock_key(thumb_name), True,
+            THUMBNAIL_LOCK_TIMEOUT)]
+
+
+def _refresh(original, thumbs):
+    stale = [(thumb_name, size) for thumb_name, size in thumbs
+        if not original.is_up_to_date(thumb_name)]
+    if stale:
+        generate_thumbnails(original, stale)
+        if THUMBNAIL_CONTENT_ADDRESSED:
+            _submit(remove_stale_thumbnails, (original, stale))
+    cache.set_many(dict((original.index_key(thumb_name), True)
+        for thumb_name, _ in thumbs), THUMBNAIL_INDEX_TIMEOUT)
+
+
+def _refresh_locked(original, thumbs):
+    try:
+        _refresh(original, thumbs)
+    finally:
+        cache.delete_many([original.lock_key(thumb_name)
+            for thumb_name, _ in thumbs])
+
+
+def ensure_thumbnails(original, thumbs):
+    """Makes sure up to date thumbnails of an `Original` exist and adds them
+    to the index. `thumbs` is a list of ``(thumb_name, size)`` pairs. Waits
+    for thumbnails which are being generated elsewhere, at most
+    ``THUMBNAIL_LOCK_TIMEOUT`` seconds. Then (e.g. if the cache doesn't work)
+    it refreshes the remaining ones itself."""
+    pending = list(thumbs)
+    deadline = time.time() + THUMBNAIL_LOCK_TIMEOUT
+    while True:
+        acquired = _acquire(original, pending)
+        if acquired:
+            _refresh_locked(original, acquired)
+        pending = [thumb for thumb in pending if thumb not in acquired]
+        if pending:
+            indexed = cache.get_many([original.index_key(thumb_name)
+                for thumb_name, _ in pending])
+            pending = [(thumb_name, size) for thumb_name, size in pending
+                if original.index_key(thumb_name) not in indexed]
+        if not pending:
+            return
+        if time.time() >= deadline:
+            _refresh(original, pending)
+            return
+        time.sleep(0.05)
+
+
+def ensure_thumbnail(original, thumb_name, size):
+    """Like `ensure_thumbnails()` for a single thumbnail."""
+    ensure_thumbnails(original, [(thumb_name, size)])
+
+
+def remove_stale_thumbnails(original, thumbs):
+    """Removes content-addressed thumbnails of the same sizes as `thumbs`
+    which were made for previous versions of the original."""
+    for thumb_name, size in thumbs:
+        for name in original.stale_thumbnail_names(thumb_name, size):
+            original.thumbnail_storage.delete(name)
+
+
+def prepare_thumbnails(original, sizes):
+    """Makes sure up to date `sizes` thumbnails of an `Original` exist.
+    Returns a dictionary mapping sizes to thumbnail names."""
+    thumbs = [(original.thumbnail_name(size), size) for size in sizes]
+    ensure_thumbnails(original, thumbs)
+    if THUMBNAIL_CONTENT_ADDRESSED:
+        cache.set_many(dict((original.lookup_key(size), thumb_name)
+            for thumb_name, size in thumbs), THUMBNAIL_INDEX_TIMEOUT)
+    return dict((size, thumb_name) for thumb_name, size in thumbs)
+
+
+def forget_thumbnails(image, sizes):
+    """Makes the next `thumbnails()` call check `sizes` thumbnails of `image`
+    again. Call it when the original is replaced under the same name."""
+    image = get_image(image)
+    if image is None:
+        return
+    _forget(Original.from_image(image), sizes)
+
+
+def warm_thumbnails(image, sizes):
+    """Like `forget_thumbnails()` but also prepares `sizes` thumbnails of
+    `image` in a background thread. Doesn't touch the storage itself."""
+    image = get_image(image)
+    if image is None:
+        return
+    original = Original.from_image(image)
+    _forget(original, sizes)
+    _prepare_in_background(original, sizes)
+
+
+def _forget(original, sizes):
+    if THUMBNAIL_CONTENT_ADDRESSED:
+        # names of current thumbnails are only known from the lookup table
+        keys = [original.lookup_key(size) for size in sizes]
+    else:
+        keys = [original.index_key(original.thumbnail_name(size))
+            for size in sizes]
+    cache.delete_many(keys)
+
+
+def _submit(function, args):
+    with _pool_lock:
+        if not _pool:
+            _pool.append(ThreadPool(THUMBNAIL_WORKERS))
+    _pool[0].apply_async(function, args)
+
+
+def _prepare_pending(original, sizes):
+    # exceptions would silently vanish in the pool's result
+    try:
+        prepare_thumbnails(original, sizes)
+    except Exception:
+        LOG.exception("Preparing thumbnails of `%s` failed.", original.name)
+    finally:
+        cache.delete_many([original.pending_key(size) for size in sizes])
+
+
+def _prepare_in_background(original, sizes):
+    # sizes pending elsewhere are already being prepared
+    pending = [size for size in sizes if cache.add(original.pending_key(size),
+        True, THUMBNAIL_LOCK_TIMEOUT)]
+    if pending:
+        _submit(_prepare_pending, (original, pending))
+
+
+def thumbnails(image, sizes, background=None):
+    """Returns a dictionary mapping `sizes` to URLs of thumbnails of
+    `image`. Missing thumbnails are generated in a single pass over the
+    original. If `background` is True (by default ``THUMBNAIL_BACKGROUND``),
+    thumbnails missing from the index are looked up in the storage and the
+    rest is generated in a background thread while the placeholder URL is
+    returned for them instead. Returns an empty dictionary if `image` is not
+    an image."""
+    image = get_image(image)
+    if image is None:
+        return {}
+    original = Original.from_image(image)
+    names = original.known_thumbnail_names(sizes)
+    missing = [size for size in sizes if size not in names]
+    if background is None:
+        background = THUMBNAIL_BACKGROUND
+    if missing and background:
+        # the index might have expired while the thumbnails still exist
+        names.update(original.existing_thumbnail_names(missing))
+        missing = [size for size in missing if size not in names]
+        if missing:
+            _prepare_in_background(original, missing)
+    elif missing:
+        names.update(prepare_thumbnails(original, missing))
+    url = original.thumbnail_storage.url
+    placeholder = THUMBNAIL_PLACEHOLDER_URL or image.url
+    return dict((size, url(names[size]) if size in names else placeholder)
+        for size in sizes)
+
+
+def get_thumbnail_url(image, size, background=None):
+    """Returns the URL of a `size` thumbnail of `image`, generating the
+    thumbnail if necessary. See `thumbnails()`. Returns None if `image` is
+    not an image."""
+    return thumbnails(image, [size], background).get(size)
@@ -45,6 +45,7 @@ from django.utils.translation import ugettext_lazy as _
 from dj.choices import Country, Gender
 
 from lck.django.common.templatetags.thumbnail import thumbnail
+from lck.django.common.thumbnails import warm_thumbnails
 
 
 TZ_CHOICES = [(float(x[0]), x[1]) for x in (
@@ -176,6 +177,11 @@ class AvatarSupport(db.Model):
 
         avatar = AvatarSupport.avatar_field(upload_to='upload_directory')
 
+    Thumbnails in ``avatar_sizes`` (e.g. ``('s48', 's100', 'm300')``) are
+    generated in a single pass in a background thread when an object is
+    created or its avatar changes. When replacing the file under the same
+    name, call `warm_thumbnails()` yourself.
+
     To have gravatar fallback, specify `GravatarSupport` **after**
     `AvatarSupport` in your model inheritance list.
     """
@@ -186,6 +192,7 @@ class AvatarSupport(db.Model):
     avatar_field = partial(db.ImageField, verbose_name=_("custom avatar"),
         height_field='avatar_height', width_field='avatar_width',
         null=True, blank=True, max_length=255)
+    avatar_sizes = ()
 
     def __getattr__(self, name):
         m = AVATAR_ATTR_REGEX.match(name)
@@ -194,6 +201,20 @@ class AvatarSupport(db.Model):
             return thumbnail(self.avatar, mode_size)
         return super(AvatarSupport, self).__getattr__(name)
 
+    def __init__(self, *args, **kwargs):
+        super(AvatarSupport, self).__init__(*args, **kwargs)
+        # deferred avatars aren't loaded for that
+        avatar = self.__dict__.get('avatar')
+        self._saved_avatar_name = getattr(avatar, 'name', avatar)
+
+    def save(self, *args, **kwargs):
+        changed = self.pk is None or \
+            self.avatar.name != self._saved_avatar_name
+        super(AvatarSupport, self).save(*args, **kwargs)
+        self._saved_avatar_name = self.avatar.name
+        if changed and self.avatar_sizes and self.avatar:
+            warm_thumbnails(self.avatar, self.avatar_sizes)
+
     class Meta:
         abstract = True
 
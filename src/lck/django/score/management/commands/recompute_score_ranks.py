@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from optparse import make_option
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import transaction
+
+from lck.django.score.models import now, TotalScore
+from lck.django.score.ranking import get_ranking
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=1000, help='How many total scores to update in a single '
+            'transaction. Default: 1000.'),
+        make_option('--model', dest='model', default=None,
+            help='Only recompute ranks for objects of the given `app.model`.'),
+    )
+    help = ("Recomputes ranks of total scores in batches. Run it periodically "
+            "if the configured SCORE_RANKING changes over time.")
+
+    def handle_noargs(self, **options):
+        scores = TotalScore.objects.all()
+        if options.get('model'):
+            try:
+                app_label, model = options['model'].lower().split('.')
+                ct = ContentType.objects.get_by_natural_key(app_label, model)
+            except (ValueError, ContentType.DoesNotExist):
+                raise CommandError("Unknown model: {!r}. Use the "
+                    "`app.model` format.".format(options['model']))
+            scores = scores.filter(content_type=ct)
+        ranking = get_ranking()
+        started = time.time()
+        last_id = 0
+        checked = updated = 0
+        while True:
+            count, changed, last_id = self.recompute_batch(scores, ranking,
+                last_id, options['batch_size'])
+            if not count:
+                break
+            checked += count
+            updated += changed
+        print("{} total scores checked, {} ranks updated in {:.1f} s.".format(
+            checked, updated, time.time() - started))
+
+    @transaction.commit_on_success
+    def recompute_batch(self, scores, ranking, last_id, batch_size):
+        """Returns the number of total scores checked and updated in a batch
+        following `last_id`, and the last ID in the batch."""
+        rows = list(scores.select_for_update().filter(id__gt=last_id
+            ).order_by('id').values_list('id', 'value', 'ups', 'downs',
+            'created', 'rank')[:batch_size])
+        timestamp = now()
+        changed = 0
+        for pk, value, ups, downs, created, rank in rows:
+            new_rank = ranking(value, ups, downs, created, timestamp)
+            if new_rank != rank:
+                TotalScore.objects.filter(pk=pk).update(rank=new_rank)
+                changed += 1
+        return len(rows), changed, rows[-1][0] if rows else last_id
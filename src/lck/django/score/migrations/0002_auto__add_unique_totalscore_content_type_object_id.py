@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.creator.freezer import freeze_apps
+from south.db import db
+from south.v2 import SchemaMigration
+
+from django.conf import settings
+from django.db.models import Count, Sum
+
+
+SCORE_VOTER_MODEL = getattr(settings, 'SCORE_VOTER_MODEL',
+    getattr(settings, 'AUTH_PROFILE_MODULE', 'auth.User'))
+apm_key = SCORE_VOTER_MODEL.lower()
+apm_app = SCORE_VOTER_MODEL.split('.')[0]
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        if not db.dry_run:
+            # Merging duplicate total scores created by concurrent first votes
+            TotalScore = orm['score.TotalScore']
+            Vote = orm['score.Vote']
+            duplicates = TotalScore.objects.values_list('content_type',
+                'object_id').annotate(Count('id')).filter(
+                id__count__gt=1).order_by()
+            for ct_id, object_id, _ in duplicates:
+                scores = list(TotalScore.objects.filter(content_type=ct_id,
+                    object_id=object_id).order_by('id'))
+                kept = scores[0]
+                voters = set(Vote.objects.filter(total_score=kept
+                    ).values_list('voter', flat=True))
+                for score in scores[1:]:
+                    for vote in Vote.objects.filter(total_score=score):
+                        if vote.voter_id in voters:
+                            vote.delete()
+                            continue
+                        vote.total_score = kept
+                        vote.save()
+                        voters.add(vote.voter_id)
+                    score.delete()
+                kept.value = Vote.objects.filter(total_score=kept).aggregate(
+                    Sum('value'))['value__sum'] or 0
+                kept.save()
+
+        # Adding unique constraint on 'TotalScore', fields ['content_type', 'object_id']
+        db.create_unique('score_totalscore', ['content_type_id', 'object_id'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'TotalScore', fields ['content_type', 'object_id']
+        db.delete_unique('score_totalscore', ['content_type_id', 'object_id'])
+
+
+    models = {
+        apm_key: freeze_apps(apm_app)[apm_key],
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'score.totalscore': {
+            'Meta': {'unique_together': "(('content_type', 'object_id'),)", 'object_name': 'TotalScore'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'score_totalscore_scores'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'value': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_index': 'True'})
+        },
+        'score.vote': {
+            'Meta': {'unique_together': "([u'total_score', u'voter'],)", 'object_name': 'Vote'},
+            'cache_version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'reason': ('django.db.models.fields.TextField', [], {'default': "u''", 'blank': 'True'}),
+            'total_score': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['score.TotalScore']"}),
+            'value': ('django.db.models.fields.IntegerField', [], {'default': '1', 'db_index': 'True'}),
+            'voter': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['{SCORE_VOTER_MODEL}']".format(SCORE_VOTER_MODEL=SCORE_VOTER_MODEL)})
+        }
+    }
+
+    complete_apps = ['score']
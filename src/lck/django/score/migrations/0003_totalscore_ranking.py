@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.creator.freezer import freeze_apps
+from south.db import db
+from south.v2 import SchemaMigration
+
+from django.conf import settings
+
+
+SCORE_VOTER_MODEL = getattr(settings, 'SCORE_VOTER_MODEL',
+    getattr(settings, 'AUTH_PROFILE_MODULE', 'auth.User'))
+apm_key = SCORE_VOTER_MODEL.lower()
+apm_app = SCORE_VOTER_MODEL.split('.')[0]
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'TotalScore.created'
+        db.add_column('score_totalscore', 'created',
+                      self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now),
+                      keep_default=False)
+
+        # Adding field 'TotalScore.ups'
+        db.add_column('score_totalscore', 'ups',
+                      self.gf('django.db.models.fields.IntegerField')(default=0),
+                      keep_default=False)
+
+        # Adding field 'TotalScore.downs'
+        db.add_column('score_totalscore', 'downs',
+                      self.gf('django.db.models.fields.IntegerField')(default=0),
+                      keep_default=False)
+
+        # Adding field 'TotalScore.rank'
+        db.add_column('score_totalscore', 'rank',
+                      self.gf('django.db.models.fields.FloatField')(default=0, db_index=True),
+                      keep_default=False)
+
+        # Adding index on 'TotalScore', fields ['content_type', 'rank']
+        db.create_index('score_totalscore', ['content_type_id', 'rank'])
+
+        if not db.dry_run:
+            # Filling vote counts and creation dates from existing votes.
+            # Ranks are filled by the `recompute_score_ranks` command.
+            db.execute("""
+                UPDATE score_totalscore SET
+                ups = (SELECT COUNT(*) FROM score_vote
+                    WHERE score_vote.total_score_id = score_totalscore.id
+                    AND score_vote.value > 0),
+                downs = (SELECT COUNT(*) FROM score_vote
+                    WHERE score_vote.total_score_id = score_totalscore.id
+                    AND score_vote.value < 0),
+                created = COALESCE((SELECT MIN(score_vote.created)
+                    FROM score_vote
+                    WHERE score_vote.total_score_id = score_totalscore.id),
+                    created)""")
+
+
+    def backwards(self, orm):
+        # Removing index on 'TotalScore', fields ['content_type', 'rank']
+        db.delete_index('score_totalscore', ['content_type_id', 'rank'])
+
+        # Deleting field 'TotalScore.created'
+        db.delete_column('score_totalscore', 'created')
+
+        # Deleting field 'TotalScore.ups'
+        db.delete_column('score_totalscore', 'ups')
+
+        # Deleting field 'TotalScore.downs'
+        db.delete_column('score_totalscore', 'downs')
+
+        # Deleting field 'TotalScore.rank'
+        db.delete_column('score_totalscore', 'rank')
+
+
+    models = {
+        apm_key: freeze_apps(apm_app)[apm_key],
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'score.totalscore': {
+            'Meta': {'unique_together': "(('content_type', 'object_id'),)", 'object_name': 'TotalScore'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'score_totalscore_scores'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'value': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'ups': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'downs': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'rank': ('django.db.models.fields.FloatField', [], {'default': '0', 'db_index': 'True'})
+        },
+        'score.vote': {
+            'Meta': {'unique_together': "([u'total_score', u'voter'],)", 'object_name': 'Vote'},
+            'cache_version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'reason': ('django.db.models.fields.TextField', [], {'default': "u''", 'blank': 'True'}),
+            'total_score': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['score.TotalScore']"}),
+            'value': ('django.db.models.fields.IntegerField', [], {'default': '1', 'db_index': 'True'}),
+            'voter': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['{SCORE_VOTER_MODEL}']".format(SCORE_VOTER_MODEL=SCORE_VOTER_MODEL)})
+        }
+    }
+
+    complete_apps = ['score']
@@ -27,6 +27,7 @@
    Models holding votes for objects of different types. Usage::
 
         TotalScore.get_value(object) -> int
+        TotalScore.get_values(objects) -> {object: int, ...}
         TotalScore.update(object, voter, value, [reason]) -> int
 """
 
@@ -35,34 +36,156 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import defaultdict
+from datetime import datetime
+from hashlib import md5
+import threading
+import time
+
+import django
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
+from django.core.cache import cache
 from django.db import models as db
+from django.db import connections, IntegrityError, router, transaction
 from django.utils.translation import ugettext_lazy as _
+try:
+    from django.utils.timezone import now
+except ImportError:
+    now = datetime.now
 
+from lck.django.common import nested_commit_on_success
 from lck.django.common.models import TimeTrackable
-from lck.django.score.signals import total_score_changed
+from lck.django.score.ranking import get_ranking
+from lck.django.score import signals
 
 
 SCORE_VOTER_MODEL = getattr(settings, 'SCORE_VOTER_MODEL', User)
+SCORE_STATS_TIMEOUT = getattr(settings, 'SCORE_STATS_TIMEOUT', 60 * 10)
+
+# lookups that `get_stats_for_model()` cases can use to be evaluated as
+# conditional sums in a single query instead of a separate COUNT query
+_LOOKUPS = ('exact', 'gt', 'gte', 'lt', 'lte', 'in', 'range', 'isnull')
+
+
+def _pk(value):
+    return getattr(value, 'pk', value)
+
+
+def _parse_vote_case(case):
+    """Returns a list of `(field, lookup, value)` conditions for `case` or
+    None if it uses lookups or related fields that can't be evaluated as
+    a conditional sum."""
+    conditions = []
+    for key, value in case.iteritems():
+        parts = key.split('__')
+        lookup = parts.pop() if len(parts) == 2 else 'exact'
+        if len(parts) != 1 or lookup not in _LOOKUPS:
+            return None
+        try:
+            field = Vote._meta.get_field(parts[0])
+        except db.FieldDoesNotExist:
+            return None
+        if lookup in ('in', 'range'):
+            value = [_pk(v) for v in value]
+        else:
+            value = _pk(value)
+        conditions.append((field, lookup, value))
+    return conditions
+
+
+def _case_sql(conditions, connection):
+    """Returns a ``CASE WHEN`` expression counting votes which meet all
+    `conditions` and its parameters. Values are prepared by the fields so
+    the database compares them like in a regular filter."""
+    table = connection.ops.quote_name(Vote._meta.db_table)
+    where = []
+    params = []
+    for field, lookup, value in conditions:
+        column = "{}.{}".format(table, connection.ops.quote_name(field.column))
+        if lookup == 'isnull':
+            where.append("{} IS {}NULL".format(column, "" if value else "NOT "))
+            continue
+        values = field.get_db_prep_lookup(lookup, value, connection=connection)
+        if lookup == 'in':
+            if not values:
+                where.append("1 = 0")
+                continue
+            where.append("{} IN ({})".format(column,
+                ", ".join(["%s"] * len(values))))
+        elif lookup == 'range':
+            where.append("{} BETWEEN %s AND %s".format(column))
+        else:
+            where.append("{} {}".format(column,
+                connection.operators[lookup] % "%s"))
+        params.extend(values)
+    return "CASE WHEN {} THEN 1 ELSE 0 END".format(" AND ".join(where) or
+        "1 = 1"), params
+
+
+def _stats_version(content_type_id):
+    key = "score::stats::version::{}".format(content_type_id)
+    version = cache.get(key)
+    if version is None:
+        # never start from a value that might have been used before
+        version = int(time.time() * 1000)
+        cache.add(key, version, 60 * 60 * 24 * 30)
+        # another process might have won the race
+        version = cache.get(key, version)
+    return version
+
+
+def _bump_stats_version(content_type_id):
+    try:
+        cache.incr("score::stats::version::{}".format(content_type_id))
+    except ValueError:
+        pass # no stats cached yet
+
+
+def _notify(content_type_id, object_id, value):
+    """Bumps the stats version and sends `total_score_changed`."""
+    _bump_stats_version(content_type_id)
+    signals.dispatch_total_score_changed(content_type_id, object_id, value)
+# changes made by `TotalScore.update()` inside transactions managed elsewhere
+_pending = threading.local()
+
+
+def _vote_counts(value):
+    """Returns the `(ups, downs)` contribution of a vote `value`."""
+    if not value:
+        return 0, 0
+    return (1, 0) if value > 0 else (0, 1)
 
 
 class TotalScore(db.Model):
     """Holds the integer `value` of the total score for votes on a specific
     `content_object`. The `value` is updated whenever a Vote object is created,
-    modified or deleted. Don't alter it directly."""
+    modified or deleted. Don't alter it directly.
+
+    Along with the `value`, the numbers of positive and negative votes are
+    kept, as well as a `rank` computed by the formula configured with
+    SCORE_RANKING (see `lck.django.score.ranking`)."""
     value = db.IntegerField(verbose_name=_("value"), default=0, db_index=True)
     content_type = db.ForeignKey(ContentType, verbose_name=_("Content type"),
         related_name="%(app_label)s_%(class)s_scores")
     object_id = db.IntegerField(verbose_name=_("Content type instance id"),
         db_index=True)
     content_object = GenericForeignKey()
+    created = db.DateTimeField(verbose_name=_("date created"), default=now)
+    ups = db.IntegerField(verbose_name=_("positive votes"), default=0)
+    downs = db.IntegerField(verbose_name=_("negative votes"), default=0)
+    rank = db.FloatField(verbose_name=_("rank"), default=0, db_index=True)
 
     class Meta:
         verbose_name = _("total score")
         verbose_name_plural = _("total scores")
+        unique_together = ('content_type', 'object_id')
+        if django.VERSION >= (1, 5):
+            # used by `get_ranked()`, earlier versions get it from migration
+            # 0003 or `create_rank_index()`
+            index_together = [('content_type', 'rank')]
 
     def __unicode__(self):
         return "Total score for ({}.id={}): {}".format(self.content_type,
@@ -72,19 +195,94 @@ class TotalScore(db.Model):
     def get_stats_for_model(cls, cases, model, instance=None, ct=None):
         """Returns a list of stats computed using the specified `cases` which
         are a sequence of filtering arguments for the TotalScore vote_set for
-        the specified model (and optionally: instance)."""
+        the specified model (and optionally: instance).
+
+        Cases using plain lookups on Vote fields are evaluated together in
+        a single query. Results are cached until a vote on any object of
+        `model` changes, at most for SCORE_STATS_TIMEOUT seconds."""
         if not ct:
             ct = ContentType.objects.get_for_model(model)
-        kwargs = {'total_score__content_type': ct}
-        if instance:
-            kwargs['total_score__object_id'] = instance.id
-        stats = []
-        for case in cases:
-            case.update(kwargs)
-            case_sum = Vote.objects.filter(**case).count()
-            stats.append(case_sum)
+        object_ids = None if not instance else [instance.id]
+        stats = cls._get_stats(cases, ct, object_ids)
+        result = [0] * len(cases)
+        for object_stats in stats.itervalues():
+            result = [a + b for a, b in zip(result, object_stats)]
+        return result
+
+    @classmethod
+    def get_stats_for_objects(cls, cases, objects):
+        """TotalScore.get_stats_for_objects(cases, objects) -> {object: [int, ...], ...}
+
+        Like `get_stats_for_model()` but returns stats for each of the
+        `objects` at once, using a single query per content type."""
+        objects_by_ct = defaultdict(list)
+        for obj in objects:
+            ct = ContentType.objects.get_for_model(obj.__class__)
+            objects_by_ct[ct].append(obj)
+        result = {}
+        for ct, ct_objects in objects_by_ct.iteritems():
+            stats = cls._get_stats(cases, ct, [obj.pk for obj in ct_objects])
+            for obj in ct_objects:
+                result[obj] = stats.get(obj.pk, [0] * len(cases))
+        return result
+
+    @classmethod
+    def _get_stats(cls, cases, ct, object_ids=None):
+        """Returns a cached `{object_id: [count, ...]}` dictionary for objects
+        of the given content type with votes matching any of the `cases`."""
+        if object_ids is not None:
+            object_ids = sorted(set(object_ids))
+        signature = repr((object_ids, [sorted((k, _pk(v)) for k, v in
+            case.iteritems()) for case in cases]))
+        key = "score::stats::{}::{}::{}".format(ct.id, _stats_version(ct.id),
+            md5(signature.encode('utf8')).hexdigest())
+        stats = cache.get(key)
+        if stats is None:
+            stats = cls._compute_stats(cases, ct, object_ids)
+            cache.set(key, stats, SCORE_STATS_TIMEOUT)
         return stats
 
+    @classmethod
+    def _compute_stats(cls, cases, ct, object_ids=None):
+        votes = Vote.objects.filter(total_score__content_type=ct)
+        if object_ids is not None:
+            votes = votes.filter(total_score__object_id__in=object_ids)
+        parsed = [_parse_vote_case(case) for case in cases]
+        stats = defaultdict(lambda: [0] * len(cases))
+        summed = [i for i, conditions in enumerate(parsed)
+            if conditions is not None]
+        if summed:
+            connection = connections[votes.db]
+            qn = connection.ops.quote_name
+            select = {}
+            select_params = []
+            for i in summed:
+                select['case_{}'.format(i)], params = _case_sql(parsed[i],
+                    connection)
+                select_params.extend(params)
+            names = ['case_{}'.format(i) for i in summed]
+            # Django puts extra selects into GROUP BY, so the sums are taken
+            # over a derived table grouped by the object only
+            votes_sql, params = votes.extra(select=select,
+                select_params=select_params).values_list(
+                'total_score__object_id', *names).order_by(
+                ).query.get_compiler(using=votes.db).as_sql()
+            cursor = connection.cursor()
+            cursor.execute("SELECT votes.{}, {} FROM ({}) votes GROUP BY "
+                "votes.{}".format(qn('object_id'), ", ".join(
+                "SUM(votes.{})".format(qn(name)) for name in names),
+                votes_sql, qn('object_id')), params)
+            for row in cursor.fetchall():
+                for i, count in zip(summed, row[1:]):
+                    stats[row[0]][i] = int(count or 0)
+        for i, conditions in enumerate(parsed):
+            if conditions is not None:
+                continue
+            for object_id, count in votes.filter(**cases[i]).values_list(
+                'total_score__object_id').annotate(db.Count('id')).order_by():
+                stats[object_id][i] = count
+        return dict(stats)
+
     @classmethod
     def get_value(cls, object, voter=None, ct=None):
         """TotalScore.get_value(object, [voter, ct]) -> int
@@ -101,6 +299,48 @@ class TotalScore(db.Model):
         except (cls.DoesNotExist, Vote.DoesNotExist):
             return 0
 
+    @classmethod
+    def get_ranked(cls, model):
+        """TotalScore.get_ranked(model) -> QuerySet
+
+        Returns total scores for objects of `model`, the highest ranked first.
+        Backed by an index on `(content_type, rank)`."""
+        ct = ContentType.objects.get_for_model(model)
+        return cls.objects.filter(content_type=ct).order_by('-rank')
+
+    @classmethod
+    def get_values(cls, objects, voter=None):
+        """TotalScore.get_values(objects, [voter]) -> {object: int, ...}
+
+        Returns current scores for all `objects` using a single query per
+        content type. Objects no-one voted for yet have a score of 0.
+
+        If `voter` is given, returns a `(scores, votes)` pair of dictionaries
+        where `votes` holds values voted by `voter` (0 for objects she didn't
+        vote for), fetched with one more query per content type."""
+        objects_by_ct = defaultdict(list)
+        for obj in objects:
+            ct = ContentType.objects.get_for_model(obj.__class__)
+            objects_by_ct[ct].append(obj)
+        scores = {}
+        votes = {}
+        for ct, ct_objects in objects_by_ct.iteritems():
+            ids = {obj.pk for obj in ct_objects}
+            values = dict(cls.objects.filter(content_type=ct,
+                object_id__in=ids).values_list('object_id', 'value'))
+            for obj in ct_objects:
+                scores[obj] = values.get(obj.pk, 0)
+            if voter is None:
+                continue
+            values = dict(Vote.objects.filter(voter=voter,
+                total_score__content_type=ct, total_score__object_id__in=ids
+            ).values_list('total_score__object_id', 'value'))
+            for obj in ct_objects:
+                votes[obj] = values.get(obj.pk, 0)
+        if voter is None:
+            return scores
+        return scores, votes
+
     @classmethod
     def update(cls, object, voter, value, reason="", ct=None):
         """TotalScore.update(object, voter, value, [reason, ct]) -> int
@@ -112,37 +352,114 @@ class TotalScore(db.Model):
         Other attempts to vote multiple times for a single `object` will be
         silently ignored.
 
+        The vote and the total are written in a single short transaction.
+        The total score row is locked first and changed with an F() UPDATE
+        so concurrent votes are never lost. Listeners are notified after the
+        transaction commits. Inside a transaction managed by the caller
+        nothing is sent until `notify_pending()` is called after commit.
+
         Conveniently returns the updated total score for the given object."""
-        try:
-            if not ct:
-                ct = ContentType.objects.get_for_model(object.__class__)
-            total_score = cls.objects.get(content_type=ct, object_id=object.id)
-        except cls.DoesNotExist:
-            # no-one voted before for that object
-            total_score = cls(content_object=object)
-            total_score.save()
-        if isinstance(voter, int):
-            voter = Vote.voter.field.rel.to.objects.get(pk=voter)
-        # TotalScore values in the database are updated automatically on
-        # vote creation, modification and deletion but the `total_score`
-        # instance we have will not. To avert returning a stale value we
-        # use a helper `result` variable.
-        result = total_score.value
-        try:
-            vote = Vote.objects.get(total_score=total_score,
-                voter=voter)
-            if -value == vote.value:
-                # we let people cancel existing votes
-                vote.delete()
-                result -= vote.value
-        except Vote.DoesNotExist:
-            if value: # don't create empty votes in the database
-                vote = Vote(total_score=total_score, voter=voter, value=value,
-                    reason=reason)
-                vote.save()
-                result += vote.value
+        if not ct:
+            ct = ContentType.objects.get_for_model(object.__class__)
+        voter_id = voter if isinstance(voter, int) else voter.pk
+        total_score_id = cls._get_or_create_id(ct, object.pk)
+        result, delta = cls._vote(total_score_id, voter_id, value, reason)
+        if delta:
+            if transaction.is_managed(using=router.db_for_write(cls)):
+                _pending.__dict__.setdefault('changes', set()).add((ct.id,
+                    object.pk))
+            else:
+                _notify(ct.id, object.pk, result)
         return result
 
+    @classmethod
+    def notify_pending(cls):
+        """Notifies listeners of changes made by `update()` inside
+        a transaction managed by the caller. Call it after commit."""
+        changes = _pending.__dict__.pop('changes', set())
+        values = defaultdict(int)
+        for ct_id in {key[0] for key in changes}:
+            values.update(((ct_id, object_id), value) for object_id, value in
+                cls.objects.filter(content_type=ct_id, object_id__in=[key[1]
+                for key in changes if key[0] == ct_id]).values_list(
+                'object_id', 'value'))
+        for ct_id, object_id in sorted(changes):
+            _notify(ct_id, object_id, values[ct_id, object_id])
+
+    @classmethod
+    def _get_id(cls, ct, object_id):
+        ids = list(cls.objects.filter(content_type=ct, object_id=object_id
+            ).values_list('id', flat=True)[:1])
+        return ids[0] if ids else None
+
+    @classmethod
+    def _get_or_create_id(cls, ct, object_id):
+        pk = cls._get_id(ct, object_id)
+        if pk is not None:
+            return pk
+        using = router.db_for_write(cls)
+        # inside an outer transaction only the failed INSERT may be rolled
+        # back, otherwise PostgreSQL refuses any further queries
+        sid = None
+        if transaction.is_managed(using=using):
+            sid = transaction.savepoint(using=using)
+        try:
+            pk = cls._create(ct, object_id)
+        except IntegrityError:
+            # someone voted for the object for the first time concurrently
+            if sid:
+                transaction.savepoint_rollback(sid, using=using)
+            return cls.objects.filter(content_type=ct, object_id=object_id
+                ).values_list('id', flat=True).get()
+        if sid:
+            transaction.savepoint_commit(sid, using=using)
+        return pk
+
+    @classmethod
+    @nested_commit_on_success
+    def _create(cls, ct, object_id):
+        return cls.objects.create(content_type=ct, object_id=object_id).pk
+
+    @classmethod
+    @nested_commit_on_success
+    def _vote(cls, total_score_id, voter_id, value, reason):
+        """Returns the new total and the change it went through. Votes are
+        written and deleted without sending Vote signals, the caller notifies
+        listeners once the transaction is committed."""
+        # the lock serializes votes on the object until commit, including
+        # repeated votes by the same voter
+        total, ups, downs, created = cls.objects.select_for_update(
+            ).values_list('value', 'ups', 'downs', 'created').get(
+            pk=total_score_id)
+        existing = Vote.objects.filter(total_score=total_score_id,
+            voter=voter_id).values_list('id', 'value')[:1]
+        if existing:
+            vote_id, vote_value = existing[0]
+            if -value != vote_value:
+                return total, 0
+            # we let people cancel existing votes
+            using = router.db_for_write(Vote)
+            qn = connections[using].ops.quote_name
+            connections[using].cursor().execute("DELETE FROM {} WHERE {} = %s"
+                "".format(qn(Vote._meta.db_table), qn(Vote._meta.pk.column)),
+                [vote_id])
+            delta = -vote_value
+            ups_delta, downs_delta = [-count for count in
+                _vote_counts(vote_value)]
+        elif value: # don't create empty votes in the database
+            Vote.objects.bulk_create([Vote(total_score_id=total_score_id,
+                voter_id=voter_id, value=value, reason=reason)])
+            delta = value
+            ups_delta, downs_delta = _vote_counts(value)
+        else:
+            return total, 0
+        rank = get_ranking()(total + delta, ups + ups_delta,
+            downs + downs_delta, created, now())
+        cls.objects.filter(pk=total_score_id).update(value=db.F('value') +
+            delta, ups=db.F('ups') + ups_delta,
+            downs=db.F('downs') + downs_delta, rank=rank)
+        return total + delta, delta
+
 
 class Vote(TimeTrackable):
     """A single vote. Total score value is updated upon creation and alteration
@@ -165,21 +482,41 @@ class Vote(TimeTrackable):
 
 
 def dispatch_total_score_changed(total_score):
-    total_score_changed.send_robust(sender=TotalScore,
-        content_object=total_score.content_object, value=total_score.value)
+    signals.dispatch_total_score_changed(total_score.content_type_id,
+        total_score.object_id, total_score.value)
+
+
+def _add_to_total_score(total_score, old_value, new_value):
+    diff = new_value - old_value
+    old_counts = _vote_counts(old_value)
+    new_counts = _vote_counts(new_value)
+    ups_diff = new_counts[0] - old_counts[0]
+    downs_diff = new_counts[1] - old_counts[1]
+    if not (diff or ups_diff or downs_diff):
+        return
+    scores = TotalScore.objects.filter(pk=total_score.pk)
+    scores.update(value=db.F('value') + diff, ups=db.F('ups') + ups_diff,
+        downs=db.F('downs') + downs_diff)
+    value, ups, downs, created = scores.values_list('value', 'ups',
+        'downs', 'created').get()
+    total_score.rank = get_ranking()(value, ups, downs, created, now())
+    scores.update(rank=total_score.rank)
+    total_score.value = value
+    total_score.ups = ups
+    total_score.downs = downs
+    _bump_stats_version(total_score.content_type_id)
 
 
 def vote_pre_save(sender, instance, **kwargs):
     """Alters the total score value for the created/modified Vote."""
     try:
-        existing = sender.objects.get(pk=instance.id)
-        diff = instance.value - existing.value
+        existing = sender.objects.filter(pk=instance.id).values_list('value',
+            flat=True).get()
         # if existing.voter != instance.voter is handled at the
         # `unique_together` level of Vote objects
     except sender.DoesNotExist:
-        diff = instance.value
-    instance.total_score.value += diff
-    instance.total_score.save()
+        existing = 0
+    _add_to_total_score(instance.total_score, existing, instance.value)
 db.signals.pre_save.connect(vote_pre_save, Vote)
 
 
@@ -191,7 +528,24 @@ db.signals.post_save.connect(vote_post_save, Vote)
 def vote_post_delete(sender, instance, **kwargs):
     """Decreases total score value by the value of the currently removed
     object."""
-    instance.total_score.value -= instance.value
-    instance.total_score.save()
+    _add_to_total_score(instance.total_score, instance.value, 0)
     dispatch_total_score_changed(instance.total_score)
 db.signals.post_delete.connect(vote_post_delete, Vote)
+
+
+def create_rank_index(sender, created_models, **kwargs):
+    """Creates the ``(content_type_id, rank)`` index on tables created by
+    ``syncdb`` (e.g. in tests) for Django versions without
+    ``Meta.index_together``."""
+    if django.VERSION >= (1, 5) or TotalScore not in created_models:
+        return
+    using = kwargs.get('db') or router.db_for_write(TotalScore)
+    qn = connections[using].ops.quote_name
+    table = TotalScore._meta.db_table
+    sql = "CREATE INDEX {} ON {} ({}, {})".format(
+        qn(table + '_content_type_id_rank'), qn(table),
+        qn(TotalScore._meta.get_field('content_type').column),
+        qn(TotalScore._meta.get_field('rank').column))
+    connections[using].cursor().execute(sql)
+    transaction.commit_unless_managed(using=using)
+db.signals.post_syncdb.connect(create_rank_index)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""lck.django.score.ranking
+   ------------------------
+
+   Ranking formulas for total scores. Each one is a function of
+   ``(value, ups, downs, created, now)`` returning a float, higher is better.
+   The one used is chosen by the ``SCORE_RANKING`` setting: a name from
+   ``RANKINGS`` or a dotted path to a custom function. Configured further by:
+
+   * ``SCORE_RANKING_EPOCH`` - a datetime from which ``hot`` counts time.
+     **Default**: 2012-01-01.
+
+   * ``SCORE_RANKING_HALF_LIFE`` - seconds after which ``half_life`` cuts the
+     value in half. **Default**: a day."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import calendar
+from datetime import datetime
+import math
+import time
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+
+SCORE_RANKING = getattr(settings, 'SCORE_RANKING', 'hot')
+SCORE_RANKING_EPOCH = getattr(settings, 'SCORE_RANKING_EPOCH',
+    datetime(2012, 1, 1))
+SCORE_RANKING_HALF_LIFE = getattr(settings, 'SCORE_RANKING_HALF_LIFE',
+    60 * 60 * 24)
+
+
+def timestamp(dt):
+    if dt.tzinfo is not None:
+        return calendar.timegm(dt.utctimetuple())
+    return time.mktime(dt.timetuple())
+
+
+def hot(value, ups, downs, created, now):
+    """Reddit's "hot" ranking: the order of magnitude of the score plus
+    a bonus for newer objects (one order of magnitude per 12.5 hours).
+    Doesn't change over time, so needs no periodic refresh."""
+    order = math.log10(max(abs(value), 1))
+    sign = 1 if value > 0 else -1 if value < 0 else 0
+    seconds = timestamp(created) - timestamp(SCORE_RANKING_EPOCH)
+    return round(sign * order + seconds / 45000, 7)
+
+
+def wilson(value, ups, downs, created, now):
+    """The lower bound of the Wilson score confidence interval (95%) for
+    the ratio of positive votes. Doesn't decay with time."""
+    n = ups + downs
+    if not n:
+        return 0.0
+    z = 1.96
+    p = ups / n
+    return ((p + z * z / (2 * n) - z * math.sqrt((p * (1 - p) + z * z /
+        (4 * n)) / n)) / (1 + z * z / n))
+
+
+def half_life(value, ups, downs, created, now):
+    """The value halved every SCORE_RANKING_HALF_LIFE seconds since the
+    object received its first vote. Changes over time, so rankings have to
+    be refreshed periodically with the ``recompute_score_ranks`` command."""
+    age = max(timestamp(now) - timestamp(created), 0)
+    return value * 0.5 ** (age / SCORE_RANKING_HALF_LIFE)
+
+
+RANKINGS = {
+    'hot': hot,
+    'wilson': wilson,
+    'half_life': half_life,
+}
+
+
+def get_ranking():
+    """Returns the ranking function configured by SCORE_RANKING."""
+    if SCORE_RANKING in RANKINGS:
+        return RANKINGS[SCORE_RANKING]
+    module, func = SCORE_RANKING.rsplit('.', 1)
+    return getattr(import_module(module), func)
@@ -21,12 +21,127 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+"""lck.django.score.signals
+   ------------------------
+
+   The ``total_score_changed`` signal is sent with ``content_type_id``,
+   ``object_id`` and ``value`` arguments. A lazy ``content_object`` is passed
+   as well and hits the database only when used.
+
+   Configured by these values in ``settings.py``:
+
+   * ``SCORE_DISPATCH_MODE`` - ``"sync"`` sends the signal right after
+     a vote, ``"thread"`` sends it from a pool of
+     ``SCORE_DISPATCH_THREADS`` in-process threads, ``"rq"`` and
+     ``"celery"`` send it from a task queue worker. **Default**: ``"sync"``.
+
+   * ``SCORE_DISPATCH_COALESCE`` - in asynchronous modes, changes to the
+     same object made while a dispatch is still pending are coalesced
+     into it for at most this many seconds. The receivers get the latest
+     value. 0 disables coalescing. **Default**: 5 seconds.
+
+   * ``SCORE_TASK_EXPIRATION`` - expiration of queued tasks in seconds.
+     **Default**: 30 seconds."""
+
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from multiprocessing.pool import ThreadPool
+import threading
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
 from django.dispatch import Signal
+from django.utils.functional import SimpleLazyObject
+
+
+total_score_changed = Signal(providing_args=["content_type_id", "object_id",
+    "value", "content_object"])
+
+
+class OptionBag(object): pass
+SCORE_DISPATCH_MODE = getattr(settings, 'SCORE_DISPATCH_MODE', 'sync')
+SCORE_DISPATCH_THREADS = getattr(settings, 'SCORE_DISPATCH_THREADS', 2)
+SCORE_DISPATCH_COALESCE = getattr(settings, 'SCORE_DISPATCH_COALESCE', 5)
+SCORE_TASK_EXPIRATION = getattr(settings, 'SCORE_TASK_EXPIRATION', 30)
+if SCORE_DISPATCH_MODE == 'sync':
+    def maybe_async(function):
+        result = OptionBag()
+        result.delay = function
+        return result
+elif SCORE_DISPATCH_MODE == 'thread':
+    _pool = []
+    _pool_lock = threading.Lock()
+
+    def _run_in_thread(function, *args):
+        try:
+            function(*args)
+        finally:
+            # pool threads open their own connections, don't leak them
+            for connection in connections.all():
+                connection.close()
+
+    def maybe_async(function):
+        def delay(*args):
+            with _pool_lock:
+                if not _pool:
+                    _pool.append(ThreadPool(SCORE_DISPATCH_THREADS))
+            _pool[0].apply_async(_run_in_thread, (function,) + args)
+        result = OptionBag()
+        result.delay = delay
+        return result
+elif SCORE_DISPATCH_MODE == 'rq':
+    from django_rq import job
+    maybe_async = job(
+        'score',
+        timeout=SCORE_TASK_EXPIRATION,
+        result_ttl=SCORE_TASK_EXPIRATION,
+    )
+elif SCORE_DISPATCH_MODE == 'celery':
+    import celery
+    maybe_async = celery.task(
+        expires=SCORE_TASK_EXPIRATION,
+    )
+else:
+    raise ImproperlyConfigured("Unknown SCORE_DISPATCH_MODE: {!r}. Use "
+        "'sync', 'thread', 'rq' or 'celery'.".format(SCORE_DISPATCH_MODE))
+coalescing = SCORE_DISPATCH_MODE != 'sync' and SCORE_DISPATCH_COALESCE > 0
+
+
+def _pending_key(content_type_id, object_id):
+    return "score::dispatch::{}::{}".format(content_type_id, object_id)
+
+
+def _get_object(content_type_id, object_id):
+    ct = ContentType.objects.get_for_id(content_type_id)
+    return ct.get_object_for_this_type(pk=object_id)
+
+
+@maybe_async
+def send_total_score_changed(content_type_id, object_id, value):
+    from lck.django.score.models import TotalScore
+    if coalescing:
+        cache.delete(_pending_key(content_type_id, object_id))
+        # changes coalesced into this dispatch came with newer values
+        values = list(TotalScore.objects.filter(content_type=content_type_id,
+            object_id=object_id).values_list('value', flat=True)[:1])
+        if values:
+            value = values[0]
+    total_score_changed.send_robust(sender=TotalScore,
+        content_type_id=content_type_id, object_id=object_id, value=value,
+        content_object=SimpleLazyObject(lambda: _get_object(content_type_id,
+            object_id)))
 
 
-total_score_changed = Signal(providing_args=["content_object", "value"])
+def dispatch_total_score_changed(content_type_id, object_id, value):
+    """Sends `total_score_changed` for the given object according to
+    SCORE_DISPATCH_MODE."""
+    if coalescing and not cache.add(_pending_key(content_type_id, object_id),
+        True, SCORE_DISPATCH_COALESCE):
+        return # a pending dispatch will send the latest value
+    send_total_score_changed.delay(content_type_id, object_id, value)
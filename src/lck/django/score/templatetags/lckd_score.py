@@ -40,6 +40,8 @@ from lck.django.score.models import TotalScore
 
 register = template.Library()
 
+PREFETCHED_SCORES = '_lckd_prefetched_scores'
+
 
 class ScoreNode(template.Node):
     """Base score node. Some contenttypes related code taken from
@@ -70,7 +72,7 @@ class ScoreNode(template.Node):
     def lookup_content_type(token, tagname):
         try:
             app, model = token.split('.')
-            return ContentType.objects.get(app_label=app, model=model)
+            return ContentType.objects.get_by_natural_key(app, model)
         except ValueError:
             raise template.TemplateSyntaxError("Third argument in %r must be "
                 "in the format 'app.model'" % tagname)
@@ -102,7 +104,7 @@ class ScoreNode(template.Node):
                 raise template.TemplateSyntaxError("Fourth argument in %r must"
                     " be 'as'" % tokens[0])
             return cls(
-                ctype = BaseCommentNode.lookup_content_type(tokens[2],
+                ctype = cls.lookup_content_type(tokens[2],
                     tokens[0]),
                 object_pk_expr = parser.compile_filter(tokens[3]),
                 as_varname = tokens[5]
@@ -115,7 +117,11 @@ class ScoreNode(template.Node):
     def render(self, context):
         return ''
 
-    def get_score_value(self, ctype, object_pk):
+    def get_score_value(self, ctype, object_pk, context=None):
+        prefetched = context.get(PREFETCHED_SCORES) if context else None
+        key = (ctype.id, smart_unicode(object_pk))
+        if prefetched and key in prefetched:
+            return prefetched[key]
         try:
             return self.model.objects.get(content_type=ctype,
                 object_id=smart_unicode(object_pk)).value
@@ -130,7 +136,8 @@ class GetScoreValueNode(ScoreNode):
     def render(self, context):
         ctype, object_pk = self.get_target_ctype_pk(context)
         if object_pk:
-            context[self.as_varname] = self.get_score_value(ctype, object_pk)
+            context[self.as_varname] = self.get_score_value(ctype, object_pk,
+                context)
         return ''
 
 
@@ -172,7 +179,8 @@ class RenderScoreNode(ScoreNode):
             ]
             vars = {'ct': ctype, 'object_id': object_pk}
             try:
-                vars['score'] = self.get_score_value(ctype, object_pk)
+                vars['score'] = self.get_score_value(ctype, object_pk,
+                    context)
             except self.model.DoesNotExist:
                 vars['score'] = 0
             context.push()
@@ -182,6 +190,56 @@ class RenderScoreNode(ScoreNode):
         else:
             return ''
 
+class PrefetchScoresNode(template.Node):
+    """Loads scores for a list of objects into the context."""
+
+    def __init__(self, objects_expr):
+        self.objects_expr = objects_expr
+
+    @classmethod
+    def handle_token(cls, parser, token):
+        """Class method to parse prefetch_scores and return a Node."""
+        tokens = token.contents.split()
+        if len(tokens) != 3 or tokens[1] != 'for':
+            raise template.TemplateSyntaxError("%r tag must be used as "
+                "{%% %s for [object_list] %%}" % (tokens[0], tokens[0]))
+        return cls(parser.compile_filter(tokens[2]))
+
+    def render(self, context):
+        try:
+            objects = self.objects_expr.resolve(context)
+        except template.VariableDoesNotExist:
+            return ''
+        if not objects:
+            return ''
+        prefetched = dict(context.get(PREFETCHED_SCORES) or {})
+        for obj, value in TotalScore.get_values(objects).iteritems():
+            ctype = ContentType.objects.get_for_model(obj)
+            prefetched[ctype.id, smart_unicode(obj.pk)] = value
+        context[PREFETCHED_SCORES] = prefetched
+        return ''
+
+@register.tag
+def prefetch_scores(parser, token):
+    """
+    Loads score values for all objects in the given list with a single query
+    per content type. ``get_score_value`` and ``render_score`` tags used
+    later at the same or a nested template level read them from memory.
+
+    Syntax::
+
+        {% prefetch_scores for [object_list] %}
+
+    Example usage::
+
+        {% prefetch_scores for comment_list %}
+        {% for comment in comment_list %}
+            {% render_score for comment %}
+        {% endfor %}
+
+    """
+    return PrefetchScoresNode.handle_token(parser, token)
+
 @register.tag
 def get_score_value(parser, token):
     """
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Tests for voting."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from multiprocessing.pool import ThreadPool
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils.unittest import skipIf, skipUnless
+
+from lck.django.score import signals, views
+from lck.django.score.models import TotalScore, Vote
+
+
+VOTER_IS_USER = Vote.voter.field.rel.to is User
+
+
+def make_users(count, prefix='voter'):
+    User.objects.bulk_create([User(username='{}{}'.format(prefix, i))
+        for i in xrange(count)])
+    return list(User.objects.filter(username__startswith=prefix))
+
+
+@skipUnless(VOTER_IS_USER, "Requires SCORE_VOTER_MODEL to be auth.User.")
+class TestVoting(TestCase):
+    def test_update(self):
+        target, voter, other = make_users(3)
+        self.assertEqual(TotalScore.update(target, voter, 1), 1)
+        # repeated votes are ignored
+        self.assertEqual(TotalScore.update(target, voter, 1), 1)
+        self.assertEqual(TotalScore.update(target, other.pk, 1), 2)
+        # votes can be cancelled
+        self.assertEqual(TotalScore.update(target, voter, -1), 1)
+        self.assertEqual(TotalScore.get_value(target), 1)
+        self.assertEqual(Vote.objects.count(), 1)
+        self.assertEqual(TotalScore.update(target, voter, 0), 1)
+        self.assertEqual(Vote.objects.count(), 1)
+
+    def test_concurrent_first_vote(self):
+        target, voter, other = make_users(3)
+        # another voter created the total score after it was looked up
+        ct = ContentType.objects.get_for_model(User)
+        TotalScore.objects.create(content_type=ct, object_id=target.pk)
+        get_id = TotalScore.__dict__['_get_id']
+        TotalScore._get_id = staticmethod(lambda ct, object_id: None)
+        try:
+            self.assertEqual(TotalScore.update(target, voter, 1), 1)
+        finally:
+            TotalScore._get_id = get_id
+        # the transaction is still usable
+        self.assertEqual(TotalScore.update(target, other, 1), 2)
+        self.assertEqual(TotalScore.objects.count(), 1)
+
+    def test_vote_signals(self):
+        target, voter = make_users(2)
+        TotalScore.update(target, voter, 2)
+        vote = Vote.objects.get()
+        vote.value = 5
+        vote.save()
+        self.assertEqual(TotalScore.get_value(target), 5)
+        vote.delete()
+        self.assertEqual(TotalScore.get_value(target), 0)
+
+    def test_notify_pending(self):
+        target, voter = make_users(2)
+        received = []
+
+        def receiver(sender, object_id, value, **kwargs):
+            received.append((object_id, value))
+        signals.total_score_changed.connect(receiver)
+        try:
+            # test cases run inside a managed transaction
+            TotalScore.update(target, voter, 2)
+            TotalScore.update(target, voter, -2)
+            self.assertEqual(received, [])
+            TotalScore.notify_pending()
+            TotalScore.notify_pending()
+        finally:
+            signals.total_score_changed.disconnect(receiver)
+        self.assertEqual(received, [(target.pk, 0)])
+        score = TotalScore.objects.get(object_id=target.pk)
+        self.assertEqual((score.value, score.ups, score.downs), (0, 0, 0))
+        self.assertFalse(Vote.objects.exists())
+
+    def test_get_values(self):
+        first, second, third, voter = make_users(4)
+        TotalScore.update(first, voter, 1)
+        TotalScore.update(second, third, -1)
+        TotalScore.update(second, voter, 3)
+        objects = [first, second, third]
+        with self.assertNumQueries(1):
+            self.assertEqual(TotalScore.get_values(objects),
+                {first: 1, second: 2, third: 0})
+        with self.assertNumQueries(2):
+            scores, votes = TotalScore.get_values(objects, voter=voter)
+        self.assertEqual(votes, {first: 1, second: 3, third: 0})
+
+    def test_stats(self):
+        first, second, voter, other = make_users(4)
+        TotalScore.update(first, voter, 1)
+        TotalScore.update(first, other, -1)
+        TotalScore.update(second, voter, 2)
+        cases = [{'value__gt': 0}, {'value__lt': 0}, {'voter': voter},
+            {'voter__username': other.username}]
+        with self.assertNumQueries(2):
+            self.assertEqual(TotalScore.get_stats_for_model(cases, User),
+                [2, 1, 2, 1])
+        self.assertEqual(cases[0], {'value__gt': 0})
+        # values are compared by the database, like in filters
+        self.assertEqual(TotalScore.get_stats_for_model([{'value': '2'},
+            {'voter__in': [voter.pk, other.pk]}], User), [1, 3])
+        self.assertEqual(TotalScore.get_stats_for_model(cases, User,
+            instance=first), [1, 1, 1, 1])
+        TotalScore.update(second, other, 1)
+        self.assertEqual(TotalScore.get_stats_for_objects(cases[:2],
+            [first, second, voter]), {first: [1, 1], second: [2, 0],
+            voter: [0, 0]})
+
+    def test_ranking(self):
+        first, second, voter, other = make_users(4)
+        TotalScore.update(first, voter, 1)
+        TotalScore.update(second, voter, 1)
+        TotalScore.update(second, other, 1)
+        TotalScore.update(first, other, -1)
+        score = TotalScore.objects.get(object_id=first.pk)
+        self.assertEqual((score.value, score.ups, score.downs), (0, 1, 1))
+        self.assertEqual([s.object_id for s in TotalScore.get_ranked(User)],
+            [second.pk, first.pk])
+        TotalScore.update(first, other, 1)
+        score = TotalScore.objects.get(object_id=first.pk)
+        self.assertEqual((score.value, score.ups, score.downs), (1, 1, 0))
+
+    def test_vote_rate_limit(self):
+        voter, = make_users(1)
+        cache.delete(views._vote_key(voter))
+        now = 1000000.0
+        allowed = [views._vote_allowed(voter, now=now)
+            for i in xrange(views.SCORE_VOTE_BURST + 1)]
+        self.assertEqual(allowed.count(True), views.SCORE_VOTE_BURST)
+        self.assertFalse(allowed[-1])
+        # refills one token at a time, not a whole window at once
+        now += 1 / views.SCORE_VOTE_RATE
+        self.assertTrue(views._vote_allowed(voter, now=now))
+        self.assertFalse(views._vote_allowed(voter, now=now))
+        # never above the burst size
+        now += 1000 / views.SCORE_VOTE_RATE
+        allowed = [views._vote_allowed(voter, now=now)
+            for i in xrange(views.SCORE_VOTE_BURST + 1)]
+        self.assertEqual(allowed.count(True), views.SCORE_VOTE_BURST)
+
+
+@skipUnless(VOTER_IS_USER, "Requires SCORE_VOTER_MODEL to be auth.User.")
+@skipIf(connection.vendor == 'sqlite',
+        "Concurrent connections are not supported by the test database.")
+class TestConcurrentVoting(TransactionTestCase):
+    def test_parallel_votes(self):
+        target, = make_users(1, prefix='target')
+        voters = make_users(300)
+
+        def vote(voter):
+            try:
+                return TotalScore.update(target, voter, 1)
+            finally:
+                connection.close()
+
+        pool = ThreadPool(20)
+        try:
+            results = pool.map(vote, voters)
+        finally:
+            pool.terminate()
+        self.assertEqual(sorted(results), range(1, len(voters) + 1))
+        self.assertEqual(TotalScore.get_value(target), len(voters))
+        self.assertEqual(TotalScore.objects.count(), 1)
+        self.assertEqual(Vote.objects.count(), len(voters))
@@ -31,4 +31,6 @@ from django.conf.urls.defaults import *
 urlpatterns = patterns('lck.django.score.views',
     url(r'^(?P<content_type>\d+)/(?P<object_id>\d+)/$', 'show_score', name='show'),
     url(r'^(?P<content_type>\d+)/(?P<object_id>\d+)/(?P<value>-?\d+)/$', 'update_score', name='update'),
+    url(r'^(?P<content_type>\d+)/(?P<object_id>\d+)/json/$', 'show_score_json', name='show_json'),
+    url(r'^(?P<content_type>\d+)/(?P<object_id>\d+)/(?P<value>-?\d+)/json/$', 'update_score_json', name='update_json'),
 )
@@ -31,16 +31,119 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import math
+import time
+
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_POST
 
 from lck.django.common import render_decorator as render
-from lck.django.common import redirect
+from lck.django.common import redirect, render_json
 from lck.django.score.models import TotalScore, Vote
 
+
+SCORE_OBJECT_CACHE_TIMEOUT = getattr(settings, 'SCORE_OBJECT_CACHE_TIMEOUT',
+    60)
+SCORE_EXISTING_CACHE_TIMEOUT = getattr(settings,
+    'SCORE_EXISTING_CACHE_TIMEOUT', 5)
+SCORE_TOTAL_CACHE_TIMEOUT = getattr(settings, 'SCORE_TOTAL_CACHE_TIMEOUT', 5)
+SCORE_VOTE_BURST = getattr(settings, 'SCORE_VOTE_BURST', 10)
+SCORE_VOTE_RATE = getattr(settings, 'SCORE_VOTE_RATE', 0.5)
+SCORE_VOTE_LOCK_TIMEOUT = getattr(settings, 'SCORE_VOTE_LOCK_TIMEOUT', 5)
+
+
+def _get_voter(request, voter=None):
+    if voter:
+        return voter
+    voter_model = Vote.voter.field.rel.to
+    if voter_model is User:
+        return request.user
+    voter = request.user.get_profile()
+    if voter_model is not voter.__class__:
+        raise ImproperlyConfigured("voter not passed to the"
+            "`update_score()` view. Write a `process_view()` "
+            "middleware to pass it. This is not required if the voter "
+            "model is `User` or `user_instance.get_profile()`.")
+    return voter
+
+
+def _vote_key(voter):
+    return "score::votes::{}".format(voter.pk)
+
+
+def _vote_allowed(voter, now=None):
+    """Takes a token from the voter's bucket. The bucket holds up to
+    SCORE_VOTE_BURST tokens and refills with SCORE_VOTE_RATE tokens per
+    second. Returns False if the bucket is empty.
+
+    The bucket is a ``(tokens, timestamp)`` pair in the cache, read and
+    written under a short lock taken with `cache.add()`. A vote arriving while
+    another vote of the same voter holds the lock is rejected, only clients
+    voting in parallel are affected by that."""
+    if not SCORE_VOTE_RATE:
+        return True
+    key = _vote_key(voter)
+    if not cache.add(key + '::lock', True, SCORE_VOTE_LOCK_TIMEOUT):
+        return False
+    try:
+        if now is None:
+            now = time.time()
+        tokens, timestamp = cache.get(key) or (SCORE_VOTE_BURST, now)
+        tokens = min(SCORE_VOTE_BURST,
+            tokens + max(0, now - timestamp) * SCORE_VOTE_RATE)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # a bucket left alone for that long is full again, the same as
+        # a missing one
+        cache.set(key, (tokens, now),
+            int(math.ceil(SCORE_VOTE_BURST / SCORE_VOTE_RATE)) + 1)
+        return allowed
+    finally:
+        cache.delete(key + '::lock')
+
+
+def _rate_limited():
+    return HttpResponse("Too many votes, slow down.", status=429,
+        mimetype="text/plain")
+
+
+def _get_lazy_object(content_type, object_id):
+    """Returns an unsaved instance with only the primary key set for an
+    object that exists in the database. Objects that don't exist are
+    remembered for SCORE_OBJECT_CACHE_TIMEOUT seconds so repeated requests
+    for them don't query the database. Existing objects are remembered only
+    for SCORE_EXISTING_CACHE_TIMEOUT seconds, which is how long a deleted
+    object can still be voted on."""
+    try:
+        model = ContentType.objects.get_for_id(content_type).model_class()
+    except ContentType.DoesNotExist:
+        raise Http404
+    if model is None:
+        raise Http404
+    key = "score::exists::{}::{}".format(content_type, object_id)
+    exists = cache.get(key)
+    if exists is None:
+        exists = model._default_manager.filter(pk=object_id).exists()
+        cache.set(key, exists, SCORE_EXISTING_CACHE_TIMEOUT if exists else
+            SCORE_OBJECT_CACHE_TIMEOUT)
+    if not exists:
+        raise Http404
+    return model(pk=object_id)
+
+
+def _total_key(content_type, object_id):
+    return "score::total::{}::{}".format(content_type, object_id)
+
+
 @render
 def show_score(request, content_type, object_id):
     template = 'score/show.html'
@@ -51,19 +154,42 @@ def show_score(request, content_type, object_id):
 
 @login_required
 def update_score(request, content_type, object_id, value, voter=None):
-    if not voter:
-        voter_model = Vote.voter.field.rel.to
-        if voter_model is User:
-            voter = request.user
-        else:
-            voter = request.user.get_profile()
-            if voter_model is not voter.__class__:
-                raise ImproperlyConfigured("voter not passed to the"
-                    "`update_score()` view. Write a `process_view()` "
-                    "middleware to pass it. This is not required if the voter "
-                    "model is `User` or `user_instance.get_profile()`.")
+    voter = _get_voter(request, voter)
     ct = get_object_or_404(ContentType, pk=int(content_type))
     obj = get_object_or_404(ct.model_class(), pk=int(object_id))
     score = TotalScore.update(obj, voter, int(value), ct=ct)
+    cache.set(_total_key(ct.id, obj.pk), score, SCORE_TOTAL_CACHE_TIMEOUT)
     return redirect(request, reverse('lckd-score:show',
         args=[int(content_type), int(object_id)]))
+
+def show_score_json(request, content_type, object_id):
+    """Returns the score of an object as JSON. Totals are cached for
+    SCORE_TOTAL_CACHE_TIMEOUT seconds."""
+    content_type, object_id = int(content_type), int(object_id)
+    score = cache.get(_total_key(content_type, object_id))
+    if score is None:
+        _get_lazy_object(content_type, object_id)
+        scores = TotalScore.objects.filter(content_type=content_type,
+            object_id=object_id).values_list('value', flat=True)[:1]
+        score = scores[0] if scores else 0
+        cache.set(_total_key(content_type, object_id), score,
+            SCORE_TOTAL_CACHE_TIMEOUT)
+    return render_json({'content_type': content_type, 'object_id': object_id,
+        'score': score})
+
+@require_POST
+@login_required
+def update_score_json(request, content_type, object_id, value, voter=None):
+    """Votes for an object and returns its new score as JSON. The object is
+    not fetched from the database."""
+    voter = _get_voter(request, voter)
+    if not _vote_allowed(voter):
+        return _rate_limited()
+    content_type, object_id = int(content_type), int(object_id)
+    obj = _get_lazy_object(content_type, object_id)
+    score = TotalScore.update(obj, voter, int(value),
+        ct=ContentType.objects.get_for_id(content_type))
+    cache.set(_total_key(content_type, object_id), score,
+        SCORE_TOTAL_CACHE_TIMEOUT)
+    return render_json({'content_type': content_type, 'object_id': object_id,
+        'score': score})
@@ -26,73 +26,82 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import re
+import unicodedata
 
-def parse_tag_input(tagstring):
+
+# either an unquoted run, or a quoted run with an optional closing quote
+# (only missing if the quote is never closed)
+TAG_TOKEN_REGEX = re.compile(r'([^"]+)|"([^"]*)("?)')
+
+def parse_tag_input(tagstring, normalize=None):
     """Returns a sorted list of unique tag stems. Parses a specified
     `tagstring`, with multiple word input being activated and
     delineated by commas and double quotes. Quotes take precedence, so
     they may contain commas. If the `tagstring` doesn't contain any commas,
     unquoted spaces are treated as tag divisors as well.
 
-    Ported from Jonathan Buchanan's
+    If `normalize` is given, it's called on every tag. Tags for which it
+    returns an empty value are dropped. See `make_tag_normalizer()`.
+
+    Semantics ported from Jonathan Buchanan's
     `django-tagging <http://django-tagging.googlecode.com/>`_"""
 
     if not tagstring:
         return []
 
-    if ',' not in tagstring and '"' not in tagstring:
-        words = list(set(split_strip(tagstring, ' ')))
-        words.sort()
-        return words
-
-    words = []
-    buffer = []
-    # Defer splitting of non-quoted sections until we know if there are
-    # any unquoted commas.
-    to_be_split = []
-    saw_loose_comma = False
-    open_quote = False
-    i = iter(tagstring)
-    try:
-        while True:
-            c = i.next()
-            if c == '"':
-                if buffer:
-                    to_be_split.append(''.join(buffer))
-                    buffer = []
-                # Find the matching quote
-                open_quote = True
-                c = i.next()
-                while c != '"':
-                    buffer.append(c)
-                    c = i.next()
-                if buffer:
-                    word = ''.join(buffer).strip()
-                    if word:
-                        words.append(word)
-                    buffer = []
-                open_quote = False
-            else:
-                if not saw_loose_comma and c == ',':
-                    saw_loose_comma = True
-                buffer.append(c)
-    except StopIteration:
-        # If we were parsing an open quote which was never closed treat
-        # the buffer as unquoted.
-        if buffer:
-            if open_quote and ',' in buffer:
-                saw_loose_comma = True
-            to_be_split.append(''.join(buffer))
-    if to_be_split:
-        if saw_loose_comma:
+    if '"' not in tagstring:
+        words = split_strip(tagstring, ',' if ',' in tagstring else ' ')
+    else:
+        words = []
+        # Defer splitting of non-quoted sections until we know if there are
+        # any unquoted commas.
+        to_be_split = []
+        for unquoted, quoted, closed in TAG_TOKEN_REGEX.findall(tagstring):
+            if unquoted:
+                to_be_split.append(unquoted)
+            elif closed:
+                quoted = quoted.strip()
+                if quoted:
+                    words.append(quoted)
+            elif quoted:
+                # A quote which was never closed is treated as unquoted.
+                to_be_split.append(quoted)
+        if any(',' in chunk for chunk in to_be_split):
             delimiter = ','
         else:
             delimiter = ' '
         for chunk in to_be_split:
             words.extend(split_strip(chunk, delimiter))
-    words = list(set(words))
-    words.sort()
-    return words
+    if normalize:
+        words = [w for w in (normalize(w) for w in words) if w]
+    return sorted(set(words))
+
+
+def parse_tag_inputs(tagstrings, normalize=None):
+    """Generates results of `parse_tag_input()` for every string in the
+    `tagstrings` iterable. Useful for bulk imports."""
+    for tagstring in tagstrings:
+        yield parse_tag_input(tagstring, normalize)
+
+
+def make_tag_normalizer(lower=True, form='NFC', max_length=None):
+    """Returns a function usable as `normalize` in `parse_tag_input()`.
+    It lowercases tags if `lower` is True, applies the Unicode
+    normalization `form` (if any) and cuts tags longer than `max_length`
+    characters."""
+
+    def normalize(word):
+        if form:
+            word = unicodedata.normalize(form, word)
+        if lower:
+            word = word.lower()
+        if max_length:
+            word = word[:max_length].strip()
+        return word
+
+    return normalize
+
 
 def split_strip(string, delimiter=','):
     """Splits ``string`` on ``delimiter``, stripping each resulting string
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from optparse import make_option
+import os
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from lck.django.tags.models import Tag
+from lck.django.tags.similarity import (begin_build, changed_since,
+    save_matrices, StemMatrix, TAG_SIMILARITY_MATRIX_PATH)
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--path', dest='path', default=TAG_SIMILARITY_MATRIX_PATH,
+            help='Where to store the matrices. By default the value of the '
+            'TAG_SIMILARITY_MATRIX_PATH setting.'),
+        make_option('--if-changed', action='store_true', dest='if_changed',
+            help='Only rebuild the matrices if tags changed since they were '
+            'built.'),
+    )
+    help = ("Precomputes stem-by-object matrices used by "
+            "`similar_objects()` on taggable models.")
+
+    def handle_noargs(self, **options):
+        path = options.get('path')
+        if not path:
+            raise CommandError("No path given and the "
+                "TAG_SIMILARITY_MATRIX_PATH setting is not set.")
+        if options.get('if_changed') and os.path.exists(path) and \
+            changed_since(os.path.getmtime(path)) is None:
+            print("Matrices in {} are up to date.".format(path))
+            return
+        built = begin_build()
+        matrices = {
+            False: StemMatrix.from_tags(Tag.objects.all()),
+            True: StemMatrix.from_tags(Tag.objects.filter(official=True)),
+        }
+        save_matrices(matrices, path, built)
+        print("Stored {} objects tagged with {} stems in {}.".format(
+            len(matrices[False].keys), len(matrices[False].stem_columns), path))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import models as db
+from django.db import connections, router, transaction
+
+from lck.django.tags.models import Tag, TagStem, TagStemSummary
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            help='Only report drifted counts, change nothing.'),
+    )
+    help = ("Recomputes tag counts on all stems and tag cloud summaries from "
+            "existing tags and removes stems without tags.")
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        actual = dict(Tag.objects.filter(stem__isnull=False).values_list(
+            'stem').annotate(db.Count('id')).order_by())
+        drifted = unused = 0
+        for stem_id, tag_count in TagStem.objects.values_list('id',
+            'tag_count'):
+            if actual.get(stem_id, 0) != tag_count:
+                drifted += 1
+            if stem_id not in actual:
+                unused += 1
+        summary = self.get_summary_deltas()
+        print("{} stems with drifted counts, {} stems without tags, {} "
+            "drifted tag cloud summaries.".format(drifted, unused,
+            len(summary)))
+        if options.get('dry_run'):
+            return
+        # the counts read above are only a report; every count is recomputed
+        # by the database in the same statement that stores it so concurrent
+        # tag changes are never counted twice
+        self.rebuild_stem_counts()
+        TagStem.objects.delete_unused()
+        self.rebuild_summaries()
+        TagStemSummary.invalidate_clouds({key[1] for key in summary})
+
+    def execute_sql(self, sql, params=()):
+        using = router.db_for_write(TagStem)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        tag_field = lambda name: qn(Tag._meta.get_field(name).column)
+        summary_field = lambda name: qn(
+            TagStemSummary._meta.get_field(name).column)
+        connection.cursor().execute(sql.format(
+            stem=qn(TagStem._meta.db_table), tag=qn(Tag._meta.db_table),
+            summary=qn(TagStemSummary._meta.db_table),
+            id=qn(TagStem._meta.pk.column), tag_count=qn('tag_count'),
+            official_count=qn('official_count'),
+            official=tag_field('official'),
+            language=qn('language'), stem_id=tag_field('stem'),
+            content_type_id=tag_field('content_type'),
+            summary_stem_id=summary_field('stem_id'),
+            summary_content_type_id=summary_field('content_type')), params)
+
+    def rebuild_stem_counts(self):
+        self.execute_sql("UPDATE {stem} SET {tag_count} = (SELECT COUNT(*) "
+            "FROM {tag} WHERE {tag}.{stem_id} = {stem}.{id})")
+
+    def rebuild_summaries(self):
+        tagged = ("{tag}.{stem_id} = {summary}.{summary_stem_id} AND "
+            "{tag}.{content_type_id} = {summary}.{summary_content_type_id}")
+        self.execute_sql("INSERT INTO {summary} ({summary_stem_id}, "
+            "{summary_content_type_id}, {language}, {tag_count}, "
+            "{official_count}) SELECT {tag}.{stem_id}, "
+            "{tag}.{content_type_id}, MIN({tag}.{language}), 0, 0 FROM {tag} "
+            "WHERE {tag}.{stem_id} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM "
+            "{summary} WHERE " + tagged + ") GROUP BY {tag}.{stem_id}, "
+            "{tag}.{content_type_id}")
+        self.execute_sql("UPDATE {summary} SET {tag_count} = (SELECT COUNT(*) "
+            "FROM {tag} WHERE " + tagged + "), {official_count} = (SELECT "
+            "COUNT(*) FROM {tag} WHERE " + tagged + " AND {tag}.{official} = "
+            "%s)", [True])
+        self.execute_sql("DELETE FROM {summary} WHERE {tag_count} <= 0 AND "
+            "{official_count} <= 0")
+
+    def get_summary_deltas(self):
+        tags = Tag.objects.filter(stem__isnull=False)
+        grouping = ('stem', 'content_type')
+        actual = defaultdict(lambda: [0, 0])
+        for stem_id, ct_id, count in tags.values_list(
+            *grouping).annotate(db.Count('id')).order_by():
+            actual[stem_id, ct_id][0] = count
+        for stem_id, ct_id, count in tags.filter(
+            official=True).values_list(*grouping).annotate(
+            db.Count('id')).order_by():
+            actual[stem_id, ct_id][1] = count
+        deltas = {}
+        for stem_id, ct_id, tag_count, official_count in \
+            TagStemSummary.objects.values_list('stem_id', 'content_type_id',
+            'tag_count', 'official_count'):
+            key = (stem_id, ct_id)
+            counts = actual.pop(key, (0, 0))
+            delta = [counts[0] - tag_count, counts[1] - official_count]
+            if any(delta):
+                deltas[key] = delta
+        # missing summary rows
+        deltas.update(actual)
+        return deltas
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.creator.freezer import freeze_apps
+from south.db import db
+from south.v2 import SchemaMigration
+
+from django.conf import settings
+
+
+TAG_AUTHOR_MODEL = getattr(settings, 'TAG_AUTHOR_MODEL',
+    getattr(settings, 'AUTH_PROFILE_MODULE', 'auth.User'))
+apm_key = TAG_AUTHOR_MODEL.lower()
+apm_app = TAG_AUTHOR_MODEL.split('.')[0]
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'TagStemSummary'
+        db.create_table('tags_tagstemsummary', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('language', self.gf('django.db.models.fields.PositiveIntegerField')(default=39)),
+            ('stem_id', self.gf('django.db.models.fields.IntegerField')(db_index=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(related_name=u'tags_tagstemsummary_summaries', to=orm['contenttypes.ContentType'])),
+            ('tag_count', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('official_count', self.gf('django.db.models.fields.IntegerField')(default=0)),
+        ))
+        db.send_create_signal('tags', ['TagStemSummary'])
+
+        # Adding unique constraint on 'TagStemSummary', fields ['stem_id', 'content_type']
+        db.create_unique('tags_tagstemsummary', ['stem_id', 'content_type_id'])
+
+        if not db.dry_run:
+            # Filling the summaries from existing tags
+            db.execute("""
+                INSERT INTO tags_tagstemsummary
+                    (language, stem_id, content_type_id, tag_count,
+                    official_count)
+                SELECT language, stem_id, content_type_id, COUNT(*),
+                    SUM(CASE WHEN official THEN 1 ELSE 0 END)
+                FROM tags_tag WHERE stem_id IS NOT NULL
+                GROUP BY stem_id, content_type_id, language""")
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'TagStemSummary', fields ['stem_id', 'content_type']
+        db.delete_unique('tags_tagstemsummary', ['stem_id', 'content_type_id'])
+
+        # Deleting model 'TagStemSummary'
+        db.delete_table('tags_tagstemsummary')
+
+
+    models = {
+        apm_key: freeze_apps(apm_app)[apm_key],
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'tags.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'author': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['{TAG_AUTHOR_MODEL}']".format(TAG_AUTHOR_MODEL=TAG_AUTHOR_MODEL)}),
+            'cache_version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'tags_tag_tags'", 'to': "orm['contenttypes.ContentType']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'language': ('django.db.models.fields.PositiveIntegerField', [], {'default': '39'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '75'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'official': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'stem': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'related_tags'", 'null': 'True', 'to': "orm['tags.TagStem']"})
+        },
+        'tags.tagstemsummary': {
+            'Meta': {'unique_together': "(('stem_id', 'content_type'),)", 'object_name': 'TagStemSummary'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'tags_tagstemsummary_summaries'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'language': ('django.db.models.fields.PositiveIntegerField', [], {'default': '39'}),
+            'official_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'stem_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'tag_count': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        'tags.tagstem': {
+            'Meta': {'object_name': 'TagStem'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'language': ('django.db.models.fields.PositiveIntegerField', [], {'default': '39'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '75'}),
+            'tag_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['tags']
@@ -35,23 +35,47 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import defaultdict
+from hashlib import md5
+import heapq
+import json
+from itertools import groupby, imap, islice
+import math
+from operator import itemgetter
+import Queue
+import sys
+import threading
+import time
+
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import (GenericForeignKey,
     GenericRelation)
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.db import models as db
-from django.db.models.signals import post_delete
+from django.db import connections, IntegrityError, router, transaction
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import post_delete, post_save
 from django.utils.translation import ugettext_lazy as _
 from dj.choices import Choice, Language
 
+from lck.django import cache as mint_cache
+from lck.django.common import nested_commit_on_success
 from lck.django.common.models import Named, Localized, TimeTrackable
 from lck.django.tags.helpers import parse_tag_input
+from lck.django.tags.similarity import load_matrices, mark_changed, METRICS
 from lck.lang import unset
 
 
 TAG_AUTHOR_MODEL = getattr(settings, 'TAG_AUTHOR_MODEL', User)
+TAG_INDEX_TIMEOUT = getattr(settings, 'TAG_INDEX_TIMEOUT', 60 * 60 * 24)
+TAG_INDEX_MAX_OBJECTS = getattr(settings, 'TAG_INDEX_MAX_OBJECTS', 10000)
+TAG_CLOUD_TIMEOUT = getattr(settings, 'TAG_CLOUD_TIMEOUT', 60 * 15)
+TAG_CLOUD_SCALES = {'linear': float, 'log': math.log}
+TAG_FETCH_CHUNK_SIZE = getattr(settings, 'TAG_FETCH_CHUNK_SIZE', 500)
+TAG_FETCH_THREADS = getattr(settings, 'TAG_FETCH_THREADS', 1)
 
 
 def _tag_get_user(author, default=unset):
@@ -95,6 +119,219 @@ def _tag_get_instance(instance, default=unset):
         "has a `pk` attribute.")
 
 
+def _object_index_key(content_type_id, object_id):
+    return "tags::index::object::{}::{}".format(content_type_id, object_id)
+
+
+def _stem_index_key(name):
+    # stem names may contain spaces and non-ASCII characters which memcached
+    # doesn't accept in keys
+    return "tags::index::stem::{}".format(md5(name.encode('utf8')).hexdigest())
+
+
+def _filter_official(entries, official):
+    return {e[0] for e in entries if e[-1] or not official}
+
+
+def _tag_is_official(author):
+    if hasattr(author, 'user') and hasattr(author.user, 'is_staff'):
+        author = author.user
+    return author.is_staff
+
+
+def _tag_get_names(name):
+    if isinstance(name, basestring):
+        return set(parse_tag_input(name))
+    return set(name)
+
+
+def _drop_index_entries(content_type_id, object_id, names):
+    cache.delete_many([_object_index_key(content_type_id, object_id)] +
+        [_stem_index_key(name) for name in names])
+    mark_changed()
+
+
+def _delete_tags(pks):
+    """Deletes tags without running the `Tag` signal handlers of this module.
+    Stem counts and index entries have to be updated by the caller."""
+    _bulk_change.active = True
+    try:
+        Tag.objects.filter(pk__in=list(pks)).delete()
+    finally:
+        _bulk_change.active = False
+_bulk_change = threading.local()
+
+
+def _in_bulk_change():
+    return getattr(_bulk_change, 'active', False)
+
+
+def _summary_delta(changes, stem_id, content_type_id, official, sign):
+    if not stem_id:
+        return
+    delta = changes[stem_id, content_type_id]
+    delta[0] += sign
+    if official:
+        delta[1] += sign
+
+
+def _cloud_version_key(content_type_id):
+    return "tags::cloud::version::{}".format(content_type_id or 'all')
+
+
+def _cloud_version(content_type_id):
+    key = _cloud_version_key(content_type_id)
+    version = cache.get(key)
+    if version is None:
+        # never start from a value that might have been used before
+        version = int(time.time() * 1000)
+        cache.add(key, version, 60 * 60 * 24 * 30)
+        # another process might have won the race
+        version = cache.get(key, version)
+    return version
+
+
+def _cloud_buckets(counts, buckets, scale):
+    scale = TAG_CLOUD_SCALES[scale]
+    low = scale(min(counts))
+    span = scale(max(counts)) - low
+    if not span:
+        return [1] * len(counts)
+    return [1 + int(round((scale(count) - low) / span * (buckets - 1)))
+        for count in counts]
+
+
+def _fetch_objects(task):
+    """Returns `((ct_id, object_id), obj)` pairs in the order of the IDs."""
+    ct_id, model, ids = task
+    objects = model.objects.in_bulk(ids)
+    return [((ct_id, pk), objects[pk]) for pk in ids if pk in objects]
+
+
+def _fetch_objects_in_thread(pending, done):
+    """Runs tasks from the `pending` queue until it's empty, putting
+    `(index, result, exc_info)` triples on the `done` queue. All tasks of
+    a thread share its connection."""
+    aliases = set()
+    try:
+        while True:
+            try:
+                index, task = pending.get_nowait()
+            except Queue.Empty:
+                return
+            aliases.add(router.db_for_read(task[1]))
+            try:
+                done.put((index, _fetch_objects(task), None))
+            except Exception:
+                done.put((index, None, sys.exc_info()))
+    finally:
+        # worker threads open their own connections, don't leak them
+        for alias in aliases:
+            connections[alias].close()
+
+
+def _fetch_all_objects(tasks):
+    """Yields results of `_fetch_objects()` for all `tasks` in order.
+    Runs queries concurrently in TAG_FETCH_THREADS threads, unless inside
+    a managed transaction which other connections couldn't see."""
+    if TAG_FETCH_THREADS < 2 or len(tasks) < 2 or transaction.is_managed():
+        for result in imap(_fetch_objects, tasks):
+            yield result
+        return
+    pending = Queue.Queue()
+    for item in enumerate(tasks):
+        pending.put(item)
+    done = Queue.Queue()
+    for _ in xrange(min(TAG_FETCH_THREADS, len(tasks))):
+        thread = threading.Thread(target=_fetch_objects_in_thread,
+            args=(pending, done))
+        thread.daemon = True
+        thread.start()
+    results = {}
+    try:
+        for index in xrange(len(tasks)):
+            while index not in results:
+                finished, result, exc_info = done.get()
+                results[finished] = result, exc_info
+            result, exc_info = results.pop(index)
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield result
+    finally:
+        # threads stop after their current task if the caller stops early
+        while True:
+            try:
+                pending.get_nowait()
+            except Queue.Empty:
+                break
+
+
+def _get_tag_names_field(model):
+    try:
+        return _TAG_NAMES_FIELDS[model]
+    except KeyError:
+        attname = None
+        for field in model._meta.fields:
+            if isinstance(field, TagNames):
+                attname = field.attname
+        _TAG_NAMES_FIELDS[model] = attname
+        return attname
+_TAG_NAMES_FIELDS = {}
+
+
+def _sorted_tag_names(names):
+    return sorted(set(names), key=lambda name: (name.lower(), name))
+
+
+def _load_tag_names(content_type_id, object_ids, official=True):
+    tags = Tag.objects.filter(content_type=content_type_id,
+        object_id__in=object_ids)
+    if official:
+        tags = tags.filter(official=True)
+    names = defaultdict(list)
+    for object_id, name in tags.values_list('object_id', 'name'):
+        names[object_id].append(name)
+    return {object_id: _sorted_tag_names(names[object_id])
+        for object_id in object_ids}
+
+
+def _refresh_tag_names(content_type_id, object_ids):
+    """Rewrites the `TagNames` field on the given objects (if their model
+    has one). Returns a dictionary of the new values."""
+    model = ContentType.objects.get_for_id(content_type_id).model_class()
+    attname = _get_tag_names_field(model) if model else None
+    if not attname:
+        return {}
+    values = {object_id: json.dumps(names) for object_id, names in
+        _load_tag_names(content_type_id, object_ids).iteritems()}
+    for object_id, value in values.iteritems():
+        model._base_manager.filter(pk=object_id).update(**{attname: value})
+    return values
+
+
+def with_tags(objects, official=True):
+    """with_tags(objects, [official]) -> [obj, obj, ...]
+
+    Prefetches tag names for all taggable `objects` (e.g. a page of
+    a QuerySet) so that `get_tag_names()` doesn't issue a query per object.
+    Uses a single query per content type. Objects with a `TagNames` field
+    don't need any query for official tags and are skipped."""
+    objects = list(objects)
+    objects_by_ct = defaultdict(list)
+    for obj in objects:
+        if official and _get_tag_names_field(obj.__class__):
+            continue
+        ct = ContentType.objects.get_for_model(obj.__class__)
+        objects_by_ct[ct.id].append(obj)
+    for ct_id, ct_objects in objects_by_ct.iteritems():
+        names = _load_tag_names(ct_id, {obj.pk for obj in ct_objects},
+            official)
+        for obj in ct_objects:
+            obj.__dict__.setdefault('_prefetched_tag_names', {})[official] = \
+                names[obj.pk]
+    return objects
+
+
 class TaggableBase(db.Model):
     """Provides the `tags` generic relation to prettify the API."""
     tags = GenericRelation("Tag")
@@ -106,13 +343,110 @@ class TaggableBase(db.Model):
         The `name` can be a list of comma-separated tags. Double quotes can be
         used to escape values with spaces or commas. One special case: if there
         are no commas in the input, spaces are treated as tag delimiters."""
+        self.tag_many(name, language, author)
+
+    @nested_commit_on_success
+    def tag_many(self, names, language, author):
+        """tag_many(names, language, author)
+
+        Tags this object using all `names` in a specific `language` at once.
+        `names` is either an iterable of tag names or a string parsed like in
+        `tag()`. Tags by `author` already present on this object are left
+        intact.
+
+        Missing stems and tags are inserted in bulk and tag counts are updated
+        with a single query per distinct change."""
+        self._update_tags(names, language, author, remove=False)
+
+    @nested_commit_on_success
+    def retag(self, names, language, author, exclusive=False):
+        """retag(names, language, author, [exclusive])
+
+        Makes tags by `author` in a specific `language` on this object match
+        `names` (same format as in `tag_many()`). Only the difference between
+        the current and the desired tags is written to the database. If
+        `exclusive` is True, tags by `author` in other languages are removed
+        as well."""
+        self._update_tags(names, language, author, remove=True,
+            exclusive=exclusive)
+
+    def _update_tags(self, names, language, author, remove, exclusive=False,
+        previous=None):
+        """`previous` is an optional `(author_id, names)` pair. Tags with
+        those names by that author are taken over by `author`."""
         author = _tag_get_user(author)
         language = _tag_get_language(language)
-        tags = parse_tag_input(name)
-        for tag_name in tags:
-            tag = Tag(name=tag_name, language=language, author=author,
-                content_object=self)
-            tag.save()
+        names = _tag_get_names(names)
+        ct = ContentType.objects.get_for_model(self.__class__)
+        authors = [author.pk]
+        if previous:
+            authors.append(previous[0])
+        current = Tag.objects.filter(content_type=ct, object_id=self.pk,
+            author__in=authors)
+        if not exclusive:
+            current = current.filter(language=language)
+        official = _tag_is_official(author)
+        existing = set()
+        removed = []
+        moved = []
+        # tags by `author` come first so they are kept over taken over ones
+        for pk, tag_name, tag_language, stem_id, tag_official, author_id in \
+            sorted(current.values_list('id', 'name', 'language', 'stem_id',
+            'official', 'author'), key=lambda row: row[-1] != author.pk):
+            if author_id != author.pk and tag_name not in previous[1]:
+                continue
+            if tag_language == language and tag_name in names and \
+                tag_name not in existing:
+                existing.add(tag_name)
+                if author_id != author.pk:
+                    moved.append((pk, tag_name, stem_id, tag_official))
+            else:
+                removed.append((pk, tag_name, stem_id, tag_official))
+        if not remove:
+            removed = []
+        self._write_tag_changes(ct, names - existing, removed, moved,
+            language, author, official)
+
+    def _write_tag_changes(self, ct, added=(), removed=(), moved=(),
+        language=None, author=None, official=False):
+        """Inserts tags named `added`, deletes `removed` ones and gives `moved`
+        ones to `author`. `removed` and `moved` are `(pk, name, stem_id,
+        official)` rows. Updates stem counts, tag cloud summaries, the
+        `TagNames` field and the index with a single query per kind of
+        change."""
+        if not added and not removed and not moved:
+            return
+        deltas = defaultdict(int)
+        summary = defaultdict(lambda: [0, 0])
+        if moved:
+            Tag.objects.filter(pk__in=[m[0] for m in moved]).update(
+                author=author, official=official)
+            for _, _, stem_id, tag_official in moved:
+                if tag_official != official:
+                    _summary_delta(summary, stem_id, ct.id, tag_official, -1)
+                    _summary_delta(summary, stem_id, ct.id, official, 1)
+        if removed:
+            _delete_tags(r[0] for r in removed)
+            for _, _, stem_id, tag_official in removed:
+                if stem_id:
+                    deltas[stem_id] -= 1
+                _summary_delta(summary, stem_id, ct.id, tag_official, -1)
+        if added:
+            stems = TagStem.objects.acquire_many(added, language)
+            Tag.objects.bulk_create([Tag(name=tag_name, language=language,
+                author=author, official=official, content_type=ct,
+                object_id=self.pk, stem=stems[tag_name])
+                for tag_name in sorted(added)])
+            for stem in stems.itervalues():
+                _summary_delta(summary, stem.pk, ct.id, official, 1)
+        TagStem.objects.adjust_counts(deltas)
+        TagStemSummary.adjust(summary)
+        attname = _get_tag_names_field(self.__class__)
+        if attname:
+            setattr(self, attname, _refresh_tag_names(ct.id,
+                [self.pk])[self.pk])
+        _drop_index_entries(ct.id, self.pk, set(added) |
+            {r[1] for r in removed} | {m[1] for m in moved})
 
     def untag(self, name, language, author):
         """Untags this object from tags in a specific `language`, authored by
@@ -121,23 +455,15 @@ class TaggableBase(db.Model):
         The `name` can be a list of comma-separated tags. Double quotes can be
         used to escape values with spaces or commas. One special case: if there
         are no commas in the input, spaces are treated as tag delimiters."""
-        author = _tag_get_user(author)
-        language = _tag_get_language(language)
-        ct = ContentType.objects.get_for_model(self.__class__)
-        tags = parse_tag_input(name)
-        for tag_name in tags:
-            try:
-                tag = Tag.objects.get(name=tag_name, language=language,
-                    author=author, content_type=ct, object_id=self.id)
-                tag.delete()
-            except Tag.DoesNotExist:
-                pass # okay, successfully "untagged".
+        self.untag_all(name, _tag_get_language(language),
+            _tag_get_user(author))
 
+    @nested_commit_on_success
     def untag_all(self, name=None, language=None, author=None):
         """untag_all([name], [language], [author])
 
         Untags this object from all tags in a specific `language` or authored
-        by `author`."""
+        by `author`. Tags are deleted in bulk."""
         author = _tag_get_user(author, default=None)
         language = _tag_get_language(language, default=None)
         ct = ContentType.objects.get_for_model(self.__class__)
@@ -148,47 +474,69 @@ class TaggableBase(db.Model):
             kwargs['language'] = language
         if author is not None:
             kwargs['author'] = author
-        tags = Tag.objects.filter(**kwargs)
-        tags.delete()
+        self._write_tag_changes(ct, removed=list(Tag.objects.filter(
+            **kwargs).values_list('id', 'name', 'stem_id', 'official')))
 
-
-    def similar_objects(self, same_type=False, official=False):
-        """similar_objects([same_type, official]) -> [(obj, distance), (obj, distance), ...]
+    def similar_objects(self, same_type=False, official=False, limit=None,
+        min_shared=1, metric='symmetric_difference'):
+        """similar_objects([same_type, official, limit, min_shared, metric]) -> [(obj, distance), (obj, distance), ...]
 
         Returns a sorted list of similar objects in tuples (the object itself,
         the distance to the `self` object). If there are no similar objects,
         the list returned is empty. Searching for similar objects can be
         constrained to the objects of the same type (if `same_type` is
-        True).
-
-        Objects are similar when they share the same tags. Distance is the
-        number of tags that are not shared by the two objects (specifically,
-        the object has distance 0 to itself). Distance calculation by default
-        uses all tags present on the object. If `official` is True, only the
-        official tags are taken into account.
+        True). At most `limit` objects are returned if specified.
+
+        Objects are similar when they share at least `min_shared` tags. By
+        default distance is the number of tags that are not shared by the two
+        objects (specifically, the object has distance 0 to itself). With
+        `metric` set to "jaccard", the Jaccard distance is used instead.
+        Distance calculation by default uses all tags present on the object.
+        If `official` is True, only the official tags are taken into account.
+
+        If matrices were precomputed with the ``build_tag_similarity``
+        management command, all objects are scored against them at once.
+        Otherwise only objects sharing a stem with `self` are looked at. Those
+        are found through the cached inverted index maintained by
+        `TagStemManager.get_objects_for_stems()`.
         """
-
-        kwargs = {"official": official}
-        if same_type:
-            kwargs['model'] = self.__class__
-        stems = TagStem.objects.get_dictionary(**kwargs)
-        distance = []
-        if self in stems:
-            self_stems = stems[self]
-            del stems[self]
+        if metric not in METRICS:
+            raise ValueError("Unknown metric `{}`. Use one of: {}.".format(
+                metric, ", ".join(sorted(METRICS))))
+        if min_shared < 1:
+            raise ValueError("`min_shared` has to be at least 1.")
+        if not self.pk:
+            return []
+        ct = ContentType.objects.get_for_model(self.__class__)
+        self_key = (ct.id, self.pk)
+        self_stems = _filter_official(TagStem.objects.get_stems_for_objects(
+            [self_key])[self_key], official)
+        matrices = load_matrices()
+        if matrices is not None:
+            scored = matrices[official].score(self_stems, metric,
+                min_shared=min_shared,
+                content_type_id=ct.id if same_type else None)
         else:
-            # may happen if this object is not available through Model.objects,
-            # e.g. the model has a custom manager which filters it out
-            self_stems = set((i[0] for i in
-                TagStem.objects.get_queryset_for_model(self.__class__,
-                self).values_list('name')))
-        for obj, s in stems.iteritems():
-            if not s & self_stems:
-                # things without a single common tag are not similar at all
-                continue
-            distance.append((obj, len(s ^ self_stems)))
-        distance.sort(key=lambda elem: elem[1])
-        return distance
+            candidates = set()
+            for entries in TagStem.objects.get_objects_for_stems(
+                self_stems).itervalues():
+                for ct_id, object_id, is_official in entries:
+                    if official and not is_official:
+                        continue
+                    if same_type and ct_id != ct.id:
+                        continue
+                    candidates.add((ct_id, object_id))
+            distance = METRICS[metric]
+            scored = []
+            for key, entries in TagStem.objects.get_stems_for_objects(
+                candidates).iteritems():
+                s = _filter_official(entries, official)
+                shared = len(s & self_stems)
+                if shared >= min_shared:
+                    scored.append((distance(shared, len(s), len(self_stems)),
+                        key))
+        scored = [elem for elem in scored if elem[1] != self_key]
+        return TagStem.objects._get_ranked_objects(scored, limit)
 
     def get_tags(self, official=True, author=None, language=None):
         """get_tags([official, author, language]) -> [TagStem, TagStem, ...]
@@ -199,6 +547,22 @@ class TaggableBase(db.Model):
             official=official, author=author, language=language).extra(
                 select={'lname': 'lower(tags_tagstem.name)'}).order_by('lname')
 
+    def get_tag_names(self, official=True):
+        """get_tag_names([official]) -> [name, name, ...]
+
+        Returns sorted names of tags on the current taggable. Names are read
+        without a query if they were prefetched with `with_tags()` or, for
+        `official` tags, if the model has a `TagNames` field."""
+        prefetched = self.__dict__.get('_prefetched_tag_names', {})
+        if official in prefetched:
+            return prefetched[official]
+        attname = _get_tag_names_field(self.__class__)
+        if official and attname:
+            value = getattr(self, attname)
+            return json.loads(value) if value else []
+        ct = ContentType.objects.get_for_model(self.__class__)
+        return _load_tag_names(ct.id, [self.pk], official)[self.pk]
+
     class Meta:
         abstract = True
 
@@ -224,6 +588,36 @@ class DefaultTags(db.CharField):
         return ('lck.django.tags.models.DefaultTags', [], kwargs)
 
 
+class TagNames(db.TextField):
+    """Opt-in denormalized list of official tag names on a taggable model,
+    sorted case insensitively and stored as JSON. Refreshed within the same
+    transaction on every tag change and never written by saving the object
+    so a stale instance can't overwrite it. Read it with
+    `get_tag_names()`."""
+
+    def __init__(self, *args, **kwargs):
+        defaults = dict(verbose_name=_("tag names"), blank=True, default="",
+            editable=False)
+        defaults.update(kwargs)
+        super(TagNames, self).__init__(*args, **defaults)
+
+    def pre_save(self, model_instance, add):
+        if add:
+            return super(TagNames, self).pre_save(model_instance, add)
+        # updates keep the value stored in the database
+        return db.F(self.attname)
+
+    def south_field_triple(self):
+        kwargs = dict(
+            null=repr(self.null),
+            blank=repr(self.blank),
+            db_column=repr(self.db_column),
+        )
+        if self.default is not db.NOT_PROVIDED:
+            kwargs['default'] = repr(self.default)
+        return ('lck.django.tags.models.TagNames', [], kwargs)
+
+
 class Taggable(TaggableBase):
     """Provides the `tags` generic relation and default tags that can be edited
     straight from the admin."""
@@ -232,13 +626,14 @@ class Taggable(TaggableBase):
     # To be used like Named.NonUnique, etc.
     NoDefaultTags = TaggableBase
 
+    def _get_default_tags_author_fields(self):
+        if hasattr(self, 'default_tags_author'):
+            return [getattr(self, 'default_tags_author')]
+        return ['created_by', 'author', 'user', 'sender']
+
     def _get_default_tags_author(self):
         allowed_author_type = Tag.author.field.rel.to
-        if hasattr(self, 'default_tags_author'):
-            author_lookup_fields = [getattr(self, 'default_tags_author')]
-        else:
-            author_lookup_fields = ['created_by', 'author', 'user', 'sender']
-        for field_name in author_lookup_fields:
+        for field_name in self._get_default_tags_author_fields():
             try:
                 _author = getattr(self, field_name)
                 if isinstance(_author, allowed_author_type):
@@ -267,23 +662,66 @@ class Taggable(TaggableBase):
         raise ImproperlyConfigured("No compatible language field found for "
             "default tags.")
 
+    def _get_default_tags_author_id(self):
+        """Returns the primary key of the default tags author without
+        fetching it. Returns None if the author isn't a foreign key."""
+        cls = self.__class__
+        try:
+            attname = _DEFAULT_TAGS_AUTHOR_FIELDS[cls]
+        except KeyError:
+            attname = None
+            allowed_author_type = Tag.author.field.rel.to
+            for field_name in self._get_default_tags_author_fields():
+                try:
+                    field = cls._meta.get_field(field_name)
+                except FieldDoesNotExist:
+                    continue
+                if getattr(field.rel, 'to', None) is allowed_author_type:
+                    attname = field.attname
+                    break
+            _DEFAULT_TAGS_AUTHOR_FIELDS[cls] = attname
+        return self.__dict__.get(attname) if attname else None
+
+    def __init__(self, *args, **kwargs):
+        super(Taggable, self).__init__(*args, **kwargs)
+        # don't trigger loading of the fields if they're deferred
+        self._saved_default_tags = self.__dict__.get('_default_tags')
+        self._saved_default_tags_author_id = self._get_default_tags_author_id()
+
     def save(self, *args, **kwargs):
-        tag_author = self._get_default_tags_author()
-        tag_lang = self._get_default_tags_language()
         self._default_tags = ", ".join(parse_tag_input(self._default_tags))
         new = not bool(self.pk)
-        if not new:
-            # FIXME: this two-step approach may delete tags on tags
-            self.untag_all(author=tag_author)
-            self.tag(self._default_tags, tag_lang, tag_author)
+        author_id = self._get_default_tags_author_id()
+        changed = new or self._default_tags != self._saved_default_tags or \
+            author_id != self._saved_default_tags_author_id
+        if changed:
+            tag_author = self._get_default_tags_author()
+            tag_lang = self._get_default_tags_language()
         super(Taggable, self).save(*args, **kwargs)
-        if new:
-            self.tag(self._default_tags, tag_lang, tag_author)
+        if changed:
+            previous = None
+            previous_author_id = self._saved_default_tags_author_id
+            if not new and self._saved_default_tags is not None and \
+                previous_author_id not in (None, tag_author.pk):
+                # default tags of the previous author are taken over
+                previous = (previous_author_id,
+                    set(parse_tag_input(self._saved_default_tags)))
+            self._retag_default_tags(tag_lang, tag_author, previous)
+        self._saved_default_tags = self._default_tags
+        self._saved_default_tags_author_id = author_id
+
+    @nested_commit_on_success
+    def _retag_default_tags(self, language, author, previous):
+        self._update_tags(self._default_tags, language, author, remove=True,
+            exclusive=True, previous=previous)
 
     class Meta:
         abstract = True
 
 
+_DEFAULT_TAGS_AUTHOR_FIELDS = {}
+
+
 class TagStemManager(db.Manager):
     """A regular manager but with a couple additional methods for easier
     stems discovery."""
@@ -303,23 +741,313 @@ class TagStemManager(db.Manager):
         """Returns a dictionary of all tagged objects with values being
         sets of raw stems (strings) for the specified object.
 
-        This is basically an overly complex implementation that avoids
-        duplicating SQL queries. A straight forward version would be::
+        The stems are read using a single grouped query over `Tag` rows.
+        Tagged objects are then fetched with one query per content type.
+        A straight forward version would be::
 
             {obj: set(TagStem.objects.get_queryset_for_model(obj.__class__, obj))
                 for obj in {t.content_object for t in Tag.objects.all()}
             }
         """
-        tagged_objects = self.get_content_objects(model=model,
-            content_type=content_type, stem=stem, stems=stems,
+        kwargs = self._get_tag_filter(model=model, content_type=content_type,
             official=official, author=author, language=language)
-        return {obj: set((i[0] for i in self.get_queryset_for_model(
-            obj.__class__, instance=obj, official=official, author=author,
-            language=language).values_list('name'))) for obj in tagged_objects}
+        tags = Tag.objects.filter(**kwargs)
+        tagged_cts_oids = None
+        if stem or stems:
+            # objects are chosen by the stem filter but their values should
+            # still list all of their stems
+            tagged_cts_oids = set(Tag.objects.filter(**self._get_tag_filter(
+                model=model, content_type=content_type, stem=stem, stems=stems,
+                official=official, author=author, language=language)
+            ).values_list('content_type_id', 'object_id').distinct())
+            if not tagged_cts_oids:
+                return {}
+            tags = tags.filter(content_type__in={k[0] for k in
+                tagged_cts_oids}, object_id__in={k[1] for k in
+                tagged_cts_oids})
+        stems_by_key = defaultdict(set)
+        # `Tag.name` always equals the name of its stem, no need for a join
+        for ct_id, object_id, name in tags.values_list('content_type_id',
+            'object_id', 'name').distinct():
+            key = (ct_id, object_id)
+            if tagged_cts_oids is None or key in tagged_cts_oids:
+                stems_by_key[key].add(name)
+        model_table = self._get_model_table({key[0] for key in stems_by_key})
+        return {obj: stems_by_key[key] for key, obj in
+            self._iter_objects_that_exist(stems_by_key, model_table)}
+
+    def get_or_create_many(self, names, language):
+        """get_or_create_many(names, language) -> {name: TagStem, ...}
+
+        Returns stems for all `names` in a specific `language`. Missing stems
+        are inserted in bulk."""
+        language = _tag_get_language(language)
+        names = set(names)
+
+        def fetch():
+            stems = {}
+            # in case of duplicates the oldest stem wins
+            for stem in self.filter(language=language,
+                name__in=names).order_by('-pk'):
+                stems[stem.name] = stem
+            return stems
+
+        stems = fetch()
+        missing = names - set(stems)
+        if missing:
+            self.bulk_create([self.model(name=name, language=language)
+                for name in missing])
+            stems = fetch()
+        return stems
+
+    def acquire_many(self, names, language):
+        """acquire_many(names, language) -> {name: TagStem, ...}
+
+        Like `get_or_create_many()` but also atomically increments the tag
+        count of every returned stem. Stems garbage collected by a concurrent
+        `adjust_counts()` in the meantime are created again."""
+        language = _tag_get_language(language)
+        result = {}
+        missing = set(names)
+        while missing:
+            stems = self.get_or_create_many(missing, language)
+            ids = {stem.pk: name for name, stem in stems.iteritems()}
+            updated = self.filter(pk__in=ids).update(
+                tag_count=db.F('tag_count') + 1)
+            if updated < len(ids):
+                alive = set(self.filter(pk__in=ids).values_list('pk',
+                    flat=True))
+            else:
+                alive = ids
+            for pk in alive:
+                name = ids[pk]
+                stems[name].tag_count += 1
+                result[name] = stems[name]
+                missing.discard(name)
+        return result
+
+    def adjust_counts(self, deltas):
+        """Applies `deltas` (a dictionary of stem IDs to tag count changes).
+        Stems sharing the same change are updated with a single UPDATE.
+        Counts never drop below zero. Stems left without tags are deleted."""
+        ids_by_delta = defaultdict(list)
+        for stem_id, delta in deltas.iteritems():
+            if delta:
+                ids_by_delta[delta].append(stem_id)
+        emptied = []
+        for delta, ids in ids_by_delta.iteritems():
+            if delta > 0:
+                self.filter(pk__in=ids).update(
+                    tag_count=db.F('tag_count') + delta)
+            else:
+                self._decrement_counts(ids, -delta)
+                emptied.extend(ids)
+        if emptied:
+            self.delete_unused(emptied)
+
+    def _decrement_counts(self, ids, by):
+        # `tag_count` is unsigned, so F('tag_count') - by would fail on
+        # a drifted count (PostgreSQL checks the constraint, MySQL in strict
+        # mode refuses negative unsigned results). The subtraction is only
+        # evaluated when it stays non-negative.
+        using = router.db_for_write(self.model)
+        qn = connections[using].ops.quote_name
+        sql = ("UPDATE {stem} SET {count} = CASE WHEN {count} < %s THEN 0 "
+            "ELSE {count} - %s END WHERE {pk} IN ({ids})".format(
+            stem=qn(self.model._meta.db_table), count=qn('tag_count'),
+            pk=qn(self.model._meta.pk.column),
+            ids=", ".join(["%s"] * len(ids))))
+        connections[using].cursor().execute(sql, [by, by] + list(ids))
+        transaction.commit_unless_managed(using=using)
+
+    def delete_unused(self, ids=None):
+        """delete_unused([ids]) -> None
+
+        Deletes stems (optionally only those with the given `ids`) with
+        a non-positive tag count. This is a single conditional DELETE so
+        a stem incremented concurrently is never removed. Stems still
+        referenced by tags (e.g. because of drifted counts) are kept."""
+        params = []
+        if ids is not None:
+            params = list(ids)
+            if not params:
+                return
+        using = router.db_for_write(self.model)
+        qn = connections[using].ops.quote_name
+        stem_table = qn(self.model._meta.db_table)
+        tag_table = qn(Tag._meta.db_table)
+        sql = ("DELETE FROM {stem} WHERE {stem}.{count} <= 0 AND NOT EXISTS "
+            "(SELECT 1 FROM {tag} WHERE {tag}.{stem_id} = {stem}.{pk})".format(
+            stem=stem_table, tag=tag_table, count=qn('tag_count'),
+            stem_id=qn(Tag._meta.get_field('stem').column),
+            pk=qn(self.model._meta.pk.column)))
+        if params:
+            sql += " AND {}.{} IN ({})".format(stem_table,
+                qn(self.model._meta.pk.column),
+                ", ".join(["%s"] * len(params)))
+        # `QuerySet.delete()` would SELECT the rows first and then delete them
+        # by primary key, reintroducing the race
+        connections[using].cursor().execute(sql, params)
+        transaction.commit_unless_managed(using=using)
+
+    def cloud(self, model=None, content_type=None, language=None,
+        official=False, limit=None, buckets=5, scale='log'):
+        """cloud([model, content_type, language, official, limit, buckets, scale]) -> [TagStem, TagStem, ...]
+
+        Returns the `limit` most popular stems (optionally only those used on
+        `model` instances, in a specific `language` or in official tags)
+        sorted by name. Every stem has two additional attributes:
+        `cloud_count` holding the number of matching tags and `cloud_bucket`
+        holding a font size bucket from 1 to `buckets`. Counts are mapped to
+        buckets on a `log` or `linear` scale.
+
+        Counts are read from `TagStemSummary` so the `Tag` table is never
+        touched. Results are cached for TAG_CLOUD_TIMEOUT seconds using
+        `lck.django.cache` or until tags on objects of the given content type
+        change."""
+        if scale not in TAG_CLOUD_SCALES:
+            raise ValueError("Unknown scale: {!r}. Use one of: {}".format(
+                scale, ", ".join(sorted(TAG_CLOUD_SCALES))))
+        if buckets < 1:
+            raise ValueError("At least one bucket is required.")
+        if model:
+            content_type = ContentType.objects.get_for_model(model)
+        ct_id = _tag_get_instance(content_type, default=None)
+        language = _tag_get_language(language, default=None)
+        key = "tags::cloud::{}::{}::{}::{}::{}::{}::{}".format(ct_id,
+            _cloud_version(ct_id), language, int(official), limit, buckets,
+            scale)
+        result = mint_cache.get(key)
+        if result is not None:
+            return result
+        field = 'official_count' if official else 'tag_count'
+        summaries = TagStemSummary.objects.filter(**{field + '__gt': 0})
+        if ct_id:
+            summaries = summaries.filter(content_type=ct_id)
+        if language is not None:
+            summaries = summaries.filter(language=language)
+        counts = summaries.values_list('stem_id').annotate(
+            count=db.Sum(field)).order_by('-count')
+        if limit:
+            counts = counts[:limit]
+        counts = dict(counts)
+        stems = self.in_bulk(list(counts)).values()
+        if stems:
+            for stem, bucket in zip(stems, _cloud_buckets([counts[stem.pk]
+                for stem in stems], buckets, scale)):
+                stem.cloud_count = counts[stem.pk]
+                stem.cloud_bucket = bucket
+        result = sorted(stems, key=lambda stem: (stem.name.lower(), stem.pk))
+        mint_cache.set(key, result, timeout=TAG_CLOUD_TIMEOUT)
+        return result
+
+    def get_stems_for_objects(self, keys):
+        """get_stems_for_objects(keys) -> {(ct_id, object_id): set([(name, official), ...]), ...}
+
+        Returns stem names used on objects identified by `keys`, an iterable
+        of `(content_type_id, object_id)` pairs. Each name is paired with
+        a flag telling whether it was used in an official tag.
+
+        Entries are held in the cache and invalidated whenever a `Tag` on the
+        object is saved or deleted. Misses are resolved with a single query
+        per content type."""
+        keys = set(keys)
+        cache_keys = {_object_index_key(*key): key for key in keys}
+        result = {cache_keys[k]: v for k, v in
+            cache.get_many(cache_keys.keys()).iteritems()}
+        missing = keys - set(result)
+        if missing:
+            oids_by_ct = defaultdict(set)
+            for ct_id, object_id in missing:
+                oids_by_ct[ct_id].add(object_id)
+            fetched = {key: set() for key in missing}
+            for ct_id, oids in oids_by_ct.iteritems():
+                for object_id, name, official in Tag.objects.filter(
+                    content_type=ct_id, object_id__in=oids).values_list(
+                    'object_id', 'name', 'official').distinct():
+                    fetched[ct_id, object_id].add((name, official))
+            cache.set_many({_object_index_key(*key): value for key, value in
+                fetched.iteritems()}, TAG_INDEX_TIMEOUT)
+            result.update(fetched)
+        return result
+
+    def get_objects_for_stems(self, names):
+        """get_objects_for_stems(names) -> {name: set([(ct_id, object_id, official), ...]), ...}
+
+        The inverted index: returns keys of objects tagged with each of the
+        given stem `names`, together with a flag telling whether the tag was
+        official.
+
+        Entries are held in the cache and invalidated whenever a `Tag` using
+        the stem is saved or deleted. Misses are resolved with a single
+        query. Stems used on more than TAG_INDEX_MAX_OBJECTS objects are not
+        cached since memcached doesn't store values larger than 1 MB."""
+        names = set(names)
+        cache_keys = {_stem_index_key(name): name for name in names}
+        result = {cache_keys[k]: v for k, v in
+            cache.get_many(cache_keys.keys()).iteritems()}
+        missing = names - set(result)
+        if missing:
+            fetched = {name: set() for name in missing}
+            for name, ct_id, object_id, official in Tag.objects.filter(
+                name__in=missing).values_list('name', 'content_type_id',
+                'object_id', 'official').distinct():
+                if name in fetched:
+                    fetched[name].add((ct_id, object_id, official))
+            cache.set_many({_stem_index_key(name): value for name, value in
+                fetched.iteritems() if len(value) <= TAG_INDEX_MAX_OBJECTS},
+                TAG_INDEX_TIMEOUT)
+            result.update(fetched)
+        return result
 
     def get_content_objects(self, model=None, content_type=None, stem=None,
-        stems=None, official=False, author=None, language=None, order_by=None):
-        """Returns a set of tagged objects."""
+        stems=None, official=False, author=None, language=None, order_by=None,
+        offset=0, limit=None):
+        """get_content_objects([model, content_type, stem, stems, official, author, language, order_by, offset, limit]) -> generator of tagged objects
+
+        Yields tagged objects sorted by content type ID and primary key.
+        `offset` and `limit` are applied to that order before any object is
+        fetched so only a single page is read. Objects hidden by custom
+        managers are skipped so a page may come out shorter than `limit`.
+
+        If `order_by` is given, objects of each content type are sorted by it
+        instead. In that case primary keys of each model are read in that
+        order with a single query (hidden objects are left out already) and
+        objects are fetched in chunks too."""
+        kwargs = self._get_tag_filter(model=model, content_type=content_type,
+            stem=stem, stems=stems, official=official, author=author,
+            language=language)
+        tags = Tag.objects.filter(**kwargs)
+        stop = None if limit is None else offset + limit
+        if order_by:
+            model_table = self._get_model_table(tags.values_list(
+                'content_type_id', flat=True).distinct().order_by())
+            cts_oids = list(islice(self._iter_ordered_keys(tags, model_table,
+                order_by), offset, stop))
+        else:
+            cts_oids = sorted(tags.values_list('content_type_id',
+                'object_id').distinct().order_by())[offset:stop]
+            model_table = self._get_model_table({key[0] for key in cts_oids})
+        return self._yield_objects_that_exist(cts_oids, model_table,
+            ordered=bool(order_by))
+
+    @staticmethod
+    def _iter_ordered_keys(tags, model_table, order_by):
+        """Yields `(ct_id, object_id)` keys of objects tagged with `tags`
+        sorted by content type ID and then by `order_by`. Tagged objects are
+        selected with a subquery so no list of IDs is sent to the
+        database."""
+        for ct_id in sorted(model_table):
+            model = model_table[ct_id]
+            object_ids = tags.filter(content_type=ct_id).values('object_id')
+            for pk in model.objects.filter(pk__in=object_ids).order_by(
+                *(list(order_by) + ['pk'])).values_list('pk',
+                flat=True).iterator():
+                yield ct_id, pk
+
+    def _get_tag_filter(self, model=None, content_type=None, stem=None,
+        stems=None, official=False, author=None, language=None):
+        """Returns keyword arguments for filtering `Tag` objects."""
         author = _tag_get_user(author, default=None)
         language = _tag_get_language(language, default=None)
         kwargs = {}
@@ -330,7 +1058,6 @@ class TagStemManager(db.Manager):
             content_type = ContentType.objects.get_for_model(model)
         if content_type:
             kwargs["content_type"] = content_type
-            tagged_models = {content_type.id: content_type.model_class()}
         if stem:
             kwargs["stem"] = stem
         if stems:
@@ -344,15 +1071,38 @@ class TagStemManager(db.Manager):
             kwargs["author"] = author
         if language is not None:
             kwargs["language"] = language
-        tags = Tag.objects.filter(**kwargs)
-        tagged_cts_oids = set(tags.values_list('content_type_id',
-            'object_id').distinct())
-        if not content_type:
-            tagged_cts = {t[0] for t in tagged_cts_oids}
-            tagged_models = {id: ContentType.objects.get(pk=id).model_class()
-                for id in tagged_cts}
-        return self._yield_objects_that_exist(tagged_cts_oids,
-            tagged_models, order_by)
+        return kwargs
+
+    @staticmethod
+    def _get_model_table(ct_ids):
+        """Returns a dictionary of model classes for the given content type
+        IDs, using the content type cache."""
+        model_table = {}
+        for ct_id in ct_ids:
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            if model is not None:
+                model_table[ct_id] = model
+        return model_table
+
+    def _get_ranked_objects(self, scored, limit=None):
+        """Turns `(distance, key)` pairs into a sorted list of at most `limit`
+        `(obj, distance)` tuples. Only the best scored objects are fetched.
+        If some of them don't exist, more are fetched to fill the limit."""
+        n = limit
+        while True:
+            exhausted = n is None or n >= len(scored)
+            if exhausted:
+                ranked = sorted(scored)
+            else:
+                ranked = heapq.nsmallest(n, scored)
+            model_table = self._get_model_table({elem[1][0] for elem in
+                ranked})
+            objects = dict(self._iter_objects_that_exist([elem[1] for elem in
+                ranked], model_table))
+            result = [(objects[key], d) for d, key in ranked if key in objects]
+            if exhausted or len(result) >= limit:
+                return result[:limit]
+            n *= 2
 
     def get_queryset_for_model(self, model, instance=None, official=False,
         author=None, language=None):
@@ -378,19 +1128,37 @@ class TagStemManager(db.Manager):
         return self.filter(**kwargs).distinct()
 
     @staticmethod
-    def _yield_objects_that_exist(cts_oids, model_table, order_by=None):
+    def _yield_objects_that_exist(cts_oids, model_table, ordered=False):
         """For models that implement a custom manager to filter out some
         objects (for instance to hide articles which should not be published
         yet) it may be possible that asking for an object that exist
         in the database (and has tags on it) raises DoesNotExist instead.
         Here we silently ignore those."""
-        for ctid, table in model_table.iteritems():
-            ids = {o[1] for o in filter(lambda x: x[0] == ctid, cts_oids)}
-            qs = table.objects.filter(pk__in=ids)
-            if order_by:
-                qs = qs.order_by(*order_by)
-            for obj in qs:
-                yield obj
+        for _, obj in TagStemManager._iter_objects_that_exist(cts_oids,
+            model_table, ordered):
+            yield obj
+
+    @staticmethod
+    def _iter_objects_that_exist(cts_oids, model_table, ordered=False):
+        """Like `_yield_objects_that_exist` but yields `((ct_id, object_id),
+        obj)` pairs so callers can map objects back to their keys.
+
+        Objects are sorted by content type ID and primary key or, if
+        `ordered` is True, come in the order of `cts_oids`. They are fetched
+        in chunks of TAG_FETCH_CHUNK_SIZE primary keys."""
+        if not ordered:
+            cts_oids = sorted(set(cts_oids))
+        tasks = []
+        for ct_id, keys in groupby(cts_oids, key=itemgetter(0)):
+            if ct_id not in model_table:
+                continue
+            ids = [object_id for _, object_id in keys]
+            for i in xrange(0, len(ids), TAG_FETCH_CHUNK_SIZE):
+                tasks.append((ct_id, model_table[ct_id],
+                    ids[i:i + TAG_FETCH_CHUNK_SIZE]))
+        for objects in _fetch_all_objects(tasks):
+            for key, obj in objects:
+                yield key, obj
 
 
 class TagStem(Named.NonUnique, Localized, Taggable.NoDefaultTags):
@@ -403,19 +1171,18 @@ class TagStem(Named.NonUnique, Localized, Taggable.NoDefaultTags):
     def __unicode__(self):
         return "{} ({})".format(self.name, self.get_language_display())
 
-    def inc_count(self):
-        """Increases the reported tag count."""
-        self.tag_count += 1
-        self.save()
-
-    def dec_count(self):
-        """Decreases the reported tag count. If it reaches zero, deletes
-        itself."""
-        if self.tag_count > 1:
-            self.tag_count -= 1
-            self.save()
-        else:
-            self.delete()
+    def inc_count(self, by=1):
+        """Atomically increases the reported tag count."""
+        TagStem.objects.filter(pk=self.pk).update(
+            tag_count=db.F('tag_count') + by)
+        self.tag_count += by
+
+    def dec_count(self, by=1):
+        """Atomically decreases the reported tag count, never below zero. If
+        it reaches zero, deletes itself unless another tag started using it
+        in the meantime."""
+        TagStem.objects.adjust_counts({self.pk: -by})
+        self.tag_count = max(self.tag_count - by, 0)
 
     class Meta:
         verbose_name = _("Tag stem")
@@ -443,36 +1210,181 @@ class Tag(Named.NonUnique, Localized, TimeTrackable):
     def update_stem(self):
         """Sets the correct stem on the object and updates tag counts for
         stems. Automatically invoked during each save() for this model."""
-        stem, created = TagStem.objects.get_or_create(name=self.name,
-            language=self.language)
-        if stem != self.stem:
-            # either there wasn't a stem before or self.name or self.language
-            # changed
-            if self.stem:
-                self.stem.dec_count()
-            self.stem = stem
-            self.stem.inc_count()
-
+        old_stem = self.stem if self.stem_id else None
+        if old_stem and old_stem.name == self.name and \
+            old_stem.language == self.language:
+            return
+        # either there wasn't a stem before or self.name or self.language
+        # changed
+        self.stem = TagStem.objects.acquire_many([self.name],
+            self.language)[self.name]
+        if old_stem:
+            cache.delete(_stem_index_key(old_stem.name))
+            old_stem.dec_count()
+
+    @nested_commit_on_success
     def save(self, *args, **kwargs):
-        if hasattr(self.author, 'user') and \
-            hasattr(self.author.user, 'is_staff'):
-            author = self.author.user
-        else:
-            author = self.author
-        if author.is_staff:
+        if _tag_is_official(self.author):
             self.official = True
+        old = self._field_state
+        old_key = None if not self.pk else (old['stem_id'],
+            old['content_type_id'], old['official'])
         self.update_stem()
-        return super(Tag, self).save(*args, **kwargs)
+        result = super(Tag, self).save(*args, **kwargs)
+        new_key = (self.stem_id, self.content_type_id, self.official)
+        if old_key != new_key:
+            changes = defaultdict(lambda: [0, 0])
+            if old_key:
+                _summary_delta(changes, *old_key, sign=-1)
+            _summary_delta(changes, *new_key, sign=1)
+            TagStemSummary.adjust(changes)
+        return result
 
     class Meta:
         verbose_name = _("Tag")
         verbose_name_plural = _("Tags")
 
 
+class TagStemSummary(Localized):
+    """The number of tags using a specific stem on objects of a specific
+    content type. Maintained incrementally on every tag change so tag clouds
+    don't have to aggregate over the `Tag` table. Stems are referenced by ID
+    without a foreign key so that garbage collecting them stays a single
+    conditional DELETE."""
+    stem_id = db.IntegerField(verbose_name=_("Tag stem"), db_index=True)
+    content_type = db.ForeignKey(ContentType, verbose_name=_("Content type"),
+        related_name="%(app_label)s_%(class)s_summaries")
+    tag_count = db.IntegerField(verbose_name=_("Tag count"), default=0)
+    official_count = db.IntegerField(verbose_name=_("Official tag count"),
+        default=0)
+
+    class Meta:
+        verbose_name = _("Tag stem summary")
+        verbose_name_plural = _("Tag stem summaries")
+        unique_together = ('stem_id', 'content_type')
+
+    @classmethod
+    def adjust(cls, changes):
+        """Applies `changes`, a dictionary of `(stem_id, content_type_id)` keys
+        to `[tag_count_delta, official_count_delta]` values. Rows sharing the
+        content type and the deltas are updated with a single F() UPDATE.
+        Missing rows are created and rows no longer counting any tags are
+        deleted. Cached tag clouds of affected content types are
+        invalidated."""
+        changes = {key: tuple(value) for key, value in changes.iteritems()
+            if any(value)}
+        if not changes:
+            return
+        ids_by_group = defaultdict(list)
+        for (stem_id, ct_id), deltas in changes.iteritems():
+            ids_by_group[ct_id, deltas].append(stem_id)
+        emptied = set()
+        for (ct_id, (tag_delta, official_delta)), ids in \
+            ids_by_group.iteritems():
+            if tag_delta > 0 or official_delta > 0:
+                cls._create_missing(ct_id, ids)
+            if tag_delta < 0:
+                emptied.update(ids)
+            cls.objects.filter(content_type=ct_id, stem_id__in=ids).update(
+                tag_count=db.F('tag_count') + tag_delta,
+                official_count=db.F('official_count') + official_delta)
+        if emptied:
+            cls._delete_empty(emptied)
+        cls.invalidate_clouds({ct_id for _, ct_id in changes})
+
+    @classmethod
+    def invalidate_clouds(cls, content_type_ids):
+        """Makes cached tag clouds for objects of the given content types (and
+        for all content types) stale."""
+        for ct_id in set(content_type_ids) | {None}:
+            try:
+                cache.incr(_cloud_version_key(ct_id))
+            except ValueError:
+                pass # no clouds cached yet
+
+    @classmethod
+    def _execute(cls, sql, params, ids):
+        """Executes `sql` with `{ids}` standing for placeholders of `ids`."""
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        field = lambda name: qn(cls._meta.get_field(name).column)
+        connection.cursor().execute(sql.format(
+            summary=qn(cls._meta.db_table), stem=qn(TagStem._meta.db_table),
+            id=qn(TagStem._meta.pk.column), language=qn('language'),
+            stem_id=field('stem_id'), content_type_id=field('content_type'),
+            tag_count=field('tag_count'),
+            official_count=field('official_count'),
+            ids=", ".join(["%s"] * len(ids))), params)
+        transaction.commit_unless_managed(using=using)
+
+    @classmethod
+    def _create_missing(cls, content_type_id, stem_ids):
+        """Inserts empty rows for stems not yet counted on objects of the given
+        content type. The language is copied from the stem."""
+        using = router.db_for_write(cls)
+        # inside an outer transaction only the failed INSERT may be rolled
+        # back, otherwise PostgreSQL refuses any further queries
+        sid = None
+        if transaction.is_managed(using=using):
+            sid = transaction.savepoint(using=using)
+        try:
+            cls._execute("INSERT INTO {summary} ({language}, {stem_id}, "
+                "{content_type_id}, {tag_count}, {official_count}) SELECT "
+                "{stem}.{language}, {stem}.{id}, %s, 0, 0 FROM {stem} WHERE "
+                "{stem}.{id} IN ({ids}) AND NOT EXISTS (SELECT 1 FROM "
+                "{summary} WHERE {summary}.{stem_id} = {stem}.{id} AND "
+                "{summary}.{content_type_id} = %s)", [content_type_id] +
+                stem_ids + [content_type_id], stem_ids)
+        except IntegrityError:
+            # a concurrent transaction inserted some of the rows first
+            if sid:
+                transaction.savepoint_rollback(sid, using=using)
+            else:
+                transaction.rollback_unless_managed(using=using)
+            if len(stem_ids) > 1:
+                for stem_id in stem_ids:
+                    cls._create_missing(content_type_id, [stem_id])
+            return
+        if sid:
+            transaction.savepoint_commit(sid, using=using)
+
+    @classmethod
+    def _delete_empty(cls, stem_ids):
+        # a single conditional DELETE never removes a row incremented
+        # concurrently
+        stem_ids = list(stem_ids)
+        cls._execute("DELETE FROM {summary} WHERE {tag_count} <= 0 AND "
+            "{stem_id} IN ({ids})", stem_ids, stem_ids)
+
+
 def clean_stems(sender, instance, **kwargs):
-    """Decreases tag count on the stem held by the deleted tag."""
-    try:
-        instance.stem.dec_count()
-    except (TagStem.DoesNotExist, AttributeError):
-        pass
+    """Decreases tag counts on the stem held by the deleted tag."""
+    if instance.stem_id and not _in_bulk_change():
+        TagStem.objects.adjust_counts({instance.stem_id: -1})
+        changes = defaultdict(lambda: [0, 0])
+        _summary_delta(changes, instance.stem_id, instance.content_type_id,
+            instance.official, sign=-1)
+        TagStemSummary.adjust(changes)
 post_delete.connect(clean_stems, sender=Tag)
+
+
+def invalidate_index(sender, instance, **kwargs):
+    """Drops cached index entries for the object and the stem of the saved
+    or deleted tag."""
+    if _in_bulk_change():
+        return
+    _drop_index_entries(instance.content_type_id, instance.object_id,
+        [instance.name])
+post_save.connect(invalidate_index, sender=Tag)
+post_delete.connect(invalidate_index, sender=Tag)
+
+
+def refresh_tag_names(sender, instance, **kwargs):
+    """Refreshes the `TagNames` field on the object of the saved or deleted
+    tag."""
+    if _in_bulk_change():
+        return
+    _refresh_tag_names(instance.content_type_id, [instance.object_id])
+post_save.connect(refresh_tag_names, sender=Tag)
+post_delete.connect(refresh_tag_names, sender=Tag)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""lck.django.tags.similarity
+   --------------------------
+
+   Scoring of tagged objects against a set of stems. A precomputed
+   object-by-stem incidence matrix can be built with the
+   ``build_tag_similarity`` management command and is then used by
+   ``TaggableBase.similar_objects()`` instead of the cached index.
+
+   Configured by these values in ``settings.py``:
+
+   * ``TAG_SIMILARITY_MATRIX_PATH`` - the file where the matrix is stored.
+     **Default**: None (precomputed matrices disabled).
+
+   * ``TAG_SIMILARITY_STALE_TIMEOUT`` - how long after the first tag change
+     since they were built matrices are still used, in seconds. After that
+     the cached index is used until the matrices are rebuilt, e.g. by
+     running ``build_tag_similarity --if-changed`` periodically. If the cache
+     lost track of tag changes, the timeout counts from the build.
+     **Default**: 15 minutes.
+
+   * ``TAG_SIMILARITY_CHECK_INTERVAL`` - how often a process checks whether
+     the file was replaced, in seconds. **Default**: 60 seconds."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from tempfile import NamedTemporaryFile
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+
+TAG_SIMILARITY_MATRIX_PATH = getattr(settings, 'TAG_SIMILARITY_MATRIX_PATH',
+    None)
+TAG_SIMILARITY_STALE_TIMEOUT = getattr(settings,
+    'TAG_SIMILARITY_STALE_TIMEOUT', 60 * 15)
+TAG_SIMILARITY_CHECK_INTERVAL = getattr(settings,
+    'TAG_SIMILARITY_CHECK_INTERVAL', 60)
+
+_CHANGED_KEY = 'tags::similarity::changed'
+# present from the start of a build as long as `_CHANGED_KEY` is trustworthy
+_BUILT_KEY = 'tags::similarity::built'
+# memcached treats longer timeouts as timestamps
+_CHANGED_TIMEOUT = 60 * 60 * 24 * 30
+
+# Distance functions take the number of `shared` stems and sizes of both stem
+# sets. They work both on ints and on NumPy arrays.
+METRICS = {
+    'symmetric_difference': lambda shared, size_a, size_b:
+        size_a + size_b - 2 * shared,
+    'jaccard': lambda shared, size_a, size_b:
+        1 - shared / (size_a + size_b - shared),
+}
+
+_loaded_matrices = {}
+
+
+class StemMatrix(object):
+    """A binary object-by-stem incidence matrix. Rows are tagged objects
+    identified by `(content_type_id, object_id)` keys, columns are stem names.
+
+    If SciPy is available, the matrix is stored in the CSR format and all
+    objects are scored in a single sparse matrix-vector product. Otherwise
+    a pure Python inverted index (stem -> rows) is used."""
+
+    def __init__(self, entries):
+        """`entries` is an iterable of `((content_type_id, object_id), name)`
+        pairs."""
+        self.keys = []
+        self.key_rows = {}
+        self.stem_columns = {}
+        cells = set()
+        for key, name in entries:
+            row = self.key_rows.get(key)
+            if row is None:
+                row = self.key_rows[key] = len(self.keys)
+                self.keys.append(key)
+            column = self.stem_columns.get(name)
+            if column is None:
+                column = self.stem_columns[name] = len(self.stem_columns)
+            cells.add((row, column))
+        if sparse is not None:
+            rows = [c[0] for c in cells]
+            columns = [c[1] for c in cells]
+            self.matrix = sparse.csr_matrix(
+                (numpy.ones(len(cells), dtype=numpy.int32), (rows, columns)),
+                shape=(len(self.keys), len(self.stem_columns)))
+            self.sizes = numpy.asarray(self.matrix.sum(axis=1)).ravel()
+            self.ct_ids = numpy.array([k[0] for k in self.keys],
+                dtype=numpy.int64)
+            self.postings = None
+        else:
+            self.matrix = None
+            self.sizes = [0] * len(self.keys)
+            self.postings = [[] for _ in xrange(len(self.stem_columns))]
+            for row, column in cells:
+                self.sizes[row] += 1
+                self.postings[column].append(row)
+
+    @classmethod
+    def from_tags(cls, tags):
+        """Builds the matrix from a `Tag` QuerySet using a single query."""
+        return cls(((ct_id, object_id), name) for ct_id, object_id, name in
+            tags.values_list('content_type_id', 'object_id', 'name').distinct())
+
+    def score(self, stems, metric, min_shared=1, content_type_id=None):
+        """score(stems, metric, [min_shared, content_type_id]) -> [(distance, key), ...]
+
+        Returns distances between the given set of stem names and every object
+        sharing at least `min_shared` of them. The result is unordered.
+        Optionally only objects of a specific `content_type_id` are
+        considered."""
+        distance = METRICS[metric]
+        size = len(stems)
+        columns = [self.stem_columns[s] for s in stems
+            if s in self.stem_columns]
+        if not columns:
+            return []
+        if self.matrix is not None:
+            query = numpy.zeros(len(self.stem_columns), dtype=numpy.int32)
+            query[columns] = 1
+            shared = self.matrix.dot(query)
+            mask = shared >= min_shared
+            if content_type_id is not None:
+                mask &= self.ct_ids == content_type_id
+            rows = numpy.nonzero(mask)[0]
+            distances = distance(shared[rows], self.sizes[rows], size)
+            return zip(distances.tolist(), [self.keys[r] for r in rows])
+        shared = defaultdict(int)
+        for column in columns:
+            for row in self.postings[column]:
+                shared[row] += 1
+        return [(distance(count, self.sizes[row], size), self.keys[row])
+            for row, count in shared.iteritems() if count >= min_shared and
+            (content_type_id is None or self.keys[row][0] == content_type_id)]
+
+
+def mark_changed():
+    """Records the time of the first tag change since matrices were last
+    built. Does nothing if precomputed matrices are disabled."""
+    if TAG_SIMILARITY_MATRIX_PATH:
+        cache.add(_CHANGED_KEY, time.time(), _CHANGED_TIMEOUT)
+
+
+def changed_since(built):
+    """Returns the time of the first tag change after `built` (a timestamp)
+    or None if tags didn't change since.
+
+    Changes are only tracked in the cache. If it lost track of them since
+    the last build (e.g. after a restart or an eviction), tags are assumed
+    to have changed at `built`."""
+    values = cache.get_many([_CHANGED_KEY, _BUILT_KEY])
+    if _BUILT_KEY not in values:
+        return built
+    changed = values.get(_CHANGED_KEY)
+    if changed is not None and changed >= built:
+        return changed
+    return None
+
+
+def begin_build():
+    """Returns the timestamp to pass to `save_matrices()`. Call it before
+    reading tags, later changes make the new matrices stale."""
+    built = time.time()
+    cache.delete(_CHANGED_KEY)
+    cache.set(_BUILT_KEY, built, _CHANGED_TIMEOUT)
+    return built
+
+
+def load_matrices(path=None):
+    """load_matrices([path]) -> {official: StemMatrix} or None
+
+    Returns precomputed matrices for all tags (key False) and for official
+    tags only (key True). The file is read once per process and re-read when
+    it changes on disk, which is checked every TAG_SIMILARITY_CHECK_INTERVAL
+    seconds. Returns None if no matrices were built or they are stale, see
+    TAG_SIMILARITY_STALE_TIMEOUT."""
+    path = path or TAG_SIMILARITY_MATRIX_PATH
+    if not path:
+        return None
+    now = time.time()
+    loaded = _loaded_matrices.get(path)
+    if not loaded or now - loaded[1] >= TAG_SIMILARITY_CHECK_INTERVAL:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        if mtime is None:
+            loaded = None, now, None
+        elif not loaded or loaded[0] != mtime:
+            with open(path, 'rb') as f:
+                loaded = mtime, now, pickle.load(f)
+        else:
+            loaded = mtime, now, loaded[2]
+        _loaded_matrices[path] = loaded
+    built, _, matrices = loaded
+    if matrices is None:
+        return None
+    # the modification time of the file is the time of the build
+    changed = changed_since(built)
+    if changed is not None and now - changed >= TAG_SIMILARITY_STALE_TIMEOUT:
+        return None
+    return matrices
+
+
+def save_matrices(matrices, path=None, built=None):
+    """Stores `matrices` under `path`. `built` is the timestamp returned by
+    `begin_build()`. The file is replaced atomically so processes reading it
+    never see a partial write."""
+    path = path or TAG_SIMILARITY_MATRIX_PATH
+    with NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)),
+        delete=False) as f:
+        pickle.dump(matrices, f, pickle.HIGHEST_PROTOCOL)
+    # temporary files are only readable by their owner
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(f.name, 0o666 & ~umask)
+    if built is not None:
+        os.utime(f.name, (built, built))
+    os.rename(f.name, path)
+    _loaded_matrices.pop(path, None)
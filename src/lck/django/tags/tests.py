@@ -0,0 +1,602 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 by Łukasz Langa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Tests for tagging helpers and models."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import random
+import shutil
+import stat
+import tempfile
+import timeit
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils.unittest import skipIf, skipUnless
+
+from lck.django.tags.helpers import (make_tag_normalizer, parse_tag_input,
+    parse_tag_inputs, split_strip)
+from lck.django.tags import models as tags_models
+from lck.django.tags import similarity
+from lck.django.tags.models import (_object_index_key, _stem_index_key, Tag,
+    TagStem, TagStemSummary, with_tags)
+from lck.dummy.defaults.models import TaggedCard, TaggedNote
+
+
+def reference_parse_tag_input(tagstring):
+    """The original character by character implementation of
+    `parse_tag_input()`, kept to verify the current one against."""
+    if not tagstring:
+        return []
+
+    if ',' not in tagstring and '"' not in tagstring:
+        words = list(set(split_strip(tagstring, ' ')))
+        words.sort()
+        return words
+
+    words = []
+    buffer = []
+    to_be_split = []
+    saw_loose_comma = False
+    open_quote = False
+    i = iter(tagstring)
+    try:
+        while True:
+            c = i.next()
+            if c == '"':
+                if buffer:
+                    to_be_split.append(''.join(buffer))
+                    buffer = []
+                open_quote = True
+                c = i.next()
+                while c != '"':
+                    buffer.append(c)
+                    c = i.next()
+                if buffer:
+                    word = ''.join(buffer).strip()
+                    if word:
+                        words.append(word)
+                    buffer = []
+                open_quote = False
+            else:
+                if not saw_loose_comma and c == ',':
+                    saw_loose_comma = True
+                buffer.append(c)
+    except StopIteration:
+        if buffer:
+            if open_quote and ',' in buffer:
+                saw_loose_comma = True
+            to_be_split.append(''.join(buffer))
+    if to_be_split:
+        if saw_loose_comma:
+            delimiter = ','
+        else:
+            delimiter = ' '
+        for chunk in to_be_split:
+            words.extend(split_strip(chunk, delimiter))
+    words = list(set(words))
+    words.sort()
+    return words
+
+
+def random_tagstrings(count, seed=0):
+    rnd = random.Random(seed)
+    alphabet = 'ab ,"\t'
+    for _ in xrange(count):
+        yield ''.join(rnd.choice(alphabet) for _ in xrange(rnd.randint(0,
+            20)))
+
+
+SAMPLES = [
+    '', 'one', 'one two', 'one, two', 'one two, three', '"one two" three',
+    '"one, two" three', '"one, two", three', 'a"b"c', 'x "abc', 'x "a,bc',
+    '"', '""', '" "', 'one "two', ',', ' , ', 'a,,b', '"a" "b"', 'b a b',
+    'zażółć "gęślą jaźń"',
+]
+
+
+class TestParseTagInput(TestCase):
+    def test_samples(self):
+        self.assertEqual(parse_tag_input('one two, three'),
+            ['one two', 'three'])
+        self.assertEqual(parse_tag_input('"one, two" three'),
+            ['one, two', 'three'])
+        self.assertEqual(parse_tag_input('x "a,bc'), ['a', 'bc', 'x'])
+        for tagstring in SAMPLES:
+            self.assertEqual(parse_tag_input(tagstring),
+                reference_parse_tag_input(tagstring), tagstring)
+
+    def test_equivalence(self):
+        for tagstring in random_tagstrings(5000):
+            self.assertEqual(parse_tag_input(tagstring),
+                reference_parse_tag_input(tagstring), repr(tagstring))
+
+    def test_batch(self):
+        self.assertEqual(list(parse_tag_inputs(SAMPLES)),
+            [parse_tag_input(tagstring) for tagstring in SAMPLES])
+
+    def test_normalize(self):
+        normalize = make_tag_normalizer(max_length=4)
+        self.assertEqual(parse_tag_input('Café, CAFÉ, "ab  c", x',
+            normalize), ['ab', 'café', 'x'])
+        self.assertEqual(list(parse_tag_inputs(['A B', 'b'], normalize)),
+            [['a', 'b'], ['b']])
+
+
+def make_author(username, is_staff=False):
+    return User.objects.create(username=username,
+        is_staff=is_staff).get_profile()
+
+
+def make_note(name, author=None):
+    return TaggedNote.objects.create(name=name, author=author)
+
+
+class TestTagCounts(TestCase):
+    def setUp(self):
+        self.author = make_author('author')
+        self.first = make_note('first', self.author)
+        self.second = make_note('second', self.author)
+        self.language = self.first.language
+
+    def stem_counts(self):
+        return dict(TagStem.objects.values_list('name', 'tag_count'))
+
+    def summary_counts(self):
+        return dict(TagStemSummary.objects.values_list('stem_id',
+            'tag_count'))
+
+    def test_bulk_counts(self):
+        self.first.tag_many('a, b', self.language, self.author)
+        self.second.tag_many(['b', 'c'], self.language, self.author)
+        self.assertEqual(self.stem_counts(), {'a': 1, 'b': 2, 'c': 1})
+        self.first.retag('b', self.language, self.author)
+        self.assertEqual(self.stem_counts(), {'b': 2, 'c': 1})
+        self.second.untag_all()
+        self.assertEqual(self.stem_counts(), {'b': 1})
+        self.assertEqual(self.summary_counts(),
+            {TagStem.objects.get(name='b').pk: 1})
+
+    def test_rebuild(self):
+        self.first.tag_many('a, b', self.language, self.author)
+        self.second.tag_many('b', self.language, self.author)
+        TagStem.objects.filter(name='b').update(tag_count=7)
+        TagStem.objects.create(name='orphan', language=self.language)
+        TagStemSummary.objects.all().delete()
+        call_command('rebuild_tag_counts', verbosity=0)
+        self.assertEqual(self.stem_counts(), {'a': 1, 'b': 2})
+        stems = dict(TagStem.objects.values_list('name', 'pk'))
+        self.assertEqual(self.summary_counts(),
+            {stems['a']: 1, stems['b']: 2})
+        Tag.objects.filter(name='a').update(stem=None)
+        call_command('rebuild_tag_counts', verbosity=0)
+        self.assertEqual(self.stem_counts(), {'b': 2})
+        self.assertEqual(self.summary_counts(), {stems['b']: 2})
+
+    def test_delete_unused(self):
+        self.first.tag('a', self.language, self.author)
+        stem = TagStem.objects.get(name='a')
+        # drifted count on a stem still in use
+        TagStem.objects.filter(pk=stem.pk).update(tag_count=0)
+        unused = TagStem.objects.create(name='unused', language=self.language)
+        TagStem.objects.delete_unused([unused.pk])
+        TagStem.objects.delete_unused()
+        self.assertEqual(set(TagStem.objects.values_list('name', flat=True)),
+            {'a'})
+
+    def test_adjust_counts_clamped(self):
+        self.first.tag('a', self.language, self.author)
+        stem = TagStem.objects.get(name='a')
+        TagStem.objects.adjust_counts({stem.pk: -3})
+        # still referenced by the tag, kept at zero instead of going negative
+        self.assertEqual(self.stem_counts(), {'a': 0})
+        stem.tag_count = 1
+        stem.dec_count(2)
+        self.assertEqual(stem.tag_count, 0)
+        self.assertEqual(self.stem_counts(), {'a': 0})
+
+
+class TestTagging(TestCase):
+    def setUp(self):
+        self.author = make_author('author')
+        self.other = make_author('other')
+        self.staff = make_author('staff', is_staff=True)
+        self.note = make_note('note', self.author)
+        self.language = self.note.language
+
+    def tags(self, **kwargs):
+        return sorted(self.note.tags.filter(**kwargs).values_list('name',
+            'author', 'official'))
+
+    def test_tag_many(self):
+        self.note.tag_many('a, b', self.language, self.author)
+        self.note.tag_many(['b', 'c'], self.language, self.author)
+        self.note.tag_many('b', self.language, self.other)
+        a, o = self.author.pk, self.other.pk
+        self.assertEqual(self.tags(), [('a', a, False), ('b', a, False),
+            ('b', o, False), ('c', a, False)])
+        # tagging again doesn't write anything
+        with self.assertNumQueries(1):
+            self.note.tag_many('a, b, c', self.language, self.author)
+
+    def test_retag(self):
+        self.note.tag_many('a, b', self.language, self.author)
+        self.note.tag_many('a', self.language, self.other)
+        self.note.retag('b, c', self.language, self.author)
+        a, o = self.author.pk, self.other.pk
+        self.assertEqual(self.tags(), [('a', o, False), ('b', a, False),
+            ('c', a, False)])
+        self.assertEqual(dict(TagStem.objects.values_list('name',
+            'tag_count')), {'a': 1, 'b': 1, 'c': 1})
+        self.note.untag('c', self.language, self.author)
+        self.assertEqual(self.tags(author=self.author), [('b', a, False)])
+        self.assertEqual(TagStem.objects.get(name='b').tag_count, 1)
+        self.assertFalse(TagStem.objects.filter(name='c').exists())
+
+    def test_default_tags(self):
+        self.note._default_tags = 'a, b'
+        self.note.save()
+        a, s = self.author.pk, self.staff.pk
+        self.assertEqual(self.tags(), [('a', a, False), ('b', a, False)])
+        self.note.tag('c', self.language, self.author)
+        # a new default tags author takes the default tags over
+        self.note.author = self.staff
+        self.note.save()
+        self.assertEqual(self.tags(), [('a', s, True), ('b', s, True),
+            ('c', a, False)])
+        stem = TagStem.objects.get(name='a')
+        self.assertEqual(TagStemSummary.objects.filter(stem_id=stem.pk
+            ).values_list('tag_count', 'official_count').get(), (1, 1))
+        self.note._default_tags = 'b'
+        self.note.save()
+        self.assertEqual(self.tags(), [('b', s, True), ('c', a, False)])
+
+
+def count_queries(func, *args, **kwargs):
+    """Returns the number of queries run by `func`."""
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        func(*args, **kwargs)
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+    return len(connection.queries) - start
+
+
+class TestTagNames(TestCase):
+    def setUp(self):
+        self.author = make_author('author')
+        self.staff = make_author('staff', is_staff=True)
+        self.card = TaggedCard.objects.create(name='card', author=self.staff)
+        self.language = self.card.language
+
+    def reload(self):
+        return TaggedCard.objects.get(pk=self.card.pk)
+
+    def test_tag_names(self):
+        stale = self.reload()
+        self.card.tag_many(['b', 'A', 'two\nlines'], self.language,
+            self.staff)
+        self.card.tag('c', self.language, self.author)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.card.get_tag_names(),
+                ['A', 'b', 'two\nlines'])
+        # saving a stale instance neither reads nor overwrites the names
+        stale.name = 'renamed'
+        with self.assertNumQueries(2):
+            stale.save()
+        self.assertEqual(self.reload().get_tag_names(),
+            ['A', 'b', 'two\nlines'])
+        self.card.untag('b', self.language, self.staff)
+        self.assertEqual(self.reload().get_tag_names(), ['A', 'two\nlines'])
+        # signals keep the names up to date on single tag changes
+        Tag.objects.get(name='A').delete()
+        self.assertEqual(self.reload().get_tag_names(), ['two\nlines'])
+
+    def test_untag_all(self):
+        other = TaggedCard.objects.create(name='other', author=self.staff)
+        self.card.tag('a', self.language, self.staff)
+        other.tag('b, c, d, e, f', self.language, self.staff)
+        # the number of queries doesn't depend on the number of tags
+        self.assertEqual(count_queries(self.card.untag_all),
+            count_queries(other.untag_all))
+        self.assertFalse(Tag.objects.exists())
+        self.assertFalse(TagStem.objects.exists())
+        self.assertFalse(TagStemSummary.objects.exists())
+        self.assertEqual(self.reload().get_tag_names(), [])
+
+    def test_with_tags(self):
+        notes = [make_note(name, self.author) for name in ('first', 'second')]
+        notes[0].tag('b, a', self.language, self.staff)
+        notes[1].tag('c', self.language, self.author)
+        self.card.tag('d', self.language, self.staff)
+        notes = list(TaggedNote.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            objects = with_tags(notes + [self.reload()])
+        with self.assertNumQueries(0):
+            self.assertEqual([obj.get_tag_names() for obj in objects],
+                [['a', 'b'], [], ['d']])
+        with self.assertNumQueries(1):
+            objects = with_tags(notes, official=False)
+        self.assertEqual([obj.get_tag_names(official=False)
+            for obj in objects], [['a', 'b'], ['c']])
+
+
+class TestTagCloud(TestCase):
+    def setUp(self):
+        self.author = make_author('author')
+        self.staff = make_author('staff', is_staff=True)
+        self.first = make_note('first', self.author)
+        self.second = make_note('second', self.author)
+        self.language = self.first.language
+
+    def cloud(self, **kwargs):
+        return [(stem.name, stem.cloud_count, stem.cloud_bucket)
+            for stem in TagStem.objects.cloud(**kwargs)]
+
+    def test_summaries(self):
+        self.first.tag('a, b', self.language, self.author)
+        self.second.tag('b', self.language, self.staff)
+        self.assertEqual(sorted(TagStemSummary.objects.values_list(
+            'stem_id', 'language', 'tag_count', 'official_count')), sorted([
+            (TagStem.objects.get(name='a').pk, self.language, 1, 0),
+            (TagStem.objects.get(name='b').pk, self.language, 2, 1)]))
+        # rows no longer counting any tags are removed right away
+        self.first.untag_all()
+        self.second.untag('b', self.language, self.staff)
+        self.assertFalse(TagStemSummary.objects.exists())
+
+    def test_cloud(self):
+        self.first.tag('a, b', self.language, self.author)
+        self.second.tag('b', self.language, self.staff)
+        self.assertEqual(self.cloud(model=TaggedNote, scale='linear'),
+            [('a', 1, 1), ('b', 2, 5)])
+        self.assertEqual(self.cloud(official=True), [('b', 1, 1)])
+        self.assertEqual(self.cloud(limit=1), [('b', 2, 1)])
+        # tag changes invalidate cached clouds
+        self.second.tag('c', self.language, self.author)
+        self.assertEqual(self.cloud(model=TaggedNote, scale='linear'),
+            [('a', 1, 1), ('b', 2, 5), ('c', 1, 1)])
+        self.first.untag_all()
+        self.assertEqual(self.cloud(), [('b', 1, 1), ('c', 1, 1)])
+        with self.assertRaises(ValueError):
+            TagStem.objects.cloud(scale='sqrt')
+
+
+class TestTagIndex(TestCase):
+    def setUp(self):
+        self.author = make_author('author')
+        self.staff = make_author('staff', is_staff=True)
+        self.first = make_note('first', self.author)
+        self.second = make_note('second', self.author)
+        self.third = make_note('third', self.author)
+        self.language = self.first.language
+        self.ct_id = ContentType.objects.get_for_model(TaggedNote).id
+        # entries of previous runs might refer to the same primary keys
+        cache.delete_many([_stem_index_key(name) for name in 'abc'] +
+            [_object_index_key(self.ct_id, note.pk) for note in (self.first,
+            self.second, self.third)])
+
+    def test_get_dictionary(self):
+        self.first.tag('a, b', self.language, self.author)
+        self.second.tag('b', self.language, self.staff)
+        self.assertEqual(TagStem.objects.get_dictionary(model=TaggedNote),
+            {self.first: {'a', 'b'}, self.second: {'b'}})
+        self.assertEqual(TagStem.objects.get_dictionary(official=True),
+            {self.second: {'b'}})
+        # filtered objects still list all of their stems
+        self.assertEqual(TagStem.objects.get_dictionary(
+            stem=TagStem.objects.get(name='a')), {self.first: {'a', 'b'}})
+
+    def test_objects_for_stems(self):
+        self.first.tag('a, b', self.language, self.author)
+        self.second.tag('b', self.language, self.staff)
+        expected = {'a': {(self.ct_id, self.first.pk, False)},
+            'b': {(self.ct_id, self.first.pk, False),
+                (self.ct_id, self.second.pk, True)}, 'c': set()}
+        with self.assertNumQueries(1):
+            self.assertEqual(TagStem.objects.get_objects_for_stems('abc'),
+                expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(TagStem.objects.get_objects_for_stems('abc'),
+                expected)
+        self.third.tag('a', self.language, self.author)
+        expected['a'].add((self.ct_id, self.third.pk, False))
+        self.assertEqual(TagStem.objects.get_objects_for_stems('abc'),
+            expected)
+        Tag.objects.get(name='b', object_id=self.second.pk).delete()
+        expected['b'] = {(self.ct_id, self.first.pk, False)}
+        self.assertEqual(TagStem.objects.get_objects_for_stems('abc'),
+            expected)
+
+    def test_index_size_limit(self):
+        self.first.tag('a', self.language, self.author)
+        self.second.tag('a, b', self.language, self.author)
+        max_objects = tags_models.TAG_INDEX_MAX_OBJECTS
+        tags_models.TAG_INDEX_MAX_OBJECTS = 1
+        try:
+            TagStem.objects.get_objects_for_stems('ab')
+            # the entry for `a` is too large to be cached
+            self.assertIsNone(cache.get(_stem_index_key('a')))
+            self.assertEqual(cache.get(_stem_index_key('b')),
+                {(self.ct_id, self.second.pk, False)})
+        finally:
+            tags_models.TAG_INDEX_MAX_OBJECTS = max_objects
+
+    def test_similar_objects(self):
+        self.first.tag('a, b, c', self.language, self.author)
+        self.second.tag('a, b', self.language, self.author)
+        self.third.tag('c', self.language, self.author)
+        self.assertEqual(self.first.similar_objects(),
+            [(self.second, 1), (self.third, 2)])
+        self.assertEqual(self.first.similar_objects(min_shared=2),
+            [(self.second, 1)])
+
+
+class TestContentObjects(TestCase):
+    def setUp(self):
+        self.author = make_author('author')
+        self.notes = [make_note(name, self.author) for name in 'edcba']
+        self.language = self.notes[0].language
+        for note in self.notes:
+            note.tag('a', self.language, self.author)
+        self.stem = TagStem.objects.get(name='a')
+        self.chunk_size = tags_models.TAG_FETCH_CHUNK_SIZE
+        tags_models.TAG_FETCH_CHUNK_SIZE = 2
+
+    def tearDown(self):
+        tags_models.TAG_FETCH_CHUNK_SIZE = self.chunk_size
+
+    def test_chunks(self):
+        # the tags and three chunks of objects
+        with self.assertNumQueries(4):
+            self.assertEqual(list(TagStem.objects.get_content_objects(
+                stem=self.stem)), self.notes)
+        with self.assertNumQueries(3):
+            self.assertEqual(list(TagStem.objects.get_content_objects(
+                stem=self.stem, offset=1, limit=3)), self.notes[1:4])
+
+    def test_order_by(self):
+        # content types, ordered primary keys and two chunks of objects
+        with self.assertNumQueries(4):
+            self.assertEqual(list(TagStem.objects.get_content_objects(
+                stem=self.stem, order_by=['name'], offset=1, limit=3)),
+                self.notes[::-1][1:4])
+        self.assertEqual(list(TagStem.objects.get_content_objects(
+            model=TaggedNote, order_by=['-name'])), self.notes)
+
+
+@skipIf(connection.vendor == 'sqlite',
+        "Concurrent connections are not supported by the test database.")
+class TestConcurrentContentObjects(TransactionTestCase):
+    def test_threads(self):
+        author = make_author('author')
+        notes = [make_note('note{}'.format(i), author) for i in xrange(10)]
+        for note in notes:
+            note.tag('a', note.language, author)
+        settings = tags_models.TAG_FETCH_CHUNK_SIZE, \
+            tags_models.TAG_FETCH_THREADS
+        tags_models.TAG_FETCH_CHUNK_SIZE = 3
+        tags_models.TAG_FETCH_THREADS = 2
+        try:
+            self.assertEqual(list(TagStem.objects.get_content_objects(
+                model=TaggedNote)), notes)
+            self.assertEqual(list(TagStem.objects.get_content_objects(
+                model=TaggedNote, order_by=['-name'])), notes[::-1])
+        finally:
+            tags_models.TAG_FETCH_CHUNK_SIZE, \
+                tags_models.TAG_FETCH_THREADS = settings
+
+
+class TestTagSimilarity(TestCase):
+    def setUp(self):
+        self.author = make_author('author')
+        self.first = make_note('first', self.author)
+        self.second = make_note('second', self.author)
+        self.third = make_note('third', self.author)
+        self.language = self.first.language
+        self.first.tag('a, b, c', self.language, self.author)
+        self.second.tag('a, b', self.language, self.author)
+        self.third.tag('c', self.language, self.author)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'similarity.pickle')
+        self.settings = (similarity.TAG_SIMILARITY_MATRIX_PATH,
+            similarity.TAG_SIMILARITY_STALE_TIMEOUT,
+            similarity.TAG_SIMILARITY_CHECK_INTERVAL)
+        similarity.TAG_SIMILARITY_MATRIX_PATH = self.path
+        similarity.TAG_SIMILARITY_CHECK_INTERVAL = 0
+
+    def tearDown(self):
+        (similarity.TAG_SIMILARITY_MATRIX_PATH,
+            similarity.TAG_SIMILARITY_STALE_TIMEOUT,
+            similarity.TAG_SIMILARITY_CHECK_INTERVAL) = self.settings
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        self.assertIsNone(similarity.load_matrices())
+        expected = self.first.similar_objects()
+        self.assertEqual(expected, [(self.second, 1), (self.third, 2)])
+        call_command('build_tag_similarity', verbosity=0)
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode),
+            0o666 & ~umask)
+        matrices = similarity.load_matrices()
+        self.assertEqual(len(matrices[False].keys), 3)
+        self.assertEqual(self.first.similar_objects(), expected)
+
+    def test_stale(self):
+        call_command('build_tag_similarity', verbosity=0)
+        built = os.path.getmtime(self.path)
+        self.assertIsNotNone(similarity.load_matrices())
+        self.third.tag('a', self.language, self.author)
+        # still used within the timeout
+        self.assertIsNotNone(similarity.load_matrices())
+        similarity.TAG_SIMILARITY_STALE_TIMEOUT = 0
+        self.assertIsNone(similarity.load_matrices())
+        self.assertEqual(self.first.similar_objects(),
+            [(self.second, 1), (self.third, 1)])
+        call_command('build_tag_similarity', verbosity=0, if_changed=True)
+        rebuilt = os.path.getmtime(self.path)
+        self.assertGreaterEqual(rebuilt, built)
+        self.assertIsNotNone(similarity.load_matrices())
+        self.assertEqual(self.first.similar_objects(),
+            [(self.second, 1), (self.third, 1)])
+        call_command('build_tag_similarity', verbosity=0, if_changed=True)
+        self.assertEqual(os.path.getmtime(self.path), rebuilt)
+
+    def test_stale_after_cache_loss(self):
+        call_command('build_tag_similarity', verbosity=0)
+        built = os.path.getmtime(self.path)
+        # e.g. a restarted memcached, tag changes might have been missed
+        cache.delete_many([similarity._CHANGED_KEY, similarity._BUILT_KEY])
+        self.assertEqual(similarity.changed_since(built), built)
+        self.assertIsNotNone(similarity.load_matrices())
+        similarity.TAG_SIMILARITY_STALE_TIMEOUT = 0
+        self.assertIsNone(similarity.load_matrices())
+        call_command('build_tag_similarity', verbosity=0, if_changed=True)
+        self.assertIsNone(similarity.changed_since(
+            os.path.getmtime(self.path)))
+        self.assertIsNotNone(similarity.load_matrices())
+
+
+@skipUnless(os.environ.get('LCK_BENCHMARK'),
+            "Set LCK_BENCHMARK=1 to run benchmarks.")
+class BenchmarkParseTagInput(TestCase):
+    def test_parse_tag_input(self):
+        tagstrings = list(random_tagstrings(2000)) + SAMPLES * 100
+        for func in (reference_parse_tag_input, parse_tag_input):
+            elapsed = min(timeit.repeat(lambda: [func(t) for t in tagstrings],
+                repeat=3, number=5))
+            print("\n{}: {:.1f} us per string".format(func.__name__,
+                elapsed / 5 / len(tagstrings) * 10 ** 6))
@@ -35,11 +35,13 @@ from django.db import models as db
 from django.dispatch import receiver
 from lck.django.activitylog.models import MonitoredActivity
 from lck.django.common.models import (
+    Localized,
     Named,
     TimeTrackable,
     WithConcurrentGetOrCreate,
 )
 from lck.django.profile.models import BasicInfo
+from lck.django.tags.models import Taggable, TagNames
 
 
 class Profile(BasicInfo, MonitoredActivity):
@@ -63,6 +65,15 @@ class CurrentlyConcurrent(Named, WithConcurrentGetOrCreate):
 class TimeConscious(Named, TimeTrackable):
     pass
 
+
+class TaggedNote(Named, Localized, Taggable):
+    author = db.ForeignKey(Profile, null=True, blank=True, default=None)
+
+
+class TaggedCard(Named, Localized, Taggable):
+    author = db.ForeignKey(Profile, null=True, blank=True, default=None)
+    tag_names = TagNames()
+
 # workaround for a unit test bug in Django 1.4.x
 
 from django.contrib.auth.tests import models as auth_test_models
@@ -68,6 +68,7 @@ INSTALLED_APPS = (
     'south',
     'lck.django.common',
     'lck.django.activitylog',
+    'lck.django.badges',
     'lck.django.profile',
     'lck.django.score',
     'lck.django.tags',